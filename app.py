@@ -1,21 +1,139 @@
-from flask import Flask, render_template, request, jsonify, send_file
+from flask import Flask, render_template, request, jsonify, Response
 import pandas as pd
+import numpy as np
 import os
 from werkzeug.utils import secure_filename
 from rapidfuzz import fuzz, process
 import json
+import logging
 from datetime import datetime
 import re
+import unicodedata
+import heapq
+import itertools
+import hashlib
+import pickle
+import threading
+import multiprocessing
+import time
+import shutil
+import uuid
+from collections import OrderedDict, Counter, deque
+from functools import lru_cache, partial
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 import tempfile
+import csv
+import sqlite3
+import tracemalloc
+import cProfile
+import pstats
+import hmac
 import io
+import contextlib
+from openpyxl import Workbook, load_workbook
+import xlrd
+from openpyxl.cell import WriteOnlyCell
+from openpyxl.styles import Alignment, Border, Font, Side
+try:  # Exportação em Parquet é opcional (pip install pyarrow)
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = pq = None
 
 app = Flask(__name__)
 app.config['SECRET_KEY'] = 'sua-chave-secreta-aqui'
 app.config['UPLOAD_FOLDER'] = 'uploads'
 app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # 16MB max file size
+# Matching vetorizado: nomes TOEFL pontuados por bloco; workers=-1 usa todos os núcleos no cdist
+app.config['MATCH_CHUNK_SIZE'] = 256
+app.config['MATCH_CDIST_WORKERS'] = -1
+# Blocking: pontuar só candidatos que compartilham tokens/prefixos/n-gramas (fallback para varredura completa)
+app.config['MATCH_BLOCKING'] = False
+app.config['MATCH_BLOCKING_FULL_SCAN_FALLBACK'] = True
+app.config['BLOCKING_PREFIX_LEN'] = 3
+app.config['BLOCKING_NGRAM_SIZE'] = 3
+app.config['BLOCKING_NGRAM_MIN_SHARE'] = 0.6
+app.config['SUGGESTIONS_TOP_K'] = 3
+# Teto do top_k pedido em /compare: os candidatos de cada nome são guardados em arrays (nomes × top_k)
+app.config['SUGGESTIONS_MAX_TOP_K'] = 20
+# Diagnóstico: incluir na resposta o melhor candidato absoluto de cada nome (independe do limiar)
+app.config['MATCH_DIAGNOSTICS'] = False
+# Conjuntos de candidatos pequenos são pontuados par a par com score_cutoff (mais rápido que cdist)
+app.config['MATCH_PAIRWISE_MAX_CANDIDATES'] = 16
+# Sharding do matching entre processos (ProcessPoolExecutor): None = um processo por núcleo, 0/1 = serial
+app.config['MATCH_PROCESSES'] = None
+app.config['MATCH_PROCESS_MIN_NAMES'] = 2000  # abaixo disso subir os processos custa mais que o ganho
+# Início dos processos do pool: o pool é criado dentro de threads de job, e um fork do servidor com várias
+# threads vivas pode herdar um lock preso (logging, sqlite); 'forkserver' (ou 'spawn') evita isso
+app.config['MATCH_PROCESS_START_METHOD'] = 'forkserver'
+
+# Cache de planilhas já lidas (memória LRU + pickle em disco), chaveado pelo SHA-256 do arquivo
+app.config['DATASET_CACHE_FOLDER'] = os.path.join(app.config['UPLOAD_FOLDER'], 'cache')
+app.config['DATASET_CACHE_MAX_ENTRIES'] = 8
+app.config['DATASET_CACHE_MAX_BYTES'] = 256 * 1024 * 1024
+app.config['DATASET_CACHE_MAX_DISK_BYTES'] = 1024 * 1024 * 1024
+# /upload lê só cabeçalho, nomes das abas e contagem de linhas; amostra opcional limitada a este valor
+app.config['UPLOAD_PREVIEW_MAX_SAMPLE_ROWS'] = 20
+# Planilha TOEFL em CSV lida em blocos (só a coluna de nomes e as métricas), alimentando o matching
+# à medida que é lida; CSVs menores que o limite são lidos inteiros e passam pelo cache
+app.config['TOEFL_STREAM_CSV'] = True
+app.config['TOEFL_STREAM_MIN_BYTES'] = 8 * 1024 * 1024
+app.config['TOEFL_STREAM_CHUNK_ROWS'] = 20000
+
+# Registro de rosters: planilhas base já preparadas (rótulos, professor, nível, nomes parseados, índice)
+# reutilizadas entre lotes TOEFL; LRU em memória + pickle em disco, sem expiração
+app.config['ROSTER_FOLDER'] = os.path.join(app.config['UPLOAD_FOLDER'], 'rosters')
+app.config['ROSTER_MAX_ENTRIES'] = 8
+
+# Cache persistente (SQLite) dos candidatos de cada nome TOEFL por roster e opções de matching:
+# reexecuções só pontuam nomes novos ou alterados
+app.config['MATCH_CACHE'] = True
+app.config['MATCH_CACHE_PATH'] = os.path.join(app.config['UPLOAD_FOLDER'], 'match_cache.sqlite3')
+app.config['MATCH_CACHE_MAX_ROWS'] = 500000
+
+# Cada upload ganha um workspace isolado (uploads/workspaces/<dataset_id>) removido após o TTL
+app.config['WORKSPACE_FOLDER'] = os.path.join(app.config['UPLOAD_FOLDER'], 'workspaces')
+app.config['WORKSPACE_TTL_SECONDS'] = 6 * 60 * 60
+
+# Resultados de /compare guardados no servidor (LRU em memória + pickle em disco) para /export?result_id=
+app.config['RESULT_STORE_FOLDER'] = os.path.join(app.config['UPLOAD_FOLDER'], 'results')
+app.config['RESULT_STORE_MAX_ENTRIES'] = 16
+app.config['RESULT_TTL_SECONDS'] = 6 * 60 * 60
+# Exportação: planilha escrita linha a linha (openpyxl write-only) em arquivo temporário e enviada em blocos
+app.config['EXPORT_STREAM_CHUNK_SIZE'] = 64 * 1024
+# Linhas por bloco nas exportações CSV/NDJSON (streaming) e por row group no Parquet
+app.config['EXPORT_BATCH_ROWS'] = 5000
+
+# Comparações rodam em background: POST /compare devolve job_id e o progresso sai em GET /jobs/<id>
+app.config['COMPARE_ASYNC'] = True
+app.config['JOB_WORKERS'] = 2
+app.config['JOB_MAX_PENDING'] = 16  # jobs na fila + em execução; acima disso /compare responde 503
+app.config['JOB_TTL_SECONDS'] = 60 * 60  # jobs concluídos ficam consultáveis por este tempo
+
+# Logging por categoria (substitui os prints de diagnóstico): níveis ajustáveis por categoria
+app.config['LOG_LEVELS'] = {'class_source': 'INFO', 'matching': 'INFO', 'export': 'INFO'}
+app.config['LOG_FORMAT'] = '%(asctime)s [%(process)d] %(name)s %(levelname)s %(message)s'
+# Eventos por linha (origem do rótulo de turma, nível DEBUG): no máximo N registros por requisição
+app.config['LOG_SAMPLE_LIMIT'] = 20
+# Contadores por aba/requisição num único registro estruturado; as linhas por aba descem para DEBUG
+app.config['LOG_AGGREGATE_COUNTERS'] = True
+
+# Instrumentação por etapa de /compare e /export: bloco `timings` na resposta com "timings": true
+# (pico de memória por etapa com "trace_memory": true) e histogramas acumulados em GET /metrics
+app.config['COMPARE_TIMINGS'] = False
+app.config['METRICS_ENABLED'] = True
+app.config['METRICS_BUCKETS'] = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+# Perfil cProfile sob demanda de uma requisição de /compare ou /export (X-Profile: 1 ou ?profile=1),
+# só com o cabeçalho X-Admin-Token igual a ADMIN_TOKEN; sem token configurado a captura fica desligada.
+# Os .pstats ficam em PROFILE_FOLDER (os PROFILE_MAX_FILES mais recentes) e saem em GET /profiles
+app.config['ADMIN_TOKEN'] = os.environ.get('COMPARAR_ADMIN_TOKEN')
+app.config['PROFILE_FOLDER'] = os.path.join(app.config['UPLOAD_FOLDER'], 'profiles')
+app.config['PROFILE_MAX_FILES'] = 20
 
 # Criar pasta de uploads se não existir
 os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
+os.makedirs(app.config['WORKSPACE_FOLDER'], exist_ok=True)
 
 # Extensões permitidas
 ALLOWED_EXTENSIONS = {'xlsx', 'xls', 'csv'}
@@ -23,6 +141,853 @@ ALLOWED_EXTENSIONS = {'xlsx', 'xls', 'csv'}
 def allowed_file(filename):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
+log_class_source = logging.getLogger('comparar.class_source')
+log_matching = logging.getLogger('comparar.matching')
+log_export = logging.getLogger('comparar.export')
+
+def configure_logging():
+    """Apply LOG_LEVELS and LOG_FORMAT to the category loggers (call again after changing them).
+
+    A stderr handler is attached to the ``comparar`` logger only when the
+    server has not configured logging itself (no root handlers).
+    """
+    parent = logging.getLogger('comparar')
+    handler = next((h for h in parent.handlers if getattr(h, 'comparar_default', False)), None)
+    if handler is None and not logging.getLogger().handlers:
+        handler = logging.StreamHandler()
+        handler.comparar_default = True
+        parent.addHandler(handler)
+    if handler is not None:
+        handler.setFormatter(logging.Formatter(app.config['LOG_FORMAT']))
+    for category, level in app.config['LOG_LEVELS'].items():
+        logging.getLogger(f'comparar.{category}').setLevel(str(level).upper())
+
+configure_logging()
+
+class SampledLog:
+    """Per-request limit for per-row log events.
+
+    The first ``limit`` events are logged (a negative limit disables the cap);
+    later ones are only counted in ``suppressed``. Nothing is formatted or
+    counted while the logger's level filters the events out.
+    """
+
+    def __init__(self, logger, limit, level=logging.DEBUG):
+        self.logger = logger
+        self.limit = limit
+        self.level = level
+        self.emitted = 0
+        self.suppressed = 0
+
+    def log(self, msg, *args):
+        if not self.logger.isEnabledFor(self.level):
+            return
+        if 0 <= self.limit <= self.emitted:
+            self.suppressed += 1
+            return
+        self.emitted += 1
+        self.logger.log(self.level, msg, *args)
+
+def _prometheus_labels(labels):
+    escaped = (
+        (key, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+        for key, value in labels
+    )
+    return '{' + ','.join(f'{key}="{value}"' for key, value in escaped) + '}'
+
+class StageMetrics:
+    """Cumulative per-stage timing histograms and counters, in Prometheus text format.
+
+    Fed by every StageTimer with a route and served by GET /metrics. The
+    values live in this process's memory (one set per WSGI worker process),
+    like the job store.
+    """
+
+    def __init__(self, buckets):
+        self.buckets = tuple(sorted(float(b) for b in buckets))
+        self._lock = threading.Lock()
+        self._stage_seconds = {}  # (route, stage) -> [contagens por bucket, soma, total]
+        self._request_seconds = {}  # (route,) -> idem
+        self._stage_rows = Counter()  # (route, stage, direction) -> linhas
+        self._requests = Counter()  # (route, status) -> requisições
+        self._counters = Counter()  # (name, route) -> valor (ex.: chamadas rapidfuzz)
+
+    def _observe(self, histograms, key, seconds):
+        histogram = histograms.get(key)
+        if histogram is None:
+            histogram = histograms[key] = [[0] * len(self.buckets), 0.0, 0]
+        for i, bound in enumerate(self.buckets):
+            if seconds <= bound:
+                histogram[0][i] += 1
+                break
+        histogram[1] += seconds
+        histogram[2] += 1
+
+    def observe_stage(self, route, stage, seconds, rows_in=None, rows_out=None):
+        with self._lock:
+            self._observe(self._stage_seconds, (route, stage), seconds)
+            if rows_in is not None:
+                self._stage_rows[(route, stage, 'in')] += rows_in
+            if rows_out is not None:
+                self._stage_rows[(route, stage, 'out')] += rows_out
+
+    def observe_request(self, route, seconds, status, counters=None):
+        with self._lock:
+            self._observe(self._request_seconds, (route,), seconds)
+            self._requests[(route, status)] += 1
+            for name, value in (counters or {}).items():
+                self._counters[(name, route)] += value
+
+    def _render_histogram(self, lines, name, help_text, histograms, label_names):
+        lines.append(f'# HELP {name} {help_text}')
+        lines.append(f'# TYPE {name} histogram')
+        for key, (bucket_counts, total, count) in sorted(histograms.items()):
+            labels = list(zip(label_names, key))
+            cumulative = 0
+            for bound, n in zip(self.buckets, bucket_counts):
+                cumulative += n
+                lines.append(f'{name}_bucket{_prometheus_labels(labels + [("le", f"{bound:g}")])} {cumulative}')
+            lines.append(f'{name}_bucket{_prometheus_labels(labels + [("le", "+Inf")])} {count}')
+            lines.append(f'{name}_sum{_prometheus_labels(labels)} {total:.6f}')
+            lines.append(f'{name}_count{_prometheus_labels(labels)} {count}')
+
+    def render(self):
+        """Prometheus text exposition (format 0.0.4) of everything observed so far."""
+        with self._lock:
+            lines = []
+            self._render_histogram(
+                lines, 'comparar_stage_duration_seconds', 'Wall time of each pipeline stage.',
+                self._stage_seconds, ('route', 'stage'),
+            )
+            self._render_histogram(
+                lines, 'comparar_request_duration_seconds', 'Wall time of instrumented requests.',
+                self._request_seconds, ('route',),
+            )
+            lines.append('# HELP comparar_stage_rows_total Rows entering (in) and leaving (out) each stage.')
+            lines.append('# TYPE comparar_stage_rows_total counter')
+            for (route, stage, direction), rows in sorted(self._stage_rows.items()):
+                labels = [('route', route), ('stage', stage), ('direction', direction)]
+                lines.append(f'comparar_stage_rows_total{_prometheus_labels(labels)} {rows}')
+            lines.append('# HELP comparar_requests_total Instrumented requests by outcome.')
+            lines.append('# TYPE comparar_requests_total counter')
+            for (route, status), n in sorted(self._requests.items()):
+                lines.append(f'comparar_requests_total{_prometheus_labels([("route", route), ("status", status)])} {n}')
+            for name in sorted({name for name, _ in self._counters}):
+                lines.append(f'# TYPE comparar_{name}_total counter')
+                for (counter, route), value in sorted(self._counters.items()):
+                    if counter == name:
+                        lines.append(f'comparar_{name}_total{_prometheus_labels([("route", route)])} {value}')
+        return '\n'.join(lines) + '\n'
+
+stage_metrics = StageMetrics(app.config['METRICS_BUCKETS'])
+
+class StageTimer:
+    """Wall time of the consecutive stages of one request, measured lap by lap.
+
+    ``lap(stage)`` closes the stage that began at the previous lap (or when
+    the timer was created), so a linear pipeline is instrumented with one call
+    at the end of each stage. Work counters (e.g. rapidfuzz calls) go to
+    ``counters``. With ``trace_memory`` each stage also records the peak
+    traced memory (tracemalloc is process-wide: concurrent traced requests
+    see each other's allocations). Timers with a ``route`` feed
+    ``stage_metrics``.
+    """
+
+    _tracing_users = 0
+    _tracing_owned = False  # tracemalloc iniciado aqui (não desligar o de quem já rastreava)
+    _tracing_lock = threading.Lock()
+
+    def __init__(self, route=None, trace_memory=False):
+        self.route = route if app.config['METRICS_ENABLED'] else None
+        self.stages = []
+        self.counters = Counter()
+        self.trace_memory = trace_memory
+        self.started = self._last = time.perf_counter()
+        self._finished = None
+        if trace_memory:
+            with StageTimer._tracing_lock:
+                if StageTimer._tracing_users == 0 and not tracemalloc.is_tracing():
+                    tracemalloc.start()
+                    StageTimer._tracing_owned = True
+                StageTimer._tracing_users += 1
+            tracemalloc.reset_peak()
+
+    def lap(self, stage, rows_in=None, rows_out=None):
+        now = time.perf_counter()
+        record = {'stage': stage, 'seconds': round(now - self._last, 6)}
+        if rows_in is not None:
+            record['rows_in'] = int(rows_in)
+        if rows_out is not None:
+            record['rows_out'] = int(rows_out)
+        if self.trace_memory and tracemalloc.is_tracing():
+            record['peak_memory_mib'] = round(tracemalloc.get_traced_memory()[1] / (1024 * 1024), 2)
+            tracemalloc.reset_peak()
+        self.stages.append(record)
+        if self.route:
+            stage_metrics.observe_stage(self.route, stage, now - self._last, rows_in, rows_out)
+        self._last = now
+
+    def stage_seconds(self):
+        """``{stage: seconds}`` of the stages so far (for log records)."""
+        seconds = Counter()
+        for record in self.stages:
+            seconds[record['stage']] += record['seconds']
+        return {stage: round(value, 4) for stage, value in seconds.items()}
+
+    def finish(self, status='ok'):
+        """Close the timer (once), record the request and return the ``timings`` block."""
+        if self._finished is None:
+            total = time.perf_counter() - self.started
+            if self.trace_memory:
+                with StageTimer._tracing_lock:
+                    StageTimer._tracing_users -= 1
+                    if StageTimer._tracing_users == 0 and StageTimer._tracing_owned:
+                        tracemalloc.stop()
+                        StageTimer._tracing_owned = False
+            if self.route:
+                stage_metrics.observe_request(self.route, total, status, self.counters)
+            self._finished = {'total_seconds': round(total, 6), 'stages': self.stages, 'counters': dict(self.counters)}
+            if self.trace_memory:
+                peaks = [record.get('peak_memory_mib', 0) for record in self.stages]
+                self._finished['peak_memory_mib'] = max(peaks, default=0)
+        return self._finished
+
+    def server_timing(self):
+        """Stages as a ``Server-Timing`` header value (durations in ms)."""
+        return ', '.join(f"{record['stage']};dur={record['seconds'] * 1000:.1f}" for record in self.stages)
+
+PROFILE_ID_PATTERN = re.compile(r'^(compare|export)-[0-9a-f]{32}$')
+PROFILE_SORT_KEYS = ('cumulative', 'tottime', 'calls', 'ncalls')
+
+class ProfileStore:
+    """cProfile captures of single requests, kept as ``.pstats`` files.
+
+    Each capture is ``<profile_id>.pstats`` plus a ``<profile_id>.json``
+    with its metadata (route, status, duration, request details). Only the
+    ``max_files`` most recent captures are kept.
+    """
+
+    def __init__(self, folder, max_files=20):
+        self.folder = folder
+        self.max_files = max_files
+        self._lock = threading.Lock()
+
+    def save(self, profile_id, profiler, meta):
+        """Write the profiler's stats and metadata, then drop the oldest captures."""
+        os.makedirs(self.folder, exist_ok=True)
+        stats_path = self.path(profile_id)
+        tmp_path = f'{stats_path}.{os.getpid()}.tmp'
+        profiler.dump_stats(tmp_path)
+        os.replace(tmp_path, stats_path)
+        meta = dict(meta, profile_id=profile_id, bytes=os.path.getsize(stats_path))
+        with open(self._meta_path(profile_id), 'w', encoding='utf-8') as f:
+            json.dump(meta, f, ensure_ascii=False)
+        self._enforce_retention()
+
+    def list(self):
+        """Metadata of the stored captures, newest first."""
+        profiles = []
+        for profile_id in self._ids():
+            try:
+                with open(self._meta_path(profile_id), encoding='utf-8') as f:
+                    profiles.append(json.load(f))
+            except (OSError, ValueError):
+                continue
+        profiles.sort(key=lambda meta: meta.get('created_at', ''), reverse=True)
+        return profiles
+
+    def path(self, profile_id):
+        """Path of a capture's ``.pstats`` file, or None for an invalid ID."""
+        if not profile_id or not PROFILE_ID_PATTERN.match(str(profile_id)):
+            return None
+        return os.path.join(self.folder, f'{profile_id}.pstats')
+
+    def _meta_path(self, profile_id):
+        return os.path.join(self.folder, f'{profile_id}.json')
+
+    def _ids(self):
+        try:
+            names = os.listdir(self.folder)
+        except OSError:
+            return []
+        return [name[:-len('.pstats')] for name in names if name.endswith('.pstats')]
+
+    def _enforce_retention(self):
+        with self._lock:
+            captures = []
+            for profile_id in self._ids():
+                try:
+                    captures.append((os.path.getmtime(self.path(profile_id)), profile_id))
+                except OSError:
+                    pass
+            captures.sort(reverse=True)
+            for _, profile_id in captures[max(self.max_files, 1):]:
+                for path in (self.path(profile_id), self._meta_path(profile_id)):
+                    try:
+                        os.remove(path)
+                    except OSError:
+                        pass
+
+profile_store = ProfileStore(app.config['PROFILE_FOLDER'], max_files=app.config['PROFILE_MAX_FILES'])
+
+class RequestProfile:
+    """One request run under cProfile, saved to ``profile_store`` when done.
+
+    The profile ID is known up front (it goes in the 202 of an async
+    /compare or in the headers of an export). cProfile only sees the thread
+    that enables it, so ``enable``/``disable`` wrap the work wherever it
+    runs: the job thread, the view, or a streamed response body. If another
+    profiler is already active (Python 3.12+ allows only one per process) the
+    request runs unprofiled and ``error`` says why.
+    """
+
+    def __init__(self, route, **details):
+        self.profile_id = f'{route}-{uuid.uuid4().hex}'
+        self.route = route
+        self.details = details
+        self.profiler = cProfile.Profile()
+        self.error = None
+        self.seconds = 0.0
+        self._enabled_at = None
+        self._saved = False
+
+    def enable(self):
+        try:
+            self.profiler.enable()
+        except ValueError as e:
+            self.error = str(e)
+            return
+        self._enabled_at = time.perf_counter()
+
+    def disable(self):
+        if self._enabled_at is not None:
+            self.profiler.disable()
+            self.seconds += time.perf_counter() - self._enabled_at
+            self._enabled_at = None
+
+    def save(self, status='ok', **details):
+        """Stop profiling and store the capture (once); returns the ``profile`` response block."""
+        self.disable()
+        if not self._saved and self.error is None:
+            self._saved = True
+            self.details.update(details)
+            meta = {
+                'route': self.route,
+                'created_at': datetime.now().isoformat(timespec='seconds'),
+                'status': status,
+                'profiled_seconds': round(self.seconds, 6),
+                **self.details,
+            }
+            try:
+                profile_store.save(self.profile_id, self.profiler, meta)
+                log_matching.info("profile saved %s route=%s seconds=%.3f", self.profile_id, self.route, self.seconds)
+            except OSError as e:
+                self.error = f'Falha ao gravar o perfil: {e}'
+        return self.info()
+
+    def info(self):
+        if self.error is not None:
+            return {'profile_id': None, 'error': self.error}
+        return {'profile_id': self.profile_id}
+
+def admin_authorized():
+    """True when the request's X-Admin-Token matches ADMIN_TOKEN (never when no token is configured)."""
+    token = app.config['ADMIN_TOKEN']
+    supplied = request.headers.get('X-Admin-Token', '')
+    return bool(token) and hmac.compare_digest(str(supplied).encode(), str(token).encode())
+
+def profile_requested(data):
+    """Profiling flag from the X-Profile header, the ``profile`` query arg or the JSON body."""
+    flag = request.headers.get('X-Profile') or request.args.get('profile') or data.get('profile')
+    return request_flag(flag)
+
+DATASET_ID_PATTERN = re.compile(r'^[0-9a-f]{32}$')
+
+def create_workspace():
+    """Create an isolated upload workspace and return (dataset_id, path)."""
+    dataset_id = uuid.uuid4().hex
+    path = os.path.join(app.config['WORKSPACE_FOLDER'], dataset_id)
+    os.makedirs(path)
+    return dataset_id, path
+
+def get_workspace(dataset_id):
+    """Return the workspace path for a dataset ID, or None if it is invalid or expired."""
+    if not dataset_id or not DATASET_ID_PATTERN.match(str(dataset_id)):
+        return None
+    path = os.path.join(app.config['WORKSPACE_FOLDER'], str(dataset_id))
+    if not os.path.isdir(path):
+        return None
+    try:
+        os.utime(path)  # uso renova o TTL
+    except OSError:
+        pass
+    return path
+
+def find_workspace_file(workspace, base_name):
+    """Locate file1/file2 inside a workspace, returning (path, ext)."""
+    for ext in ['.xlsx', '.xls', '.csv']:
+        path = os.path.join(workspace, f'{base_name}{ext}')
+        if os.path.exists(path):
+            return path, ext
+    return None, None
+
+def cleanup_expired_workspaces():
+    """Remove workspaces not used for longer than WORKSPACE_TTL_SECONDS."""
+    root = app.config['WORKSPACE_FOLDER']
+    limit = time.time() - app.config['WORKSPACE_TTL_SECONDS']
+    try:
+        names = os.listdir(root)
+    except OSError:
+        return
+    for name in names:
+        path = os.path.join(root, name)
+        try:
+            if DATASET_ID_PATTERN.match(name) and os.path.getmtime(path) < limit:
+                shutil.rmtree(path, ignore_errors=True)
+        except OSError:
+            pass
+
+def file_sha256(path, chunk_size=1024 * 1024):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(chunk_size), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+class DatasetCache:
+    """Parsed spreadsheets keyed by the SHA-256 of the uploaded bytes.
+
+    Recently used workbooks are kept in memory (LRU bounded by entry count and
+    approximate DataFrame size) and every parsed workbook is also pickled to
+    local disk, so later requests and other worker processes skip the Excel
+    parse. Cached DataFrames are shared: callers must copy before mutating.
+    """
+
+    def __init__(self, folder, max_entries=8, max_bytes=256 * 1024 * 1024, max_disk_bytes=1024 * 1024 * 1024):
+        self.folder = folder
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.max_disk_bytes = max_disk_bytes
+        self._entries = OrderedDict()  # key -> (sheets, size)
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def get_sheets(self, path, ext):
+        """Return {sheet_name: DataFrame} for an uploaded file, parsing it at most once."""
+        key = f"{file_sha256(path)}{ext}"
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                return dict(entry[0])
+
+        sheets = self._load_from_disk(key)
+        if sheets is None:
+            if ext in ['.xlsx', '.xls']:
+                sheets = pd.read_excel(path, sheet_name=None)
+            else:
+                sheets = {'CSV': pd.read_csv(path)}
+            self._save_to_disk(key, sheets)
+
+        size = sum(int(df.memory_usage(deep=True).sum()) for df in sheets.values())
+        with self._lock:
+            if key not in self._entries:
+                self._entries[key] = (sheets, size)
+                self._bytes += size
+            while self._entries and (len(self._entries) > self.max_entries or self._bytes > self.max_bytes):
+                _, (_, old_size) = self._entries.popitem(last=False)
+                self._bytes -= old_size
+        return dict(sheets)
+
+    def get_first_sheet(self, path, ext):
+        """First sheet only, as pd.read_excel/pd.read_csv would return without sheet_name."""
+        return next(iter(self.get_sheets(path, ext).values()))
+
+    def _disk_path(self, key):
+        return os.path.join(self.folder, f'{key}.pkl')
+
+    def _load_from_disk(self, key):
+        path = self._disk_path(key)
+        try:
+            with open(path, 'rb') as f:
+                sheets = pickle.load(f)
+            os.utime(path)  # marca como usado recentemente para a limpeza por tamanho
+            return sheets
+        except (OSError, pickle.UnpicklingError, EOFError):
+            return None
+
+    def _save_to_disk(self, key, sheets):
+        try:
+            os.makedirs(self.folder, exist_ok=True)
+            tmp_path = f'{self._disk_path(key)}.{os.getpid()}.tmp'
+            with open(tmp_path, 'wb') as f:
+                pickle.dump(sheets, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_path, self._disk_path(key))
+            self._evict_disk()
+        except OSError:
+            pass
+
+    def _evict_disk(self):
+        files = []
+        for name in os.listdir(self.folder):
+            if name.endswith('.pkl'):
+                path = os.path.join(self.folder, name)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                files.append((st.st_mtime, st.st_size, path))
+        total = sum(size for _, size, _ in files)
+        for _, size, path in sorted(files):
+            if total <= self.max_disk_bytes:
+                break
+            try:
+                os.remove(path)
+                total -= size
+            except OSError:
+                pass
+
+dataset_cache = DatasetCache(
+    app.config['DATASET_CACHE_FOLDER'],
+    max_entries=app.config['DATASET_CACHE_MAX_ENTRIES'],
+    max_bytes=app.config['DATASET_CACHE_MAX_BYTES'],
+    max_disk_bytes=app.config['DATASET_CACHE_MAX_DISK_BYTES'],
+)
+
+def _preview_columns(header, width):
+    # Mesmos nomes de coluna do pandas: vazias viram 'Unnamed: i' e repetidas ganham sufixo '.1', '.2', ...
+    header = list(header) + [None] * (width - len(header))
+    columns = []
+    seen = Counter()
+    for i, value in enumerate(header):
+        name = f'Unnamed: {i}' if value is None or value == '' else value
+        while name in seen:
+            seen[name] += 1
+            name = f'{name}.{seen[name] - 1}'
+        seen[name] += 1
+        columns.append(name)
+    return columns
+
+def _trim_row(values):
+    # Remove as células vazias do fim da linha, como o leitor de Excel do pandas
+    values = list(values)
+    while values and (values[-1] is None or values[-1] == ''):
+        values.pop()
+    return values
+
+def _preview_sheet(name, rows_iter, declared_rows, sample_rows):
+    """Header, sample and row count of one sheet from an iterator of row values.
+
+    Only the header and ``sample_rows`` rows are read when ``declared_rows``
+    (the sheet's declared row count, header included) is known; otherwise the
+    remaining rows are scanned without being kept, ignoring trailing empty rows.
+    """
+    header = None
+    sample = []
+    last_nonempty = 0  # linhas até a última não vazia, cabeçalho incluído
+    count = 0
+    for values in rows_iter:
+        count += 1
+        values = _trim_row(values)
+        if values:
+            last_nonempty = count
+        if header is None:
+            header = values
+        elif len(sample) < sample_rows:
+            sample.append(values)
+        elif declared_rows is not None:
+            break
+    if header is None:
+        return {'name': name, 'rows': 0, 'columns': [], 'sample': []}
+    width = max([len(header)] + [len(row) for row in sample])
+    columns = _preview_columns(header, width)
+    total = declared_rows if declared_rows is not None else last_nonempty
+    return {
+        'name': name,
+        'rows': max(total - 1, 0),
+        'columns': columns,
+        'sample': [dict(zip(map(str, columns), row + [None] * (width - len(row)))) for row in sample],
+    }
+
+def read_sheet_preview(path, ext, sample_rows=0):
+    """Sheet names, header columns and row counts of an uploaded file, without building DataFrames.
+
+    Returns a list with one ``{name, rows, columns, sample}`` dict per sheet
+    (a single ``CSV`` entry for CSV files). Excel row counts come from the
+    sheet's declared dimension when present (Excel always writes it, so it may
+    include trailing formatted rows); the full parse is left to /compare.
+    """
+    if ext == '.xlsx':
+        workbook = load_workbook(path, read_only=True, data_only=True)
+        try:
+            sheets = []
+            for ws in workbook.worksheets:
+                declared = ws.max_row if ws.max_row else None
+                sheets.append(_preview_sheet(ws.title, ws.iter_rows(values_only=True), declared, sample_rows))
+            return sheets
+        finally:
+            workbook.close()
+    if ext == '.xls':
+        book = xlrd.open_workbook(path, on_demand=True)
+        try:
+            sheets = []
+            for index, name in enumerate(book.sheet_names()):
+                sheet = book.sheet_by_index(index)
+                rows_iter = (sheet.row_values(i) for i in range(sheet.nrows))
+                sheets.append(_preview_sheet(name, rows_iter, sheet.nrows, sample_rows))
+                book.unload_sheet(index)
+            return sheets
+        finally:
+            book.release_resources()
+    # CSV: cabeçalho/amostra pelo próprio pandas (mesmos nomes de coluna) e linhas contadas sem parse
+    head = pd.read_csv(path, nrows=sample_rows)
+    with open(path, newline='', encoding='utf-8', errors='replace') as f:
+        rows = max(sum(1 for row in csv.reader(f) if row) - 1, 0)
+    sample = head.astype(object).where(head.notna(), None).rename(columns=str).to_dict('records')
+    return [{'name': 'CSV', 'rows': rows, 'columns': list(head.columns), 'sample': sample}]
+
+RESULT_ID_PATTERN = DATASET_ID_PATTERN  # mesmo formato (uuid4 hex)
+
+class ResultStore:
+    """Comparison results kept server-side under a result ID.
+
+    Each result set is pickled to local disk (so any worker process can
+    serve the export) and the most recent ones are also kept in an in-memory
+    LRU. Files unused for longer than ``ttl_seconds`` are removed. Stored
+    records are shared: callers must not mutate them.
+    """
+
+    def __init__(self, folder, max_entries=16, ttl_seconds=6 * 60 * 60):
+        self.folder = folder
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def put(self, record):
+        """Store a result record and return its new result ID."""
+        result_id = uuid.uuid4().hex
+        self._remember(result_id, record)
+        try:
+            os.makedirs(self.folder, exist_ok=True)
+            tmp_path = f'{self._disk_path(result_id)}.{os.getpid()}.tmp'
+            with open(tmp_path, 'wb') as f:
+                pickle.dump(record, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_path, self._disk_path(result_id))
+        except OSError:
+            pass
+        self._cleanup_expired()
+        return result_id
+
+    def get(self, result_id):
+        """Return the stored record, or None if the ID is invalid, unknown or expired."""
+        if not result_id or not RESULT_ID_PATTERN.match(str(result_id)):
+            return None
+        path = self._disk_path(result_id)
+        with self._lock:
+            record = self._entries.get(result_id)
+            if record is not None:
+                self._entries.move_to_end(result_id)
+        if record is None:
+            try:
+                with open(path, 'rb') as f:
+                    record = pickle.load(f)
+            except (OSError, pickle.UnpicklingError, EOFError):
+                return None
+            self._remember(result_id, record)
+        try:
+            os.utime(path)  # uso renova o TTL
+        except OSError:
+            pass
+        return record
+
+    def _remember(self, result_id, record):
+        with self._lock:
+            self._entries[result_id] = record
+            self._entries.move_to_end(result_id)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def _disk_path(self, result_id):
+        return os.path.join(self.folder, f'{result_id}.pkl')
+
+    def _cleanup_expired(self):
+        limit = time.time() - self.ttl_seconds
+        try:
+            names = os.listdir(self.folder)
+        except OSError:
+            return
+        for name in names:
+            path = os.path.join(self.folder, name)
+            try:
+                if name.endswith('.pkl') and os.path.getmtime(path) < limit:
+                    os.remove(path)
+                    with self._lock:
+                        self._entries.pop(name[:-len('.pkl')], None)
+            except OSError:
+                pass
+
+result_store = ResultStore(
+    app.config['RESULT_STORE_FOLDER'],
+    max_entries=app.config['RESULT_STORE_MAX_ENTRIES'],
+    ttl_seconds=app.config['RESULT_TTL_SECONDS'],
+)
+
+class InMemoryJobStore:
+    """Background job records kept in this process's memory.
+
+    This is the default job store backend. Any object exposing the same
+    ``create``/``update``/``get`` methods can be assigned to ``job_store``
+    (e.g. one backed by Redis or a database so several WSGI workers share
+    jobs); with this backend, polling must reach the process that accepted
+    the job. Finished jobs are dropped after ``ttl_seconds``.
+    """
+
+    def __init__(self, ttl_seconds=3600):
+        self.ttl_seconds = ttl_seconds
+        self._jobs = {}
+        self._lock = threading.Lock()
+
+    def create(self):
+        """Register a new queued job and return its ID."""
+        job_id = uuid.uuid4().hex
+        now = time.time()
+        with self._lock:
+            self._purge(now)
+            self._jobs[job_id] = {
+                'status': 'queued',
+                'created_at': now,
+                'started_at': None,
+                'progress_started_at': None,
+                'finished_at': None,
+                'processed': 0,
+                'total': None,
+                'result': None,
+                'error': None,
+            }
+        return job_id
+
+    def update(self, job_id, **fields):
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is not None:
+                job.update(fields)
+
+    def get(self, job_id):
+        """Return a snapshot of the job record, or None if unknown/expired."""
+        with self._lock:
+            job = self._jobs.get(job_id)
+            return dict(job) if job is not None else None
+
+    def _purge(self, now):
+        limit = now - self.ttl_seconds
+        expired = [
+            job_id for job_id, job in self._jobs.items()
+            if job['finished_at'] is not None and job['finished_at'] < limit
+        ]
+        for job_id in expired:
+            del self._jobs[job_id]
+
+job_store = InMemoryJobStore(ttl_seconds=app.config['JOB_TTL_SECONDS'])
+job_executor = ThreadPoolExecutor(max_workers=app.config['JOB_WORKERS'], thread_name_prefix='compare-job')
+# Vagas de jobs (fila + execução): limita a memória presa em resultados pendentes
+_job_slots = threading.BoundedSemaphore(app.config['JOB_MAX_PENDING'])
+
+def submit_job(func, data):
+    """Queue ``func(data, progress=...)`` on the job executor.
+
+    Returns the job ID, or None when JOB_MAX_PENDING jobs are already queued
+    or running.
+    """
+    if not _job_slots.acquire(blocking=False):
+        return None
+    try:
+        job_id = job_store.create()
+        job_executor.submit(_run_job, job_id, func, data)
+    except Exception:
+        _job_slots.release()
+        raise
+    return job_id
+
+def _run_job(job_id, func, data):
+    def progress(processed, total):
+        fields = {'processed': processed, 'total': total}
+        if processed == 0:
+            fields['progress_started_at'] = time.time()
+        job_store.update(job_id, **fields)
+
+    try:
+        job_store.update(job_id, status='running', started_at=time.time())
+        result = func(data, progress=progress)
+        if result.get('success'):
+            job_store.update(job_id, status='done', result=result, finished_at=time.time())
+        else:
+            job_store.update(job_id, status='error', error=result.get('error'), finished_at=time.time())
+    except Exception as e:
+        job_store.update(job_id, status='error', error=f'Erro na comparação: {str(e)}', finished_at=time.time())
+    finally:
+        _job_slots.release()
+
+def job_progress(job):
+    """Progress block for GET /jobs/<id>: processed/total names, percentage and ETA."""
+    processed = job['processed'] or 0
+    total = job['total']
+    if job['status'] == 'done':
+        percent = 100.0
+    elif total:
+        percent = round(processed / total * 100, 1)
+    else:
+        percent = 0.0
+    elapsed = None
+    if job['started_at'] is not None:
+        elapsed = round((job['finished_at'] or time.time()) - job['started_at'], 2)
+    # ETA pela taxa observada desde o início da pontuação (leitura das planilhas não entra na taxa)
+    eta = None
+    if job['status'] == 'running' and total and processed and job['progress_started_at'] is not None:
+        rate = processed / max(time.time() - job['progress_started_at'], 1e-6)
+        eta = round((total - processed) / rate, 1)
+    elif job['status'] == 'done':
+        eta = 0.0
+    return {
+        'processed': processed,
+        'total': total,
+        'percent': percent,
+        'elapsed_seconds': elapsed,
+        'eta_seconds': eta,
+    }
+
+class PreparedName:
+    """Pre-parsed name record reused across many comparisons.
+
+    Holds everything compare_names derives from one side of a pair
+    (normalized text, compact text, token set, first/last name and the
+    full-name variants) so it is computed once per name instead of once per pair.
+    """
+    __slots__ = ('raw', 'normalized', 'compact', 'tokens', 'firstname', 'lastname', 'variants')
+
+    def __init__(self, raw, normalized, compact, tokens, firstname, lastname, variants):
+        self.raw = raw
+        self.normalized = normalized
+        self.compact = compact
+        self.tokens = tokens
+        self.firstname = firstname
+        self.lastname = lastname
+        self.variants = variants
+
+# Normalização de nomes. Acentos: a decomposição NFD separa letra e diacrítico (NFD e não NFKD,
+# para preservar 'º'/'ª' usados na detecção de turma) e os diacríticos combinantes, que não são \w,
+# caem no mesmo padrão que remove a pontuação (exceto vírgulas, importantes para o formato TOEFL)
+_NAME_PUNCTUATION_RE = re.compile(r'[^\w\s,]')
+NORMALIZE_CACHE_SIZE = 65536
+
+@lru_cache(maxsize=NORMALIZE_CACHE_SIZE)
+def _normalize_name_cached(name):
+    # Remove extra spaces and convert to lowercase
+    name = ' '.join(name.split()).lower()
+    if not name.isascii():
+        name = unicodedata.normalize('NFD', name)
+    return _NAME_PUNCTUATION_RE.sub('', name)
+
 class NameComparator:
     def __init__(self):
         # Brazilian Portuguese specific configurations
@@ -30,33 +995,11 @@ class NameComparator:
         
     def normalize_name(self, name):
         """Normalize name for better comparison"""
+        if isinstance(name, str):
+            return _normalize_name_cached(name)
         if pd.isna(name):
             return ""
-        
-        # Convert to string and normalize
-        name = str(name).strip()
-        
-        # Remove extra spaces and convert to lowercase
-        name = ' '.join(name.split()).lower()
-        
-        # Remove accents - simple replacement for common Portuguese accents
-        replacements = {
-            'á': 'a', 'à': 'a', 'ã': 'a', 'â': 'a',
-            'é': 'e', 'ê': 'e',
-            'í': 'i',
-            'ó': 'o', 'ô': 'o', 'õ': 'o',
-            'ú': 'u', 'ü': 'u',
-            'ç': 'c'
-        }
-        
-        for old, new in replacements.items():
-            name = name.replace(old, new)
-        
-        # Remove punctuation except commas (important for TOEFL format)
-        import re
-        name = re.sub(r'[^\w\s,]', '', name)
-
-        return name
+        return _normalize_name_cached(str(name))
 
     def parse_toefl_name(self, toefl_name):
         """Parse TOEFL format name (LASTNAME, FIRSTNAME [MIDDLE])"""
@@ -112,40 +1055,156 @@ class NameComparator:
             'parts': parts
         }
 
-    def compare_names(self, toefl_name, base_name, algorithm='token_sort_ratio'):
-        """Compare TOEFL format name with base name and return score 0-100 (weighted average)."""
-        toefl_parsed = self.parse_toefl_name(toefl_name)
-        base_parsed = self.parse_base_name(base_name)
+    def prepare_toefl(self, toefl_name):
+        """Build a PreparedName for a TOEFL format name (LASTNAME, FIRSTNAME [MIDDLE])"""
+        normalized = self.normalize_name(toefl_name)
+        parsed = self.parse_toefl_name(toefl_name)
+        firstname = parsed['firstname']
+        lastname = parsed['lastname']
+
+        # Full name variants compared against the base full name (empty and repeated ones dropped)
+        variants = []
+        for variant in (
+            parsed['full_name_normal'],
+            parsed['full_name_reverse'],
+            f"{firstname} {lastname}",
+            f"{lastname} {firstname}",
+        ):
+            if variant and variant not in variants:
+                variants.append(variant)
+
+        return PreparedName(
+            raw=toefl_name,
+            normalized=normalized,
+            compact=re.sub(r"\s+", "", normalized),
+            tokens=frozenset(normalized.split()),
+            firstname=firstname,
+            lastname=lastname,
+            variants=tuple(variants),
+        )
+
+    def prepare_base(self, base_name):
+        """Build a PreparedName for a base name (full name format)"""
+        parsed = self.parse_base_name(base_name)
+        full_name = parsed['full_name']
+        return PreparedName(
+            raw=base_name,
+            normalized=full_name,
+            compact=re.sub(r"\s+", "", full_name),
+            tokens=frozenset(parsed['parts']),
+            firstname=parsed['firstname'],
+            lastname=parsed['lastname'],
+            variants=(full_name,),
+        )
+
+    def compare_names(self, toefl_name, base_name, algorithm='token_sort_ratio', score_cutoff=None):
+        """Compare TOEFL format name with base name and return score 0-100 (weighted average).
+
+        With score_cutoff, pairs that cannot reach it return 0 (like rapidfuzz);
+        scores at or above the cutoff are returned exactly.
+        """
+        return self.compare_prepared(
+            self.prepare_toefl(toefl_name), self.prepare_base(base_name), algorithm, score_cutoff
+        )
+
+    def compare_prepared(self, toefl, base, algorithm='token_sort_ratio', score_cutoff=None):
+        """Same score as compare_names, for records built by prepare_toefl/prepare_base.
+
+        Cheap components are computed first and the running maximum is passed
+        down to rapidfuzz as score_cutoff, so components that cannot raise the
+        final score are skipped or cut short.
+        """
+        cutoff = score_cutoff or 0
+
+        # Nomes normalizados idênticos: compact_score é 100 e não há penalidade
+        if toefl.normalized and toefl.normalized == base.normalized:
+            return 100.0 if cutoff <= 100 else 0
+
+        # Space-insensitive comparison to handle concatenated names (e.g., "oliveiraclimenia")
+        compact_score = self._calculate_similarity(toefl.compact, base.compact, 'ratio') if base.compact else 0
+
+        # Reforço baseado em tokens para lidar com casos de apenas um nome coincidente
+        toefl_tokens = toefl.tokens
+        base_tokens = base.tokens
+        overlap = toefl_tokens.intersection(base_tokens)
+        jaccard_score = (len(overlap) / max(1, len(base_tokens))) * 100
+
+        # Penalizar correspondências de um único token quando o nome TOEFL tem 2+ tokens
+        # Mas evitar penalidade quando a comparação sem espaços indicar alta similaridade
+        compact_match_high = compact_score >= 90
+        penalized = len(toefl_tokens) >= 2 and len(overlap) < 2 and not compact_match_high
+        cap = 75 if penalized else 100
+        if cap < cutoff:
+            return 0
+
+        def finish(score):
+            if penalized:
+                score = min(score, 75)
+            return score if score >= cutoff else 0
+
+        def rapidfuzz_cutoff(value):
+            # rapidfuzz pode descartar um score exatamente igual ao cutoff (arredondamento interno)
+            return max(0, value - 1e-6)
+
+        running = max(jaccard_score, compact_score)
+        if running >= cap:
+            return finish(running)
+
+        # Token maxima only matter when they beat the running maximum
+        max_first_token_score = 0
+        max_last_token_score = 0
+        base_first = base.firstname
+        base_last = base.lastname
+        if base_first:
+            for tok in toefl_tokens:
+                s = self._calculate_similarity(base_first, tok, algorithm, rapidfuzz_cutoff(max(running, cutoff)))
+                if s > max_first_token_score:
+                    max_first_token_score = s
+                    running = max(running, s)
+        if base_last:
+            for tok in toefl_tokens:
+                s = self._calculate_similarity(base_last, tok, algorithm, rapidfuzz_cutoff(max(running, cutoff)))
+                if s > max_last_token_score:
+                    max_last_token_score = s
+                    running = max(running, s)
+        if running >= cap:
+            return finish(running)
 
         # Raw component scores
         firstname_score = None
         lastname_score = None
-        full_name_scores = []
 
         # First/last name components
-        if toefl_parsed['firstname'] and base_parsed['firstname']:
+        if toefl.firstname and base.firstname:
             firstname_score = self._calculate_similarity(
-                toefl_parsed['firstname'], base_parsed['firstname'], algorithm
+                toefl.firstname, base.firstname, algorithm
             )
 
-        if toefl_parsed['lastname'] and base_parsed['lastname']:
+        if toefl.lastname and base.lastname:
             lastname_score = self._calculate_similarity(
-                toefl_parsed['lastname'], base_parsed['lastname'], algorithm
+                toefl.lastname, base.lastname, algorithm
             )
 
-        # Full name variants
-        comparisons = [
-            (toefl_parsed['full_name_normal'], base_parsed['full_name']),
-            (toefl_parsed['full_name_reverse'], base_parsed['full_name']),
-            (f"{toefl_parsed['firstname']} {toefl_parsed['lastname']}", base_parsed['full_name']),
-            (f"{toefl_parsed['lastname']} {toefl_parsed['firstname']}", base_parsed['full_name']),
-        ]
-
-        for toefl_variant, base_full in comparisons:
-            if toefl_variant and base_full:
-                full_name_scores.append(
-                    self._calculate_similarity(toefl_variant, base_full, algorithm)
-                )
+        # Full name variants: first with the running maximum as cutoff; recomputed exactly only
+        # when all fall below it and the weighted average could still beat it
+        full_cutoff = max(running, cutoff)
+        full_name_scores = []
+        if base.normalized:
+            full_name_scores = [
+                self._calculate_similarity(toefl_variant, base.normalized, algorithm, rapidfuzz_cutoff(full_cutoff))
+                for toefl_variant in toefl.variants
+            ]
+            if full_name_scores and max(full_name_scores) < full_cutoff:
+                weights = [0.4 if firstname_score is not None else 0, 0.4 if lastname_score is not None else 0, 0.2]
+                bound = (
+                    (firstname_score or 0) * 0.4 + (lastname_score or 0) * 0.4 + full_cutoff * 0.2
+                ) / sum(weights)
+                if bound < full_cutoff - 1e-6:
+                    return finish(running)
+                full_name_scores = [
+                    self._calculate_similarity(toefl_variant, base.normalized, algorithm)
+                    for toefl_variant in toefl.variants
+                ]
 
         max_full = max(full_name_scores) if full_name_scores else None
 
@@ -169,33 +1228,6 @@ class NameComparator:
         else:
             weighted_avg = 0
 
-        # Space-insensitive comparison to handle concatenated names (e.g., "oliveiraclimenia")
-        import re
-        compact_toefl = re.sub(r"\s+", "", self.normalize_name(toefl_name))
-        compact_base = re.sub(r"\s+", "", base_parsed.get('full_name', ''))
-        compact_score = self._calculate_similarity(compact_toefl, compact_base, 'ratio') if compact_base else 0
-
-        # Reforço baseado em tokens para lidar com casos de apenas um nome coincidente
-        toefl_tokens = set(self.normalize_name(toefl_name).split())
-        base_tokens = set(base_parsed.get('parts', []))
-        overlap = toefl_tokens.intersection(base_tokens)
-        jaccard_score = (len(overlap) / max(1, len(base_tokens))) * 100
-
-        max_first_token_score = 0
-        max_last_token_score = 0
-        base_first = base_parsed.get('firstname', '')
-        base_last = base_parsed.get('lastname', '')
-        if base_first:
-            for tok in toefl_tokens:
-                s = self._calculate_similarity(base_first, tok, algorithm)
-                if s > max_first_token_score:
-                    max_first_token_score = s
-        if base_last:
-            for tok in toefl_tokens:
-                s = self._calculate_similarity(base_last, tok, algorithm)
-                if s > max_last_token_score:
-                    max_last_token_score = s
-
         final_score = max(
             weighted_avg,
             max_full if max_full is not None else 0,
@@ -204,28 +1236,526 @@ class NameComparator:
             max_last_token_score,
             compact_score,
         )
-        # Penalizar correspondências de um único token quando o nome TOEFL tem 2+ tokens
-        # Mas evitar penalidade quando a comparação sem espaços indicar alta similaridade
-        compact_match_high = compact_score >= 90
-        if len(toefl_tokens) >= 2 and len(overlap) < 2 and not compact_match_high:
-            final_score = min(final_score, 75)
-        return final_score
+        return finish(final_score)
     
-    def _calculate_similarity(self, str1, str2, algorithm='token_sort_ratio'):
-        """Calculate similarity between two strings"""
+    def _calculate_similarity(self, str1, str2, algorithm='token_sort_ratio', score_cutoff=None):
+        """Calculate similarity between two strings (0 when below score_cutoff)"""
         if not str1 or not str2:
             return 0
         
         if algorithm == 'ratio':
-            return fuzz.ratio(str1, str2)
+            return fuzz.ratio(str1, str2, score_cutoff=score_cutoff)
         elif algorithm == 'partial_ratio':
-            return fuzz.partial_ratio(str1, str2)
+            return fuzz.partial_ratio(str1, str2, score_cutoff=score_cutoff)
         elif algorithm == 'token_sort_ratio':
-            return fuzz.token_sort_ratio(str1, str2)
+            return fuzz.token_sort_ratio(str1, str2, score_cutoff=score_cutoff)
         elif algorithm == 'token_set_ratio':
-            return fuzz.token_set_ratio(str1, str2)
+            return fuzz.token_set_ratio(str1, str2, score_cutoff=score_cutoff)
         else:
-            return fuzz.token_sort_ratio(str1, str2)
+            return fuzz.token_sort_ratio(str1, str2, score_cutoff=score_cutoff)
+
+    def get_scorer(self, algorithm='token_sort_ratio'):
+        """Return the rapidfuzz scorer _calculate_similarity uses for an algorithm"""
+        return {
+            'ratio': fuzz.ratio,
+            'partial_ratio': fuzz.partial_ratio,
+            'token_sort_ratio': fuzz.token_sort_ratio,
+            'token_set_ratio': fuzz.token_set_ratio,
+        }.get(algorithm, fuzz.token_sort_ratio)
+
+
+def _top_k_indices(scores, k):
+    """Positions of the k highest scores, best first, ties broken by lower position.
+
+    Uses a partial selection (O(n)) instead of sorting the whole row.
+    """
+    n = len(scores)
+    if k <= 0 or n == 0:
+        return np.empty(0, dtype=np.intp)
+    if k >= n:
+        return np.argsort(-scores, kind='stable')
+    kth = np.partition(scores, n - k)[n - k]
+    above = np.flatnonzero(scores > kth)
+    ties = np.flatnonzero(scores == kth)[:k - len(above)]
+    selected = np.concatenate([above, ties])
+    return selected[np.argsort(-scores[selected], kind='stable')]
+
+
+class NameMatrixScorer:
+    """Vectorized compare_prepared for whole blocks of TOEFL × base names.
+
+    Each score component (first/last name, full-name variants, compact ratio,
+    per-token first/last maxima and token overlap) is computed as a NumPy
+    matrix with rapidfuzz.process.cdist and combined with the same weights,
+    maxima and 75 cap as compare_prepared, so the result matches it exactly.
+    """
+
+    def __init__(self, comparator, base_records, algorithm='token_sort_ratio', workers=-1):
+        self.base = list(base_records)
+        self.comparator = comparator
+        self.algorithm = algorithm
+        self.scorer = comparator.get_scorer(algorithm)
+        self.workers = workers
+        # Trabalho do rapidfuzz (chamadas cdist, células das matrizes, pares pontuados um a um)
+        self.calls = Counter()
+
+        self._first = [b.firstname for b in self.base]
+        self._last = [b.lastname for b in self.base]
+        self._full = [b.normalized for b in self.base]
+        self._compact = [b.compact for b in self.base]
+        # Cópias em arrays de objetos para fatiar rapidamente pelos candidatos do blocking
+        self._first_arr = np.array(self._first, dtype=object)
+        self._last_arr = np.array(self._last, dtype=object)
+        self._full_arr = np.array(self._full, dtype=object)
+        self._compact_arr = np.array(self._compact, dtype=object)
+        self._has_first = np.array([bool(s) for s in self._first], dtype=bool)
+        self._has_last = np.array([bool(s) for s in self._last], dtype=bool)
+        self._has_full = np.array([bool(s) for s in self._full], dtype=bool)
+        self._has_compact = np.array([bool(s) for s in self._compact], dtype=bool)
+        self._token_count = np.array([len(b.tokens) for b in self.base], dtype=np.float64)
+
+        # Índice invertido token -> linhas da base, usado para contar tokens em comum
+        postings = {}
+        for j, b in enumerate(self.base):
+            for tok in b.tokens:
+                postings.setdefault(tok, []).append(j)
+        self._postings = {tok: np.array(idx, dtype=np.intp) for tok, idx in postings.items()}
+
+    def _cdist(self, queries, choices, scorer=None):
+        # Blocos pequenos (um nome contra seus candidatos) não compensam o custo de abrir threads
+        workers = self.workers if len(queries) * len(choices) >= 50000 else 1
+        self.calls['rapidfuzz_cdist_calls'] += 1
+        self.calls['rapidfuzz_cdist_cells'] += len(queries) * len(choices)
+        return process.cdist(
+            queries, choices,
+            scorer=scorer or self.scorer,
+            dtype=np.float64,
+            workers=workers,
+        )
+
+    def score(self, toefl_records, columns=None):
+        """Return a (len(toefl_records), len(base)) matrix of compare_prepared scores.
+
+        When columns (base row indices) is given, only those base rows are scored
+        and the matrix has one column per entry of columns.
+        """
+        toefl_records = list(toefl_records)
+        if columns is None:
+            b_first, b_last, b_full, b_compact = self._first, self._last, self._full, self._compact
+            b_has_first, b_has_last = self._has_first, self._has_last
+            b_has_full, b_has_compact = self._has_full, self._has_compact
+            b_token_count = self._token_count
+        else:
+            b_first = self._first_arr[columns].tolist()
+            b_last = self._last_arr[columns].tolist()
+            b_full = self._full_arr[columns].tolist()
+            b_compact = self._compact_arr[columns].tolist()
+            b_has_first, b_has_last = self._has_first[columns], self._has_last[columns]
+            b_has_full, b_has_compact = self._has_full[columns], self._has_compact[columns]
+            b_token_count = self._token_count[columns]
+        n, m = len(toefl_records), len(b_full)
+        if n == 0 or m == 0:
+            return np.zeros((n, m), dtype=np.float64)
+
+        # As matrizes são combinadas in-place (poucos temporários n×m) e as máscaras
+        # de componentes ausentes são aplicadas por linha/coluna; multiplicar por 1.0
+        # ou somar 0.0 não altera os valores, então o resultado é idêntico ao escalar.
+        def rows_mask(values):
+            return np.array([bool(v) for v in values], dtype=bool)
+
+        def zero_missing(matrix, row_mask, col_mask):
+            matrix[~row_mask, :] = 0.0
+            matrix[:, ~col_mask] = 0.0
+            return matrix
+
+        # First/last name components (weight 0.4 each)
+        t_first = [t.firstname for t in toefl_records]
+        t_last = [t.lastname for t in toefl_records]
+        t_has_first, t_has_last = rows_mask(t_first), rows_mask(t_last)
+        weighted = self._cdist(t_first, b_first)
+        weighted *= 0.4
+        zero_missing(weighted, t_has_first, b_has_first)
+        scratch = self._cdist(t_last, b_last)
+        scratch *= 0.4
+        weighted += zero_missing(scratch, t_has_last, b_has_last)
+
+        # Full name variants (até 4 por nome TOEFL); vale o máximo entre elas (weight 0.2)
+        t_has_full = np.array([bool(t.variants) for t in toefl_records], dtype=bool)
+        max_full = np.full((n, m), -np.inf)
+        for k in range(max(len(t.variants) for t in toefl_records)):
+            queries = [t.variants[k] if k < len(t.variants) else '' for t in toefl_records]
+            variant_scores = self._cdist(queries, b_full)
+            variant_scores[~rows_mask(queries), :] = -np.inf
+            np.maximum(max_full, variant_scores, out=max_full)
+            del variant_scores
+        zero_missing(max_full, t_has_full, b_has_full)
+        np.multiply(max_full, 0.2, out=scratch)
+        weighted += scratch
+
+        # Weighted average with dynamic weights based on available components
+        total_weight = np.outer(t_has_first, b_has_first) * 0.4
+        total_weight += np.outer(t_has_last, b_has_last) * 0.4
+        total_weight += np.outer(t_has_full, b_has_full) * 0.2
+        final = np.divide(weighted, total_weight, out=weighted, where=total_weight > 0)
+        del total_weight
+        np.maximum(final, max_full, out=final)
+        del max_full
+
+        # Space-insensitive comparison to handle concatenated names
+        t_compact = [t.compact for t in toefl_records]
+        compact_scores = zero_missing(
+            self._cdist(t_compact, b_compact, fuzz.ratio), rows_mask(t_compact), b_has_compact
+        )
+        np.maximum(final, compact_scores, out=final)
+
+        # Tokens em comum (via índice invertido) e Jaccard sobre os tokens da base
+        overlap = np.zeros((n, len(self.base)), dtype=np.float64)
+        for i, t in enumerate(toefl_records):
+            for tok in t.tokens:
+                rows = self._postings.get(tok)
+                if rows is not None:
+                    overlap[i, rows] += 1
+        if columns is not None:
+            overlap = overlap[:, columns]
+        np.divide(overlap, np.maximum(1.0, b_token_count)[None, :], out=scratch)
+        scratch *= 100
+        np.maximum(final, scratch, out=final)
+        del scratch
+
+        # Melhor similaridade de cada token TOEFL contra primeiro/último nome da base
+        with_tokens = [i for i, t in enumerate(toefl_records) if t.tokens]
+        if with_tokens:
+            flat_tokens = []
+            offsets = []
+            for i in with_tokens:
+                offsets.append(len(flat_tokens))
+                flat_tokens.extend(toefl_records[i].tokens)
+            for base_side, has_side in ((b_first, b_has_first), (b_last, b_has_last)):
+                token_scores = np.maximum.reduceat(self._cdist(flat_tokens, base_side), offsets, axis=0)
+                token_scores[:, ~has_side] = 0.0
+                if len(with_tokens) == n:
+                    np.maximum(final, token_scores, out=final)
+                else:
+                    final[with_tokens, :] = np.maximum(final[with_tokens, :], token_scores)
+                del token_scores
+
+        # Penalizar correspondências de um único token quando o nome TOEFL tem 2+ tokens,
+        # exceto quando a comparação sem espaços indicar alta similaridade
+        multi_token = np.array([len(t.tokens) >= 2 for t in toefl_records], dtype=bool)[:, None]
+        penalize = multi_token & (overlap < 2) & (compact_scores < 90)
+        np.minimum(final, 75, out=final, where=penalize)
+        return final
+
+    def score_rows(self, toefl_records, candidate_index=None, full_scan_fallback=True,
+                   top_k=3, pairwise_max_candidates=0):
+        """Score each TOEFL name and return one (columns, scores) pair per name.
+
+        Without a candidate_index every name is scored against the whole base
+        (columns is None). With one, each name is scored only against its
+        blocking candidates (sorted base row indices); names with no candidates
+        fall back to a full scan when full_scan_fallback is set, otherwise they
+        get an empty score array. Candidate sets of up to pairwise_max_candidates
+        rows are scored pair by pair with compare_prepared, using the running
+        top_k-th best score as cutoff: the top_k best scores are exact, the
+        others may be reported as 0.
+        """
+        toefl_records = list(toefl_records)
+        rows = [None] * len(toefl_records)
+        full_scan = []
+        for i, t in enumerate(toefl_records):
+            columns = candidate_index.candidates(t) if candidate_index is not None else None
+            if columns is None or (len(columns) == 0 and full_scan_fallback):
+                full_scan.append(i)
+            elif len(columns) <= pairwise_max_candidates:
+                rows[i] = (columns, self._score_pairwise(t, columns, top_k))
+            else:
+                rows[i] = (columns, self.score([t], columns)[0])
+        if full_scan:
+            matrix = self.score([toefl_records[i] for i in full_scan])
+            for r, i in enumerate(full_scan):
+                rows[i] = (None, matrix[r])
+        return rows
+
+    def score_top_k(self, toefl_records, top_k=3, **options):
+        """Like score_rows, but keep only each name's top_k candidates.
+
+        Returns one list of (base_row_index, score) per name, best first, with
+        ties kept in base order (the same order a stable sort would give).
+        """
+        top_rows = []
+        for columns, scores in self.score_rows(toefl_records, top_k=top_k, **options):
+            top = []
+            for k in _top_k_indices(scores, top_k):
+                j = int(k) if columns is None else int(columns[k])
+                top.append((j, float(scores[k])))
+            top_rows.append(top)
+        return top_rows
+
+    def _score_pairwise(self, toefl, columns, top_k):
+        # Poucos candidatos: compare_prepared com cutoff no k-ésimo melhor score até aqui
+        scores = np.zeros(len(columns), dtype=np.float64)
+        best = []
+        self.calls['rapidfuzz_pairwise_pairs'] += len(columns)
+        for pos, j in enumerate(columns):
+            cutoff = best[0] if len(best) >= top_k else None
+            s = self.comparator.compare_prepared(toefl, self.base[j], self.algorithm, cutoff)
+            scores[pos] = s
+            if len(best) < top_k:
+                heapq.heappush(best, s)
+            elif s > best[0]:
+                heapq.heapreplace(best, s)
+        return scores
+
+
+class CandidateIndex:
+    """Blocking index over prepared base names, used to prune candidates before fuzzy scoring.
+
+    Base rows are indexed by their normalized tokens, token prefixes and the
+    character n-grams of the compact (space-free) name. A TOEFL name's
+    candidates are the rows sharing a token or prefix with it, plus the rows
+    sharing at least min_ngram_share of its compact n-grams, which keeps
+    concatenated names such as "oliveiraclimenia" reachable.
+    """
+
+    def __init__(self, base_records, stopwords=(), prefix_len=3, ngram_size=3, min_ngram_share=0.6):
+        self.size = len(base_records)
+        self.stopwords = set(stopwords)
+        self.prefix_len = max(1, int(prefix_len))
+        self.ngram_size = max(1, int(ngram_size))
+        self.min_ngram_share = float(min_ngram_share)
+
+        keys = {}
+        grams = {}
+        for j, b in enumerate(base_records):
+            for key in self._token_keys(b.normalized):
+                keys.setdefault(key, []).append(j)
+            for gram in self._ngrams(b.compact):
+                grams.setdefault(gram, []).append(j)
+        self._keys = {k: np.array(v, dtype=np.intp) for k, v in keys.items()}
+        self._grams = {g: np.array(v, dtype=np.intp) for g, v in grams.items()}
+
+    def _token_keys(self, normalized):
+        keys = set()
+        for tok in normalized.replace(',', ' ').split():
+            if tok in self.stopwords:
+                continue
+            keys.add(('t', tok))
+            keys.add(('p', tok[:self.prefix_len]))
+        return keys
+
+    def _ngrams(self, compact):
+        compact = compact.replace(',', '')
+        if len(compact) <= self.ngram_size:
+            return {compact} if compact else set()
+        return {compact[k:k + self.ngram_size] for k in range(len(compact) - self.ngram_size + 1)}
+
+    def candidates(self, toefl):
+        """Return the sorted base row indices worth scoring against a prepared TOEFL name."""
+        found = [self._keys[k] for k in self._token_keys(toefl.normalized) if k in self._keys]
+
+        query_grams = self._ngrams(toefl.compact)
+        gram_rows = [self._grams[g] for g in query_grams if g in self._grams]
+        if gram_rows:
+            shared = np.bincount(np.concatenate(gram_rows), minlength=self.size)
+            needed = max(1, int(np.ceil(self.min_ngram_share * len(query_grams))))
+            found.append(np.flatnonzero(shared >= needed))
+
+        if not found:
+            return np.empty(0, dtype=np.intp)
+        return np.unique(np.concatenate(found))
+
+
+def match_top_k(comparator, matrix_scorer, toefl_names, top_k=3, chunk_size=256, candidate_index=None,
+                full_scan_fallback=True, pairwise_max_candidates=0, progress=None):
+    """Top-k ``(base_index, score)`` candidates for every TOEFL name, scored chunk by chunk.
+
+    Each row's candidates depend only on that name, so the result does not
+    depend on how the list is chunked or sharded.
+    """
+    tops = []
+    for start in range(0, len(toefl_names), chunk_size):
+        if progress:
+            progress(start, len(toefl_names))
+        chunk = toefl_names[start:start + chunk_size]
+        tops.extend(matrix_scorer.score_top_k(
+            [comparator.prepare_toefl(name) for name in chunk],
+            top_k=top_k,
+            candidate_index=candidate_index,
+            full_scan_fallback=full_scan_fallback,
+            pairwise_max_candidates=pairwise_max_candidates,
+        ))
+    return tops
+
+# Estado de cada processo do pool de matching: a base preparada chega uma única vez, pelo initializer
+_match_worker_state = {}
+
+def _init_match_worker(base_prepared, algorithm, blocking_options, match_options):
+    comparator = NameComparator()
+    candidate_index = None
+    if blocking_options is not None:
+        candidate_index = CandidateIndex(base_prepared, stopwords=comparator.stopwords, **blocking_options)
+    _match_worker_state.update(
+        comparator=comparator,
+        # Cada processo já ocupa um núcleo: cdist com uma thread para não disputar CPU
+        matrix_scorer=NameMatrixScorer(comparator, base_prepared, algorithm, workers=1),
+        candidate_index=candidate_index,
+        match_options=match_options,
+    )
+
+def _match_shard(toefl_names):
+    # Devolve os tops do shard e os contadores rapidfuzz do processo durante o shard
+    state = _match_worker_state
+    state['matrix_scorer'].calls.clear()
+    tops = match_top_k(
+        state['comparator'], state['matrix_scorer'], toefl_names,
+        candidate_index=state['candidate_index'], **state['match_options']
+    )
+    return tops, dict(state['matrix_scorer'].calls)
+
+def _match_pool_context():
+    # 'forkserver' não existe no Windows: cai para 'spawn'
+    method = app.config['MATCH_PROCESS_START_METHOD']
+    if method not in multiprocessing.get_all_start_methods():
+        method = 'spawn'
+    context = multiprocessing.get_context(method)
+    if method == 'forkserver':
+        # O servidor de fork (processo de uma só thread) importa este módulo uma vez; os workers de
+        # cada pool nascem dele já com pandas/rapidfuzz carregados, em vez de reimportar tudo
+        context.set_forkserver_preload(['__main__', __name__])
+    return context
+
+def match_top_k_sharded(base_prepared, algorithm, toefl_names, processes, blocking_options=None,
+                        progress=None, calls=None, **match_options):
+    """Same output as ``match_top_k``, with the TOEFL list split into shards scored in a process pool.
+
+    The prepared base roster is sent to each worker once (pool initializer) and
+    shard results are concatenated in submission order, so rows come back in
+    the original TOEFL order. The workers' rapidfuzz counters are added to
+    ``calls`` when given.
+    """
+    chunk_size = match_options.get('chunk_size', 256)
+    # Mais shards que processos equilibra a carga e dá granularidade ao progresso
+    shard_size = max(chunk_size, -(-len(toefl_names) // (processes * 4)))
+    shards = [toefl_names[i:i + shard_size] for i in range(0, len(toefl_names), shard_size)]
+    tops = []
+    with ProcessPoolExecutor(
+        max_workers=min(processes, len(shards)),
+        mp_context=_match_pool_context(),
+        initializer=_init_match_worker,
+        initargs=(base_prepared, algorithm, blocking_options, match_options),
+    ) as executor:
+        futures = [executor.submit(_match_shard, shard) for shard in shards]
+        for future in futures:
+            if progress:
+                progress(len(tops), len(toefl_names))
+            shard_tops, shard_calls = future.result()
+            tops.extend(shard_tops)
+            if calls is not None:
+                calls.update(shard_calls)
+    return tops
+
+def _collect_shards(futures, calls=None):
+    # Tops dos shards de um bloco, na ordem; devolve (tops, erro) para permitir o fallback em série
+    try:
+        tops = []
+        shard_calls = Counter()
+        for future in futures:
+            shard_tops, counts = future.result()
+            tops.extend(shard_tops)
+            shard_calls.update(counts)
+    except Exception as e:
+        return None, e
+    if calls is not None:
+        calls.update(shard_calls)
+    return tops, None
+
+def match_top_k_chunks(name_chunks, base_prepared, algorithm, processes=1, blocking_options=None,
+                       candidate_index=None, cdist_workers=-1, calls=None, min_pool_names=0, **match_options):
+    """Top-k candidates for TOEFL names that arrive in chunks (e.g. while a CSV is still being read).
+
+    Yields ``(names, tops)`` per input chunk, in input order, as soon as the
+    chunk is scored. With ``processes > 1`` each chunk is split into shards for a single
+    process pool and at most ``processes`` chunks are kept in flight; if the
+    pool fails, the pending and remaining chunks are scored in this process.
+    The pool is only started when the first chunk has at least
+    ``min_pool_names`` names; smaller streams are scored in this process.
+    A prebuilt ``candidate_index`` is used for the in-process scoring.
+    rapidfuzz counters of every chunk are added to ``calls`` when given.
+    """
+    serial = {}
+
+    def score_serial(names):
+        if not serial:
+            comparator = NameComparator()
+            serial['comparator'] = comparator
+            serial['matrix_scorer'] = NameMatrixScorer(comparator, base_prepared, algorithm, workers=cdist_workers)
+            serial['candidate_index'] = candidate_index
+            if candidate_index is None and blocking_options is not None:
+                serial['candidate_index'] = CandidateIndex(
+                    base_prepared, stopwords=comparator.stopwords, **blocking_options
+                )
+        tops = match_top_k(
+            serial['comparator'], serial['matrix_scorer'], names,
+            candidate_index=serial['candidate_index'], **match_options
+        )
+        if calls is not None:
+            calls.update(serial['matrix_scorer'].calls)
+        serial['matrix_scorer'].calls.clear()
+        return tops
+
+    chunks = iter(name_chunks)
+    pending = deque()  # (nomes, futures dos shards) ainda não entregues, na ordem de entrada
+    if processes > 1 and min_pool_names > 0:
+        # Como no caminho sem streaming: subir o pool só compensa a partir de min_pool_names nomes.
+        # O primeiro bloco (já sem os nomes em cache) decide; blocos completos têm TOEFL_STREAM_CHUNK_ROWS linhas
+        first = next(chunks, None)
+        if first is None:
+            return
+        if len(first) < min_pool_names:
+            processes = 1
+        chunks = itertools.chain([first], chunks)
+    if processes > 1:
+        chunk_size = match_options.get('chunk_size', 256)
+        executor = ProcessPoolExecutor(
+            max_workers=processes,
+            mp_context=_match_pool_context(),
+            initializer=_init_match_worker,
+            initargs=(base_prepared, algorithm, blocking_options, match_options),
+        )
+        failure = None
+        try:
+            for names in chunks:
+                shard_size = max(chunk_size, -(-len(names) // processes))
+                try:
+                    futures = [
+                        executor.submit(_match_shard, names[i:i + shard_size])
+                        for i in range(0, len(names), shard_size)
+                    ]
+                except Exception as e:
+                    failure = e
+                    futures = []
+                pending.append((names, futures))
+                # Entregar em ordem, mantendo no máximo `processes` blocos em andamento
+                while failure is None and len(pending) > processes:
+                    tops, failure = _collect_shards(pending[0][1], calls)
+                    if failure is None:
+                        yield pending.popleft()[0], tops
+                if failure is not None:
+                    break
+            while failure is None and pending:
+                tops, failure = _collect_shards(pending[0][1], calls)
+                if failure is None:
+                    yield pending.popleft()[0], tops
+        finally:
+            executor.shutdown(wait=failure is None, cancel_futures=True)
+        if failure is None:
+            return
+        log_matching.warning("Pool de processos indisponível (%s); pontuando em série", failure)
+    while pending:
+        names = pending.popleft()[0]
+        yield names, score_serial(names)
+    for names in chunks:
+        yield names, score_serial(names)
 
 
 CLASS_ALLOWED_LETTERS = {
@@ -257,46 +1787,62 @@ def _format_fund_label(grade, letter):
     return f'FUND-{grade}'
 
 
+# Padrões de turma pré-compilados (usados por _grade_letter_from_normalized)
+_DIGIT_LETTER_RE = re.compile(r'(\d)([a-z])')
+_LETTER_DIGIT_RE = re.compile(r'([a-z])(\d)')
+_ROMAN_GRADE_RES = [(re.compile(rf'\b{roman}\b'), grade) for roman, grade in ROMAN_GRADE_MAP.items()]
+_GRADE_LETTER_RE = re.compile(r'\b(6|9)\s*(?:ano|serie|grau)?\s*([a-h])\b')
+_GRADE_LETTER_COMPACT_RE = re.compile(r'\b(6|9)([a-h])\b')
+_GRADE_INDEX_RE = re.compile(r'\b(6|9)\s*(?:[\.,;:-])\s*([1-8])\b')
+_GRADE_INDEX_COMPACT_RE = re.compile(r'\b(6|9)([1-8])\b')
+_GRADE_ONLY_RE = re.compile(r'\b(6|9)\b')
+
+
 def _extract_grade_letter_from_text(text, comparator):
     if text is None:
         return None, None
     value = str(text).strip()
     if not value or value.lower() == 'nan':
         return None, None
-    norm = comparator.normalize_name(value)
+    return _grade_letter_from_normalized(comparator.normalize_name(value))
+
+
+@lru_cache(maxsize=4096)
+def _grade_letter_from_normalized(norm):
+    # Memoizado: planilhas repetem poucas dezenas de textos de turma para milhares de alunos
     if not norm:
         return None, None
-    norm = re.sub(r'(\d)([a-z])', r'\1 \2', norm)
-    norm = re.sub(r'([a-z])(\d)', r'\1 \2', norm)
-    for roman, grade in ROMAN_GRADE_MAP.items():
-        norm = re.sub(rf'\b{roman}\b', grade, norm)
+    norm = _DIGIT_LETTER_RE.sub(r'\1 \2', norm)
+    norm = _LETTER_DIGIT_RE.sub(r'\1 \2', norm)
+    for roman_re, grade in _ROMAN_GRADE_RES:
+        norm = roman_re.sub(grade, norm)
     search_text = norm
 
-    match = re.search(r'\b(6|9)\s*(?:ano|serie|grau)?\s*([a-h])\b', search_text)
+    match = _GRADE_LETTER_RE.search(search_text)
     if match:
         grade, letter = match.groups()
         return grade, letter
 
-    match = re.search(r'\b(6|9)([a-h])\b', search_text)
+    match = _GRADE_LETTER_COMPACT_RE.search(search_text)
     if match:
         grade, letter = match.groups()
         return grade, letter
 
-    match = re.search(r'\b(6|9)\s*(?:[\.,;:-])\s*([1-8])\b', search_text)
+    match = _GRADE_INDEX_RE.search(search_text)
     if match:
         grade, idx = match.groups()
         mapped = CLASS_INDEX_TO_LETTER.get(grade, {}).get(idx)
         if mapped:
             return grade, mapped.lower()
 
-    match = re.search(r'\b(6|9)([1-8])\b', search_text)
+    match = _GRADE_INDEX_COMPACT_RE.search(search_text)
     if match:
         grade, idx = match.groups()
         mapped = CLASS_INDEX_TO_LETTER.get(grade, {}).get(idx)
         if mapped:
             return grade, mapped.lower()
 
-    grade_match = re.search(r'\b(6|9)\b', search_text)
+    grade_match = _GRADE_ONLY_RE.search(search_text)
     if grade_match:
         grade = grade_match.group(1)
         tokens = search_text.split()
@@ -365,6 +1911,329 @@ def build_toefl_columns_map(df_columns, normalizer):
             mapping.setdefault('cerf_geral', col)
     return mapping
 
+TOEFL_METRIC_KEYS = [
+    'listening', 'listening_cerf', 'lfm', 'lfm_cerf', 'reading', 'reading_cerf',
+    'lexil', 'osl', 'total', 'cerf_geral',
+]
+
+def build_toefl_metrics_table(df2, name_col, normalizer, colmap=None):
+    """Metric columns of the TOEFL sheet keyed by normalized name (``__key__``).
+
+    Built column-wise: one normalized key per row, only the columns found by
+    build_toefl_columns_map (or the given ``colmap``), and the last row kept
+    when a name repeats. Metric columns are object dtype so integers survive
+    the later left merge.
+    """
+    if colmap is None:
+        colmap = build_toefl_columns_map(df2.columns, normalizer)
+    table = pd.DataFrame({'__key__': df2[name_col].map(str).map(normalizer)}, index=df2.index)
+    for key in TOEFL_METRIC_KEYS:
+        col = colmap.get(key)
+        table[key] = df2[col].astype(object) if col is not None else None
+    table = table[table['__key__'] != '']
+    return table.drop_duplicates('__key__', keep='last')
+
+def lookup_toefl_metrics(metrics_table, toefl_names, normalizer):
+    """Left-join the metrics table onto a list of TOEFL names in a single merge.
+
+    Returns ``(found, columns)``: a list of booleans (name present in the TOEFL
+    sheet) and ``{metric_key: list}`` aligned with ``toefl_names``, holding
+    plain Python values with missing cells as None.
+    """
+    query = pd.DataFrame({'__key__': [normalizer(name) for name in toefl_names]})
+    merged = query.merge(metrics_table, on='__key__', how='left', indicator=True, sort=False)
+    found = (merged['_merge'] == 'both').tolist()
+    columns = {}
+    for key in TOEFL_METRIC_KEYS:
+        col = merged[key].astype(object)
+        columns[key] = col.where(col.notna(), None).tolist()
+    return found, columns
+
+def toefl_metrics_row(found, columns, i):
+    """Metrics dict of the i-th looked-up name ({} when it is not in the TOEFL sheet)."""
+    if not found[i]:
+        return {}
+    return {key: columns[key][i] for key in TOEFL_METRIC_KEYS}
+
+def toefl_metrics_by_names(metrics_table, toefl_names, normalizer):
+    """Metrics dict of every distinct TOEFL name ({} when absent), from one lookup."""
+    names = list(dict.fromkeys(toefl_names))
+    found, columns = lookup_toefl_metrics(metrics_table, names, normalizer)
+    return {name: toefl_metrics_row(found, columns, i) for i, name in enumerate(names)}
+
+def resolve_toefl_name_column(columns, column2, normalizer):
+    """Name column of the TOEFL sheet: the requested one, else a column named 'NOME', else the first."""
+    if column2 and column2 in columns:
+        return column2
+    # Preferir coluna chamada exatamente 'NOME' quando existir
+    for col in columns:
+        if normalizer(str(col)) == 'nome':
+            return col
+    return columns[0]
+
+# Pontuações convertidas para número na leitura em blocos; CERF e LEXIL continuam texto
+TOEFL_NUMERIC_METRIC_KEYS = ['listening', 'lfm', 'reading', 'osl', 'total']
+
+_INT_TEXT_RE = re.compile(r'[+-]?\d+')
+_FLOAT_TEXT_RE = re.compile(r'[+-]?(?:\d+\.?\d*|\.\d+)(?:[eE][+-]?\d+)?')
+
+def _parse_metric_text(value):
+    # Métricas lidas como texto: números viram int/float (como a inferência do pandas), o resto fica texto
+    if not isinstance(value, str):
+        return None
+    text = value.strip()
+    if _INT_TEXT_RE.fullmatch(text):
+        return int(text)
+    if _FLOAT_TEXT_RE.fullmatch(text):
+        return float(text)
+    return value
+
+def iter_toefl_csv_chunks(path, column2, normalizer, chunk_rows=20000):
+    """Read a TOEFL CSV in chunks, yielding ``(names, metrics_table, fraction_read)``.
+
+    The header is sniffed first and only the name column plus the metric
+    columns found by build_toefl_columns_map are parsed, as text; the score
+    columns (TOEFL_NUMERIC_METRIC_KEYS) are then converted per value by
+    _parse_metric_text. ``names`` are the
+    non-empty names of the chunk, ``metrics_table`` is the chunk's
+    build_toefl_metrics_table and ``fraction_read`` the share of the file
+    consumed so far (for progress estimates).
+    """
+    header = list(pd.read_csv(path, nrows=0).columns)
+    name_col = resolve_toefl_name_column(header, column2, normalizer)
+    colmap = build_toefl_columns_map(header, normalizer)
+    # Colunas por posição: funciona também com cabeçalhos repetidos (renomeados pelo pandas)
+    positions = sorted({header.index(name_col)} | {header.index(col) for col in colmap.values()})
+    numeric_cols = [
+        col for col in dict.fromkeys(colmap[key] for key in TOEFL_NUMERIC_METRIC_KEYS if key in colmap)
+        if col != name_col
+    ]
+    size = max(os.path.getsize(path), 1)
+    with open(path, 'rb') as f:
+        for chunk in pd.read_csv(f, usecols=positions, dtype=str, chunksize=chunk_rows):
+            for col in numeric_cols:
+                chunk[col] = chunk[col].map(_parse_metric_text)
+            names = chunk[name_col].dropna().astype(str).tolist()
+            metrics_table = build_toefl_metrics_table(chunk, name_col, normalizer, colmap=colmap)
+            yield names, metrics_table, min(f.tell() / size, 1.0)
+
+EXPORT_SHEET_NAME = 'Resultados_Comparacao'
+EXPORT_COLUMNS = [
+    'NOME', 'NOME ENCONTRADO', 'TURMA', 'PROFESSOR', 'NÍVEL',
+    'LISTENING', 'LISTENING CERF', 'LISTENING CSA', 'LFM', 'LFM CERF',
+    'READING', 'READING CERF', 'LEXIL', 'OSL', 'TOTAL', 'CERF GERAL',
+]
+
+def iter_export_rows(results, unmatched, default_school_label=None):
+    """Yield the rows of the export sheet: matched results first, then the unmatched names.
+
+    ``unmatched`` holds ``(toefl_name, metrics)`` pairs, with ``metrics`` as
+    returned by toefl_metrics_row ({} when the name is not in the TOEFL sheet).
+    Rows are produced one at a time so the export never holds a full copy.
+    """
+    for r in results:
+        yield {
+            'NOME': r.get('toefl_name', ''),
+            'NOME ENCONTRADO': r.get('matched_name', ''),
+            'TURMA': r.get('class', ''),
+            'PROFESSOR': r.get('professor', ''),
+            'NÍVEL': r.get('nivel', ''),
+            'LISTENING': r.get('listening', ''),
+            'LISTENING CERF': r.get('listening_cerf', ''),
+            'LISTENING CSA': r.get('listening_csa', ''),
+            'LFM': r.get('lfm', ''),
+            'LFM CERF': r.get('lfm_cerf', ''),
+            'READING': r.get('reading', ''),
+            'READING CERF': r.get('reading_cerf', ''),
+            'LEXIL': r.get('lexil', ''),
+            'OSL': r.get('osl', ''),
+            'TOTAL': r.get('total', ''),
+            'CERF GERAL': r.get('cerf_geral', '')
+        }
+
+    # Para não encontrados, calcular Listening CSA usando ano selecionado (ou 9.1 se "auto")
+    fallback_label = '9.1' if (default_school_label is None or str(default_school_label).strip().lower() == 'auto') else default_school_label
+    for nm, metrics in unmatched:
+        cerf_geral = compute_cerf_geral(metrics)
+        csa_unmatched = compute_listening_csa(fallback_label, metrics.get('listening')) if metrics else {'points': ''}
+
+        yield {
+            'NOME': nm,
+            'NOME ENCONTRADO': '',
+            'TURMA': '',
+            'PROFESSOR': '',
+            'NÍVEL': '',
+            'LISTENING': metrics.get('listening', ''),
+            'LISTENING CERF': metrics.get('listening_cerf', ''),
+            'LISTENING CSA': csa_unmatched.get('points', ''),
+            'LFM': metrics.get('lfm', ''),
+            'LFM CERF': metrics.get('lfm_cerf', ''),
+            'READING': metrics.get('reading', ''),
+            'READING CERF': metrics.get('reading_cerf', ''),
+            'LEXIL': metrics.get('lexil', ''),
+            'OSL': metrics.get('osl', ''),
+            'TOTAL': metrics.get('total', ''),
+            'CERF GERAL': cerf_geral
+        }
+
+# Cabeçalho no mesmo estilo do pandas.to_excel (negrito, bordas finas, centralizado no topo)
+_EXPORT_HEADER_FONT = Font(bold=True)
+_EXPORT_HEADER_BORDER = Border(left=Side(style='thin'), right=Side(style='thin'),
+                               top=Side(style='thin'), bottom=Side(style='thin'))
+_EXPORT_HEADER_ALIGNMENT = Alignment(horizontal='center', vertical='top')
+
+def _excel_cell_value(value):
+    # Vazio/NaN viram célula vazia, como o na_rep='' do pandas
+    if value is None or value == '':
+        return None
+    if isinstance(value, float) and value != value:
+        return None
+    return value
+
+def write_export_xlsx(rows, path):
+    """Write export rows to ``path`` with a write-only (constant-memory) openpyxl workbook.
+
+    Keeps the ``Resultados_Comparacao`` sheet and the EXPORT_COLUMNS header.
+    Returns the number of data rows written.
+    """
+    workbook = Workbook(write_only=True)
+    sheet = workbook.create_sheet(EXPORT_SHEET_NAME)
+    header = []
+    for name in EXPORT_COLUMNS:
+        cell = WriteOnlyCell(sheet, value=name)
+        cell.font = _EXPORT_HEADER_FONT
+        cell.border = _EXPORT_HEADER_BORDER
+        cell.alignment = _EXPORT_HEADER_ALIGNMENT
+        header.append(cell)
+    sheet.append(header)
+    count = 0
+    for row in rows:
+        sheet.append([_excel_cell_value(row.get(col)) for col in EXPORT_COLUMNS])
+        count += 1
+    workbook.save(path)
+    return count
+
+# Colunas numéricas tipadas como float64 no Parquet; as demais vão como texto
+EXPORT_NUMERIC_COLUMNS = {'LISTENING', 'LISTENING CSA', 'LFM', 'READING', 'OSL', 'TOTAL'}
+
+def iter_export_csv(rows, batch_rows=5000):
+    """Yield the export as UTF-8 CSV chunks, a batch of rows at a time.
+
+    The first chunk starts with a BOM so Excel detects the encoding; empty
+    and NaN cells are written as empty fields.
+    """
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    buffer.write('\ufeff')
+    writer.writerow(EXPORT_COLUMNS)
+    pending = 0
+    for row in rows:
+        writer.writerow(['' if v is None else v for v in (_excel_cell_value(row.get(col)) for col in EXPORT_COLUMNS)])
+        pending += 1
+        if pending >= batch_rows:
+            yield buffer.getvalue().encode('utf-8')
+            buffer.seek(0)
+            buffer.truncate()
+            pending = 0
+    yield buffer.getvalue().encode('utf-8')
+
+def iter_export_ndjson(rows, batch_rows=5000):
+    """Yield the export as NDJSON chunks: one object per row, keys in EXPORT_COLUMNS order.
+
+    Empty and NaN cells become null.
+    """
+    lines = []
+    for row in rows:
+        record = {col: _excel_cell_value(row.get(col)) for col in EXPORT_COLUMNS}
+        lines.append(json.dumps(record, ensure_ascii=False, default=str))
+        if len(lines) >= batch_rows:
+            yield ('\n'.join(lines) + '\n').encode('utf-8')
+            lines = []
+    if lines:
+        yield ('\n'.join(lines) + '\n').encode('utf-8')
+
+def _parquet_value(col, value):
+    value = _excel_cell_value(value)
+    if value is None:
+        return None
+    if col in EXPORT_NUMERIC_COLUMNS:
+        # Valores não numéricos (ex.: texto solto na planilha TOEFL) viram nulo
+        try:
+            number = float(value)
+        except (TypeError, ValueError):
+            return None
+        return None if number != number else number
+    return str(value)
+
+def write_export_parquet(rows, path, batch_rows=5000):
+    """Write export rows to ``path`` as Parquet, one row group per ``batch_rows`` rows.
+
+    Numeric score columns (EXPORT_NUMERIC_COLUMNS) are float64, the rest are
+    strings. Requires pyarrow. Returns the number of data rows written.
+    """
+    if pa is None:
+        raise RuntimeError('Exportação em Parquet requer o pacote pyarrow')
+    schema = pa.schema([
+        (col, pa.float64() if col in EXPORT_NUMERIC_COLUMNS else pa.string()) for col in EXPORT_COLUMNS
+    ])
+    count = 0
+    with pq.ParquetWriter(path, schema) as writer:
+        batch = {col: [] for col in EXPORT_COLUMNS}
+        pending = 0
+        for row in rows:
+            for col in EXPORT_COLUMNS:
+                batch[col].append(_parquet_value(col, row.get(col)))
+            pending += 1
+            if pending >= batch_rows:
+                writer.write_table(pa.Table.from_pydict(batch, schema=schema))
+                count += pending
+                batch = {col: [] for col in EXPORT_COLUMNS}
+                pending = 0
+        if pending or not count:
+            writer.write_table(pa.Table.from_pydict(batch, schema=schema))
+            count += pending
+    return count
+
+# Formatos aceitos por /export: mimetype e extensão do arquivo
+EXPORT_FORMATS = {
+    'xlsx': ('application/vnd.openxmlformats-officedocument.spreadsheetml.sheet', 'xlsx'),
+    'csv': ('text/csv; charset=utf-8', 'csv'),
+    'ndjson': ('application/x-ndjson', 'ndjson'),
+    'parquet': ('application/vnd.apache.parquet', 'parquet'),
+}
+
+def _log_streamed_export(chunks, export_format, timer=None, profile=None):
+    # Repassa os blocos e registra o total de bytes (e a etapa de geração, no timer) ao final do envio;
+    # com perfil, a geração do corpo entra na mesma captura da view
+    size = 0
+    status = 'error'
+    if profile is not None:
+        profile.enable()
+    try:
+        for chunk in chunks:
+            size += len(chunk)
+            yield chunk
+        status = 'ok'
+    finally:
+        if timer is not None:
+            timer.lap(f'stream_{export_format}')
+            timer.finish(status)
+        if profile is not None:
+            profile.save(status, export_bytes=size)
+    log_export.info("export format=%s columns=%s bytes=%d", export_format, EXPORT_COLUMNS, size)
+
+def stream_file(path, chunk_size=64 * 1024):
+    """Yield a file in chunks (deleting it is left to the response's close callback)."""
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(chunk_size), b''):
+            yield block
+
+def remove_file_quietly(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
 # Calcula CERF GERAL a partir dos CERF por habilidade, com fallback
 def compute_cerf_geral(metrics: dict):
     """Calcula o CERF GERAL prioritariamente a partir do TOTAL, conforme faixas:
@@ -695,640 +2564,1418 @@ def compute_listening_csa(school_label: str, listening_score):
         else:
             return fuzz.token_sort_ratio(str1, str2)
 
+# Normaliza a visualização do Nível para formato fechado (ex.: 6.1/6.2/6.3)
+def normalize_nivel_display(raw_nivel):
+    if raw_nivel is None:
+        return ''
+    s = str(raw_nivel).strip().lower()
+    # Padrões com separador (.,;:-)
+    m = re.match(r"^\s*(\d{1,2})\s*[\.,;:-]\s*(\d+)\s*$", s)
+    if m:
+        major = m.group(1)
+        minor_first = m.group(2)[0]  # primeiro dígito após o separador
+        # Exibir apenas quando minor ∈ {1,2,3}
+        if minor_first in {'1','2','3'}:
+            return f"{major}.{minor_first}"
+        else:
+            return ''
+    # Inteiro simples
+    m2 = re.match(r"^\s*(\d{1,2})\s*$", s)
+    if m2:
+        # Não exibir inteiro puro para 6º ano fechado; deixar vazio
+        return ''
+    return str(raw_nivel)
+
+class PreparedRoster:
+    """Base roster ready for matching, built once from the base workbook.
+
+    Holds the rows kept after the extracurricular filter and FUND labeling,
+    deduplicated per class (name, clean label, professor, nível), their
+    PreparedName records and the per-sheet diagnostics of the preparation.
+    Candidate indexes for blocking are built on first use and kept with the
+    roster. Rosters are shared between requests: callers must not mutate them.
+    """
+
+    def __init__(self, names, classes, professors, levels, prepared, sheet_summaries=None, origin_counts=None):
+        self.names = names
+        self.classes = classes
+        self.professors = professors
+        self.levels = levels
+        self.prepared = prepared
+        self.sheet_summaries = sheet_summaries or {}
+        self.origin_counts = origin_counts or Counter()
+        # Identifica o conteúdo preparado (muda quando alunos, turmas, professor ou nível mudam)
+        digest = hashlib.sha256()
+        digest.update(json.dumps([names, classes, professors, levels], ensure_ascii=False, default=str).encode('utf-8'))
+        self.fingerprint = digest.hexdigest()
+        self._indexes = {}
+
+    def __len__(self):
+        return len(self.names)
+
+    def candidate_index(self, blocking_options, stopwords):
+        """CandidateIndex for these blocking options, built once per roster."""
+        key = tuple(sorted(blocking_options.items()))
+        index = self._indexes.get(key)
+        if index is None:
+            index = CandidateIndex(self.prepared, stopwords=stopwords, **blocking_options)
+            self._indexes[key] = index
+        return index
+
+def prepare_base_roster(sheets, column1, comparator, sheet_log_level=logging.INFO, origin_log=None, timer=None):
+    """Build a PreparedRoster from the base workbook sheets ({sheet_name: DataFrame}).
+
+    Every sheet goes through column detection, the extracurricular filter and
+    FUND labeling; rows are then deduplicated by normalized name per class.
+    With a StageTimer, labeling, dedup and name preparation are separate laps.
+    """
+    if origin_log is None:
+        origin_log = SampledLog(log_class_source, app.config['LOG_SAMPLE_LIMIT'])
+    origin_counts = Counter()
+    sheet_summaries = {}
+
+    # Agregar nomes, turmas, professor e nível da base a partir de todas as abas
+    base_names = []
+    base_classes = []
+    base_professors = []
+    base_levels = []
+    for sheet_name, df in sheets.items():
+        # Não ignorar nenhuma linha: usar todas as linhas da aba
+        df1_data = df
+
+        # Determinar colunas de nomes e turmas
+        if column1 and column1 in df1_data.columns:
+            names_col = column1
+        else:
+            names_col = df1_data.columns[0]
+
+        # Detectar dinamicamente apenas colunas diretamente relacionadas à turma/letra
+        # Restringir a 'turma' e 'classe' para evitar ruídos de 'ano/serie/grau'
+        class_keywords = {'turma','classe'}
+        class_cols = []
+        for col in df1_data.columns:
+            norm_col = comparator.normalize_name(str(col))
+            if any(kw in norm_col for kw in class_keywords):
+                class_cols.append(col)
+
+        # Escolher coluna primária de turma/classe quando disponível
+        primary_class_col = None
+        for col in df1_data.columns:
+            norm_col = comparator.normalize_name(str(col))
+            if any(kw in norm_col for kw in {'turma','classe'}):
+                primary_class_col = col
+                break
+        # Fallback: se não houver coluna identificada por cabeçalho, assumir coluna B (índice 1)
+        if primary_class_col is None and len(df1_data.columns) >= 2:
+            fallback_class_col = df1_data.columns[1]
+            if fallback_class_col != names_col:
+                primary_class_col = fallback_class_col
+                if fallback_class_col not in class_cols:
+                    class_cols.append(fallback_class_col)
+        # Não usar fallback para outras colunas (ano/serie/grau), pois podem não conter a letra correta
+        sheet_summary = sheet_summaries.setdefault(str(sheet_name), {})
+        sheet_summary.update(
+            names_col=str(names_col),
+            primary_class_col=None if primary_class_col is None else str(primary_class_col),
+            class_cols=[str(c) for c in class_cols],
+        )
+        log_class_source.log(
+            sheet_log_level, "sheet=%r names_col=%r primary_class_col=%r class_cols=%r",
+            sheet_name, names_col, primary_class_col, class_cols
+        )
+
+        # Detectar coluna de Professor e Nível
+        professor_col = None
+        nivel_col = None
+        for col in df1_data.columns:
+            norm_col = comparator.normalize_name(str(col))
+            if professor_col is None and any(kw in norm_col for kw in {'professor','docente','prof','teacher'}):
+                professor_col = col
+            if nivel_col is None and any(kw in norm_col for kw in {'nivel','nível'}):
+                nivel_col = col
+        # Fallbacks explícitos: Coluna C=professor, D=nivel
+        if professor_col is None and len(df1_data.columns) >= 3:
+            professor_col = df1_data.columns[2]
+        if nivel_col is None and len(df1_data.columns) >= 4:
+            nivel_col = df1_data.columns[3]
+
+        # Subconjunto e limpeza (inclui todas as colunas de classe encontradas)
+        subset_cols = [names_col] + class_cols + ([professor_col] if professor_col else []) + ([nivel_col] if nivel_col else [])
+        df_sub = df1_data[subset_cols].copy()
+        df_sub = df_sub[df_sub[names_col].notna()]
+
+        # Construir um campo normalizado combinando possíveis colunas de classe + nome da aba (como fallback controlado)
+        # Feito por coluna: textos 'nan' viram vazios (a normalização colapsa os espaços extras)
+        # e cada combinação distinta é normalizada uma única vez
+        sheet_norm = comparator.normalize_name(sheet_name)
+        class_combo = pd.Series('', index=df_sub.index, dtype=object)
+        for c in class_cols:
+            class_combo = class_combo + df_sub[c].map(str).replace('nan', '').astype(object) + ' '
+        # incluir nome da aba como último recurso (não prioritário)
+        class_combo = class_combo + sheet_norm
+        class_norm_by_combo = {combo: comparator.normalize_name(combo) for combo in class_combo.unique()}
+        df_sub['__class_norm__'] = class_combo.map(class_norm_by_combo)
+        # Guardar turma crua priorizando coluna primária
+        if primary_class_col:
+            df_sub['__class_raw__'] = df_sub[primary_class_col].astype(str).fillna('')
+        else:
+            df_sub['__class_raw__'] = ''
+        # Guardar professor e nível como metadados diretos
+        if professor_col:
+            df_sub['__professor__'] = df_sub[professor_col].astype(str).fillna('')
+        else:
+            df_sub['__professor__'] = ''
+        if nivel_col:
+            df_sub['__nivel__'] = df_sub[nivel_col].astype(str).fillna('')
+        else:
+            df_sub['__nivel__'] = ''
+
+        # Filtrar extracurriculares e manter entradas relevantes
+        before_count = len(df_sub)
+        # Excluir termos extracurriculares comuns (normalizados, sem acentos)
+        banned_terms = [
+            'violino','danca','teatro','musica','ballet','coral','flauta','piano','canto',
+            'judo','capoeira','arte','artes','basquete','futsal','handebol','volei','xadrez'
+        ]
+        pattern = '|'.join(banned_terms)
+        df_sub = df_sub[~df_sub['__class_norm__'].str.contains(pattern, na=False)]
+        after_count = len(df_sub)
+        sheet_summary.update(rows=before_count, extracurricular_filtered=before_count - after_count)
+        log_class_source.log(
+            sheet_log_level, "sheet=%r extracurricular filter: kept %d/%d", sheet_name, after_count, before_count
+        )
+
+        # Limpar rótulo da turma para mostrar FUND-<numero><letra>, usando o texto combinado
+        def clean_fund_label(norm, raw_class=None, raw_nivel=None, sheet_norm=None, rows=1):
+
+            def dbg(label, origin):
+                origin_counts[origin] += rows
+                origin_log.log(
+                    "origin=%r label=%r raw_class=%r raw_nivel=%r sheet=%r text=%r rows=%d",
+                    origin, label, raw_class, raw_nivel, sheet_norm, norm, rows
+                )
+                return label
+
+            sources = [
+                ('raw_class', raw_class),
+                ('raw_nivel', raw_nivel),
+                ('norm_combo', norm),
+                ('sheet_name', sheet_norm),
+            ]
+
+            fallback_label = None
+            fallback_origin = None
+
+            for origin, candidate in sources:
+                grade, letter = _extract_grade_letter_from_text(candidate, comparator)
+                if not grade:
+                    continue
+                allowed_letters = CLASS_ALLOWED_LETTERS.get(grade, set())
+                if letter and letter.lower() in allowed_letters:
+                    label = _format_fund_label(grade, letter)
+                    if label:
+                        return dbg(label, origin)
+                if fallback_label is None:
+                    fallback = _format_fund_label(grade, None)
+                    if fallback:
+                        fallback_label = fallback
+                        fallback_origin = origin
+
+            if fallback_label:
+                origin_label = f"{fallback_origin}_fallback" if fallback_origin else 'fallback'
+                return dbg(fallback_label, origin_label)
+
+            return dbg('FUND', 'default')
+
+        # Calcular rótulo limpo FUND usando turma crua da planilha + classe normalizada + Nível bruto,
+        # uma vez por combinação distinta (dezenas) em vez de uma vez por aluno (milhares)
+        label_keys = list(zip(df_sub['__class_norm__'], df_sub['__class_raw__'], df_sub['__nivel__']))
+        label_by_key = {
+            key: clean_fund_label(
+                comparator.normalize_name(key[0]),
+                key[1],
+                key[2],
+                sheet_norm,
+                rows=count
+            )
+            for key, count in Counter(label_keys).items()
+        }
+        df_sub['__class_clean__'] = [label_by_key[key] for key in label_keys]
+        # Diagnóstico geral: quantos rótulos ficaram como apenas FUND
+        try:
+            fund_only_count = int((df_sub['__class_clean__'] == 'FUND').sum())
+            # Distribuição por turma
+            dist = {str(label): int(n) for label, n in df_sub['__class_clean__'].value_counts().items()}
+            sheet_summary.update(fund_only_rows=fund_only_count, distribution=dist)
+            log_class_source.log(
+                sheet_log_level, "sheet=%r FUND-only rows: %d/%d", sheet_name, fund_only_count, len(df_sub)
+            )
+            log_class_source.log(sheet_log_level, "sheet=%r distribution: %s", sheet_name, dist)
+        except Exception:
+            pass
+
+        # Após limpar, manter apenas linhas de FUND
+        df_sub = df_sub[df_sub['__class_clean__'].str.startswith('FUND')]
+
+        # Agregar
+        base_names.extend(df_sub[names_col].astype(str).tolist())
+        # Usar rótulo limpo FUND (com fallback quando necessário)
+        base_classes.extend(df_sub['__class_clean__'].fillna('').astype(str).tolist())
+        base_professors.extend(df_sub['__professor__'].astype(str).tolist())
+        base_levels.extend(df_sub['__nivel__'].astype(str).tolist())
+
+    labeled_rows = len(base_names)
+    if timer is not None:
+        timer.lap('roster_labeling', rows_in=sum(len(df) for df in sheets.values()), rows_out=labeled_rows)
+
+    # Deduplicar nomes da base por normalização POR TURMA (preserva primeira ocorrência por turma)
+    # Isso evita perder alunos presentes em múltiplas turmas (ex.: FUND-6A e FUND-6B).
+    seen = set()
+    dedup_names = []
+    dedup_classes = []
+    dedup_professors = []
+    dedup_levels = []
+    for i, name in enumerate(base_names):
+        key = comparator.normalize_name(str(name))
+        cls = base_classes[i] if i < len(base_classes) else ''
+        comp_key = (key, cls)
+        if comp_key not in seen:
+            seen.add(comp_key)
+            dedup_names.append(name)
+            dedup_classes.append(cls)
+            dedup_professors.append(base_professors[i] if i < len(base_professors) else '')
+            dedup_levels.append(base_levels[i] if i < len(base_levels) else '')
+    base_names = dedup_names
+    base_classes = dedup_classes
+    base_professors = dedup_professors
+    base_levels = dedup_levels
+    if timer is not None:
+        timer.lap('roster_dedup', rows_in=labeled_rows, rows_out=len(base_names))
+
+    # Normalizar/parsear cada nome da base uma única vez (O(N+M)); apenas a pontuação fica O(N×M)
+    base_prepared = [comparator.prepare_base(name) for name in base_names]
+    if timer is not None:
+        timer.lap('roster_prepare_names', rows_in=len(base_names), rows_out=len(base_prepared))
+    return PreparedRoster(
+        base_names, base_classes, base_professors, base_levels, base_prepared,
+        sheet_summaries=sheet_summaries, origin_counts=origin_counts,
+    )
+
+ROSTER_ID_PATTERN = DATASET_ID_PATTERN  # mesmo formato (uuid4 hex)
+
+class RosterRegistry:
+    """Prepared base rosters by roster ID, kept warm in memory and persisted on local disk.
+
+    Registering again under an existing roster ID publishes a new version
+    that replaces the previous one. Each roster is pickled to
+    ``<roster_id>.pkl`` with a ``<roster_id>.json`` metadata sidecar, so other
+    worker processes and restarts reuse it; the in-memory LRU entry is
+    reloaded when the file on disk changes.
+    """
+
+    def __init__(self, folder, max_entries=8):
+        self.folder = folder
+        self.max_entries = max_entries
+        self._entries = OrderedDict()  # roster_id -> (mtime, meta, roster)
+        self._lock = threading.Lock()
+        self._register_lock = threading.Lock()
+
+    def register(self, roster, meta, roster_id=None):
+        """Persist a prepared roster and return its metadata (``roster_id``, ``version``, ...)."""
+        with self._register_lock:
+            previous = self.info(roster_id) if roster_id else None
+            now = datetime.now().isoformat(timespec='seconds')
+            meta = dict(
+                meta,
+                roster_id=previous['roster_id'] if previous else uuid.uuid4().hex,
+                version=previous['version'] + 1 if previous else 1,
+                names=len(roster),
+                fingerprint=roster.fingerprint,
+                created_at=previous['created_at'] if previous else now,
+                updated_at=now,
+            )
+            roster_id = meta['roster_id']
+            os.makedirs(self.folder, exist_ok=True)
+            tmp_path = f'{self._disk_path(roster_id)}.{os.getpid()}.tmp'
+            with open(tmp_path, 'wb') as f:
+                pickle.dump({'meta': meta, 'roster': roster}, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_path, self._disk_path(roster_id))
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(meta, f, ensure_ascii=False, default=str)
+            os.replace(tmp_path, self._meta_path(roster_id))
+            self._remember(roster_id, os.path.getmtime(self._disk_path(roster_id)), meta, roster)
+        if previous and previous['fingerprint'] != meta['fingerprint']:
+            # Candidatos calculados contra a versão anterior não valem mais
+            match_cache.invalidate(previous['fingerprint'])
+        return meta
+
+    def get(self, roster_id):
+        """Return ``(meta, roster)`` for the latest version, or None if the ID is invalid or unknown."""
+        if not roster_id or not ROSTER_ID_PATTERN.match(str(roster_id)):
+            return None
+        path = self._disk_path(roster_id)
+        try:
+            mtime = os.path.getmtime(path)
+        except OSError:
+            with self._lock:
+                self._entries.pop(roster_id, None)
+            return None
+        with self._lock:
+            entry = self._entries.get(roster_id)
+            if entry is not None and entry[0] == mtime:
+                self._entries.move_to_end(roster_id)
+                return entry[1], entry[2]
+        # Ausente da memória ou atualizado por outro processo: recarregar do disco
+        try:
+            with open(path, 'rb') as f:
+                record = pickle.load(f)
+        except (OSError, pickle.UnpicklingError, EOFError):
+            return None
+        self._remember(roster_id, mtime, record['meta'], record['roster'])
+        return record['meta'], record['roster']
+
+    def info(self, roster_id):
+        """Metadata of a roster without loading it, or None."""
+        if not roster_id or not ROSTER_ID_PATTERN.match(str(roster_id)):
+            return None
+        try:
+            with open(self._meta_path(roster_id), encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def list(self):
+        """Metadata of every registered roster, most recently updated first."""
+        try:
+            names = os.listdir(self.folder)
+        except OSError:
+            return []
+        metas = [self.info(name[:-len('.json')]) for name in names if name.endswith('.json')]
+        return sorted((m for m in metas if m), key=lambda m: m['updated_at'], reverse=True)
+
+    def _remember(self, roster_id, mtime, meta, roster):
+        with self._lock:
+            self._entries[roster_id] = (mtime, meta, roster)
+            self._entries.move_to_end(roster_id)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def _disk_path(self, roster_id):
+        return os.path.join(self.folder, f'{roster_id}.pkl')
+
+    def _meta_path(self, roster_id):
+        return os.path.join(self.folder, f'{roster_id}.json')
+
+roster_registry = RosterRegistry(app.config['ROSTER_FOLDER'], max_entries=app.config['ROSTER_MAX_ENTRIES'])
+
+# Aumentar quando a pontuação mudar, para não reaproveitar candidatos calculados pela versão anterior
+MATCH_CACHE_VERSION = 1
+
+class MatchCache:
+    """Top-k candidates per TOEFL name persisted in SQLite.
+
+    Rows are keyed by (roster fingerprint, match options, normalized TOEFL
+    name) and hold the ``(base_index, score)`` list returned by match_top_k,
+    so a re-run against the same roster only scores names it has not seen.
+    Rows of a replaced roster version are dropped by ``invalidate``; beyond
+    ``max_rows`` the oldest rows are removed. Errors are logged and treated as
+    cache misses.
+    """
+
+    _BATCH = 500  # nomes por consulta (limite de parâmetros do SQLite)
+
+    def __init__(self, path, max_rows=500000):
+        self.path = path
+        self.max_rows = max_rows
+        self._ready = False
+        self._lock = threading.Lock()
+
+    def get_many(self, roster_fp, options_key, names):
+        """Return ``{normalized_name: tops}`` for the cached names among ``names``."""
+        found = {}
+        names = list(names)
+        try:
+            with self._connection() as conn:
+                for start in range(0, len(names), self._BATCH):
+                    batch = names[start:start + self._BATCH]
+                    rows = conn.execute(
+                        f"SELECT name, tops FROM match_cache WHERE roster = ? AND options = ? "
+                        f"AND name IN ({','.join('?' * len(batch))})",
+                        [roster_fp, options_key] + batch,
+                    )
+                    for name, tops in rows:
+                        found[name] = [(int(j), float(score)) for j, score in json.loads(tops)]
+        except sqlite3.Error as e:
+            log_matching.warning("Cache de matching indisponível (%s)", e)
+            return {}
+        return found
+
+    def put_many(self, roster_fp, options_key, tops_by_name):
+        """Store ``{normalized_name: tops}`` and prune the oldest rows beyond ``max_rows``."""
+        if not tops_by_name:
+            return
+        now = time.time()
+        rows = [
+            (roster_fp, options_key, name, json.dumps([[int(j), float(score)] for j, score in tops]), now)
+            for name, tops in tops_by_name.items()
+        ]
+        try:
+            with self._connection() as conn:
+                conn.executemany("INSERT OR REPLACE INTO match_cache VALUES (?, ?, ?, ?, ?)", rows)
+                excess = conn.execute("SELECT COUNT(*) FROM match_cache").fetchone()[0] - self.max_rows
+                if excess > 0:
+                    conn.execute(
+                        "DELETE FROM match_cache WHERE rowid IN "
+                        "(SELECT rowid FROM match_cache ORDER BY updated_at LIMIT ?)",
+                        (excess,),
+                    )
+        except sqlite3.Error as e:
+            log_matching.warning("Cache de matching indisponível (%s)", e)
+
+    def invalidate(self, roster_fp):
+        """Drop every cached row computed against a roster fingerprint."""
+        try:
+            with self._connection() as conn:
+                conn.execute("DELETE FROM match_cache WHERE roster = ?", (roster_fp,))
+        except sqlite3.Error as e:
+            log_matching.warning("Cache de matching indisponível (%s)", e)
+
+    @contextlib.contextmanager
+    def _connection(self):
+        # Uma conexão por operação (seguro entre threads; WAL permite vários processos): transação
+        # confirmada ou desfeita ao sair e conexão sempre fechada, sem esperar o coletor de lixo
+        if not self._ready:
+            os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        conn = sqlite3.connect(self.path, timeout=30)
+        try:
+            if not self._ready:
+                with self._lock:
+                    conn.execute("PRAGMA journal_mode=WAL")
+                    conn.execute(
+                        "CREATE TABLE IF NOT EXISTS match_cache ("
+                        "roster TEXT NOT NULL, options TEXT NOT NULL, name TEXT NOT NULL, "
+                        "tops TEXT NOT NULL, updated_at REAL NOT NULL, "
+                        "PRIMARY KEY (roster, options, name))"
+                    )
+                    conn.execute("CREATE INDEX IF NOT EXISTS match_cache_updated ON match_cache (updated_at)")
+                    conn.commit()
+                    self._ready = True
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+match_cache = MatchCache(app.config['MATCH_CACHE_PATH'], max_rows=app.config['MATCH_CACHE_MAX_ROWS'])
+
+def match_cache_options_key(algorithm, blocking_options, match_options):
+    """Key of everything besides the name and roster that changes the top-k candidates."""
+    options = {
+        'version': MATCH_CACHE_VERSION,
+        'algorithm': algorithm,
+        'blocking': blocking_options,
+        'top_k': match_options['top_k'],
+        'full_scan_fallback': bool(match_options['full_scan_fallback']),
+        'pairwise_max_candidates': match_options['pairwise_max_candidates'],
+    }
+    return hashlib.sha1(json.dumps(options, sort_keys=True).encode('utf-8')).hexdigest()
+
+def lookup_cached_tops(cache, roster_fp, options_key, names, normalizer):
+    """Split TOEFL names into cached candidates and the names that still need scoring.
+
+    Returns ``(keys, known, missing)``: the normalized key of every name,
+    ``{key: tops}`` found in the cache and ``{key: raw_name}`` with one name
+    per key not cached yet (repeated names are scored once).
+    """
+    keys = [normalizer(name) for name in names]
+    known = cache.get_many(roster_fp, options_key, set(keys))
+    missing = {}
+    for name, key in zip(names, keys):
+        if key not in known and key not in missing:
+            missing[key] = name
+    return keys, known, missing
+
+def store_scored_tops(cache, roster_fp, options_key, keys, known, missing, scored_tops):
+    """Cache the tops scored for ``missing`` and return the tops of every key, in order."""
+    scored = dict(zip(missing, scored_tops))
+    cache.put_many(roster_fp, options_key, scored)
+    return [known[key] if key in known else scored[key] for key in keys]
+
+class MatchOutcomes:
+    """Threshold-independent outcome of one comparison.
+
+    Every TOEFL name (in sheet order) keeps its top-k base candidates packed
+    in two ``(rows, top_k)`` arrays, base index (-1 pads short rows) and
+    score, next to the base columns those indices point to. Only the final
+    ``score >= threshold`` split depends on the threshold, so a stored
+    outcome can be classified again for another threshold without rescoring.
+    """
+
+    def __init__(self, toefl_names, indices, scores, base_names, base_classes, base_professors, base_levels):
+        self.toefl_names = list(toefl_names)
+        self.indices = indices
+        self.scores = scores
+        self.base_names = base_names
+        self.base_classes = base_classes
+        self.base_professors = base_professors
+        self.base_levels = base_levels
+
+    @staticmethod
+    def pack(tops, top_k):
+        """``(indices, scores)`` arrays for a list of ``[(base_index, score), ...]`` rows."""
+        padding = [(-1, 0.0)] * top_k
+        packed = np.array([(list(top) + padding)[:top_k] for top in tops], dtype=np.float64)
+        packed = packed.reshape(len(tops), top_k, 2)
+        return packed[:, :, 0].astype(np.int32), packed[:, :, 1]
+
+    @classmethod
+    def from_packed(cls, toefl_names, packed, top_k, base_names, base_classes, base_professors, base_levels):
+        """Build from the ``pack`` blocks of consecutive name chunks."""
+        if packed:
+            indices = np.concatenate([block[0] for block in packed])
+            scores = np.concatenate([block[1] for block in packed])
+        else:
+            indices, scores = MatchOutcomes.pack([], top_k)
+        return cls(toefl_names, indices, scores, base_names, base_classes, base_professors, base_levels)
+
+    def __len__(self):
+        return len(self.toefl_names)
+
+    def classify(self, threshold, metrics_by_name, default_school_label=None, include_diagnostics=False):
+        """Split the outcomes into matches, suggestions and unmatched names for ``threshold``.
+
+        Returns the /compare response fields: ``results`` (with TOEFL metrics
+        and CERF/CSA columns from ``metrics_by_name``), ``unmatched_list``,
+        ``suggestions``, ``statistics`` and, if requested, ``diagnostics``.
+        """
+        base_names = self.base_names
+        base_classes = self.base_classes
+        base_professors = self.base_professors
+        base_levels = self.base_levels
+        results = []
+        suggestions = []
+        # Diagnóstico opcional: melhor absoluto de cada nome, obtido na mesma passada
+        diagnostics = [] if include_diagnostics else None
+        # Listening CSA com base na turma encontrada; se ausente, usar seleção do usuário
+        fallback_label = None if (default_school_label is None or str(default_school_label).strip().lower() == 'auto') else default_school_label
+        for toefl_name, row_indices, row_scores in zip(self.toefl_names, self.indices.tolist(), self.scores.tolist()):
+            top = [(j, s) for j, s in zip(row_indices, row_scores) if j >= 0]
+
+            best_match = None
+            best_score = 0
+            best_class = ''
+            best_professor = ''
+            best_nivel = ''
+            # Melhor absoluto (primeira ocorrência do maior score), independente do limiar
+            abs_best_score = 0
+            abs_best_match = None
+            abs_best_class = ''
+            if top and top[0][1] > 0:
+                j, abs_best_score = top[0]
+                abs_best_match = base_names[j]
+                abs_best_class = base_classes[j] if j < len(base_classes) else ''
+                if abs_best_score >= threshold:
+                    best_match = base_names[j]
+                    best_score = abs_best_score
+                    best_class = abs_best_class
+                    best_professor = base_professors[j] if j < len(base_professors) else ''
+                    best_nivel = base_levels[j] if j < len(base_levels) else ''
+
+            if diagnostics is not None:
+                diagnostics.append({
+                    'toefl_name': toefl_name,
+                    'best_above_threshold': round(best_score, 2),
+                    'abs_best_score': round(abs_best_score, 2),
+                    'abs_best_match': abs_best_match,
+                    'abs_best_class': abs_best_class,
+                })
+
+            if best_match:
+                metrics = metrics_by_name.get(toefl_name) or {}
+                cerf_geral = compute_cerf_geral(metrics)
+                effective_label = best_class if (best_class and str(best_class).strip()) else fallback_label
+                csa = compute_listening_csa(effective_label, metrics.get('listening'))
+                results.append({
+                    'toefl_name': toefl_name,
+                    'matched_name': best_match,
+                    'class': best_class,
+                    'professor': best_professor,
+                    'nivel': normalize_nivel_display(best_nivel),
+                    'score': round(best_score, 2),
+                    # métricas TOEFL para exportação final
+                    'listening': metrics.get('listening'),
+                    'listening_cerf': metrics.get('listening_cerf'),
+                    'listening_csa': csa.get('points'),
+                    'lfm': metrics.get('lfm'),
+                    'lfm_cerf': metrics.get('lfm_cerf'),
+                    'reading': metrics.get('reading'),
+                    'reading_cerf': metrics.get('reading_cerf'),
+                    'lexil': metrics.get('lexil'),
+                    'osl': metrics.get('osl'),
+                    'total': metrics.get('total'),
+                    'cerf_geral': cerf_geral
+                })
+            elif top:
+                # Sugestões (top k por score) quando nenhum candidato atinge o limiar
+                suggestions.append({
+                    'toefl_name': toefl_name,
+                    'candidates': [
+                        {
+                            'name': base_names[j],
+                            'class': base_classes[j] if j < len(base_classes) else '',
+                            'professor': base_professors[j] if j < len(base_professors) else '',
+                            'nivel': normalize_nivel_display(
+                                None if j >= len(base_levels) or pd.isna(base_levels[j]) else base_levels[j]
+                            ),
+                            'score': round(s, 2)
+                        } for (j, s) in top
+                    ]
+                })
+
+        # Calcular lista de não encontrados
+        matched_toefl_set = set(r['toefl_name'] for r in results)
+        unmatched_list = [name for name in self.toefl_names if name not in matched_toefl_set]
+
+        total_toefl = len(self.toefl_names)
+        matched_count = len(results)
+        match_percentage = (matched_count / total_toefl * 100) if total_toefl > 0 else 0
+        classified = {
+            'results': results,
+            'unmatched_list': unmatched_list,
+            'suggestions': suggestions,
+            'statistics': {
+                'total_toefl': total_toefl,
+                'matched': matched_count,
+                'unmatched': total_toefl - matched_count,
+                'match_percentage': round(match_percentage, 2)
+            }
+        }
+        if diagnostics is not None:
+            classified['diagnostics'] = diagnostics
+        return classified
+
+def store_comparison_result(dataset_id, default_school_label, threshold, outcomes, metrics_by_name, classified):
+    """Keep a classified comparison in ``result_store`` and return its result ID.
+
+    The record holds what /export needs (matches, and unmatched names with
+    their TOEFL metrics) plus the outcomes and metrics used to classify again.
+    """
+    return result_store.put({
+        'dataset_id': dataset_id,
+        'default_school_label': default_school_label,
+        'threshold': threshold,
+        'results': classified['results'],
+        'unmatched': [(name, metrics_by_name.get(name) or {}) for name in classified['unmatched_list']],
+        'outcomes': outcomes,
+        'toefl_metrics': metrics_by_name,
+    })
+
+def request_flag(value):
+    """Boolean option from a JSON body or query string ("false", "0" and "no" are off)."""
+    if isinstance(value, str):
+        return value.strip().lower() in ('1', 'true', 'yes', 'on')
+    return bool(value)
+
+def blocking_options_from_config():
+    return {
+        'prefix_len': app.config['BLOCKING_PREFIX_LEN'],
+        'ngram_size': app.config['BLOCKING_NGRAM_SIZE'],
+        'min_ngram_share': app.config['BLOCKING_NGRAM_MIN_SHARE'],
+    }
+
 @app.route('/')
 def index():
-    return render_template('index.html')
+    # Parquet só aparece no seletor de exportação quando o pyarrow (opcional) está instalado
+    return render_template('index.html', parquet_available=pa is not None)
+
+def upload_file_info(filename, sheets, sample_rows=0):
+    first = sheets[0] if sheets else {'rows': 0, 'columns': [], 'sample': []}
+    info = {
+        'name': filename,
+        'rows': first['rows'],
+        'columns': first['columns'],
+        'sheets': [{'name': sheet['name'], 'rows': sheet['rows'], 'columns': len(sheet['columns'])} for sheet in sheets],
+    }
+    if sample_rows:
+        info['sample'] = first['sample']
+    return info
+
+def roster_file_info(meta):
+    # file1_info de um upload feito com roster_id: dados do roster registrado
+    return {
+        'name': meta['name'],
+        'rows': meta['names'],
+        'columns': meta['columns'],
+        'roster_id': meta['roster_id'],
+        'version': meta['version'],
+    }
 
 @app.route('/upload', methods=['POST'])
 def upload_files():
     try:
-        if 'file1' not in request.files or 'file2' not in request.files:
+        # Com roster_id a planilha base vem do registro de rosters e só a planilha TOEFL é enviada
+        roster_id = request.form.get('roster_id')
+        roster_meta = roster_registry.info(roster_id) if roster_id else None
+        if roster_id and roster_meta is None:
+            return jsonify({'error': 'Roster não encontrado'}), 404
+
+        if 'file2' not in request.files or (roster_meta is None and 'file1' not in request.files):
             return jsonify({'error': 'Ambos os arquivos são obrigatórios'}), 400
         
-        file1 = request.files['file1']
+        file1 = request.files.get('file1') if roster_meta is None else None
         file2 = request.files['file2']
         
-        if file1.filename == '' or file2.filename == '':
+        if (file1 is not None and file1.filename == '') or file2.filename == '':
             return jsonify({'error': 'Nenhum arquivo selecionado'}), 400
         
-        if not (allowed_file(file1.filename) and allowed_file(file2.filename)):
+        if not ((file1 is None or allowed_file(file1.filename)) and allowed_file(file2.filename)):
             return jsonify({'error': 'Formato de arquivo não suportado'}), 400
         
-        # Salvar arquivos temporariamente com nomes fixos para posterior comparação
-        filename1 = secure_filename(file1.filename)
+        # Salvar arquivos em um workspace próprio deste upload (identificado por dataset_id)
+        filename1 = secure_filename(file1.filename) if file1 is not None else None
         filename2 = secure_filename(file2.filename)
         
-        ext1 = os.path.splitext(filename1)[1].lower()
+        ext1 = os.path.splitext(filename1)[1].lower() if file1 is not None else None
         ext2 = os.path.splitext(filename2)[1].lower()
         
-        filepath1 = os.path.join(app.config['UPLOAD_FOLDER'], f'file1{ext1}')
-        filepath2 = os.path.join(app.config['UPLOAD_FOLDER'], f'file2{ext2}')
+        cleanup_expired_workspaces()
+        dataset_id, workspace = create_workspace()
+        filepath1 = os.path.join(workspace, f'file1{ext1}') if file1 is not None else None
+        filepath2 = os.path.join(workspace, f'file2{ext2}')
         
-        file1.save(filepath1)
+        if file1 is not None:
+            file1.save(filepath1)
         file2.save(filepath2)
         
-        # Read the uploaded files
+        # Só cabeçalho, abas e contagem de linhas; o parse completo fica para /compare (que usa o cache)
+        try:
+            sample_rows = int(request.form.get('sample_rows', 0) or 0)
+        except ValueError:
+            sample_rows = 0
+        sample_rows = min(max(sample_rows, 0), app.config['UPLOAD_PREVIEW_MAX_SAMPLE_ROWS'])
         try:
             # First file is the base file with names (column A) and classes (column B)
-            if ext1 == '.csv':
-                df1 = pd.read_csv(filepath1)
-            else:
-                df1 = pd.read_excel(filepath1)
+            sheets1 = read_sheet_preview(filepath1, ext1, sample_rows) if file1 is not None else None
             # Second file contains TOEFL students names for comparison
-            if ext2 == '.csv':
-                df2 = pd.read_csv(filepath2)
-            else:
-                df2 = pd.read_excel(filepath2)
+            sheets2 = read_sheet_preview(filepath2, ext2, sample_rows)
         except Exception as e:
             return jsonify({'error': f'Erro ao ler planilhas: {str(e)}'}), 400
         
-        # Retornar informações das planilhas
+        # Retornar informações das planilhas (rows/columns da primeira aba, como antes)
         response = {
             'success': True,
-            'file1_info': {
-                'name': filename1,
-                'rows': len(df1),
-                'columns': list(df1.columns)
-            },
-            'file2_info': {
-                'name': filename2,
-                'rows': len(df2),
-                'columns': list(df2.columns)
-            }
+            'dataset_id': dataset_id,
+            'file1_info': upload_file_info(filename1, sheets1, sample_rows) if sheets1 is not None else roster_file_info(roster_meta),
+            'file2_info': upload_file_info(filename2, sheets2, sample_rows),
         }
+        if roster_meta is not None:
+            response['roster_id'] = roster_meta['roster_id']
         
         return jsonify(response)
         
     except Exception as e:
         return jsonify({'error': f'Erro interno: {str(e)}'}), 500
 
-@app.route('/compare', methods=['POST'])
-def compare_names():
+@app.route('/rosters', methods=['POST'])
+def register_roster():
     try:
-        data = request.get_json()
-        threshold = float(data.get('threshold', 80))  # threshold em escala 0-100
-        algorithm = data.get('algorithm', 'token_sort_ratio')
-        column1 = data.get('column1')  # coluna de nomes na planilha base
-        column2 = data.get('column2')  # coluna de nomes na planilha TOEFL
-        default_school_label = data.get('default_school_label')
-        
-        # Função auxiliar para localizar arquivos por base name e extensões suportadas
-        def find_uploaded_file(base_name):
-            for ext in ['.xlsx', '.xls', '.csv']:
-                path = os.path.join(app.config['UPLOAD_FOLDER'], f'{base_name}{ext}')
-                if os.path.exists(path):
-                    return path, ext
-            return None, None
-        
-        file1_path, ext1 = find_uploaded_file('file1')
-        file2_path, ext2 = find_uploaded_file('file2')
-        
-        if not file1_path or not file2_path:
-            return jsonify({'success': False, 'error': 'Arquivos não encontrados. Faça o upload novamente.'})
-        
-        # Read the uploaded files
+        file = request.files.get('file')
+        if file is None or file.filename == '':
+            return jsonify({'error': 'Envie a planilha base no campo file'}), 400
+        if not allowed_file(file.filename):
+            return jsonify({'error': 'Formato de arquivo não suportado'}), 400
+        # roster_id informado publica uma nova versão do mesmo roster
+        roster_id = request.form.get('roster_id') or None
+        if roster_id and roster_registry.info(roster_id) is None:
+            return jsonify({'error': 'Roster não encontrado'}), 404
+        column1 = request.form.get('column1') or None
+
+        filename = secure_filename(file.filename)
+        ext = os.path.splitext(filename)[1].lower()
+        # A planilha só é lida aqui; o que fica registrado é o roster preparado
+        cleanup_expired_workspaces()
+        _, workspace = create_workspace()
         try:
-            # Ler planilha base: todas as abas (Sheet1..N) quando for Excel
-            if ext1 in ['.xlsx', '.xls']:
-                df1_sheets = pd.read_excel(file1_path, sheet_name=None)
-            else:
-                df1_sheets = {'CSV': pd.read_csv(file1_path)}
-
-            # Ler planilha TOEFL (aba única)
-            df2 = pd.read_excel(file2_path) if ext2 in ['.xlsx', '.xls'] else pd.read_csv(file2_path)
+            path = os.path.join(workspace, f'file1{ext}')
+            file.save(path)
+            try:
+                sheets = dataset_cache.get_sheets(path, ext)
+            except Exception as e:
+                return jsonify({'error': f'Erro ao ler planilha: {str(e)}'}), 400
+        finally:
+            shutil.rmtree(workspace, ignore_errors=True)
+
+        comparator = NameComparator()
+        roster = prepare_base_roster(sheets, column1, comparator)
+        # Índice de blocking com as opções padrão já vai junto no roster persistido
+        roster.candidate_index(blocking_options_from_config(), comparator.stopwords)
+        first_sheet = next(iter(sheets.values()), None)
+        meta = roster_registry.register(roster, {
+            'name': filename,
+            'column1': column1,
+            'sheets': [str(name) for name in sheets],
+            'columns': [] if first_sheet is None else list(first_sheet.columns),
+        }, roster_id)
+        log_class_source.info(
+            "roster registered roster_id=%s version=%d names=%d", meta['roster_id'], meta['version'], meta['names']
+        )
+        return jsonify({'success': True, **meta}), 201
 
-            # Inicializar comparador/normalizador para apoiar filtros e deduplicação
-            comparator = NameComparator()
+    except Exception as e:
+        return jsonify({'error': f'Erro interno: {str(e)}'}), 500
 
-            # Agregar nomes, turmas, professor e nível da base a partir de todas as abas
-            base_names = []
-            base_classes = []
-            base_professors = []
-            base_levels = []
-            for sheet_name, df in df1_sheets.items():
-                # Não ignorar nenhuma linha: usar todas as linhas da aba
-                df1_data = df
-
-                # Determinar colunas de nomes e turmas
-                if column1 and column1 in df1_data.columns:
-                    names_col = column1
-                else:
-                    names_col = df1_data.columns[0]
-
-                # Detectar dinamicamente apenas colunas diretamente relacionadas à turma/letra
-                # Restringir a 'turma' e 'classe' para evitar ruídos de 'ano/serie/grau'
-                class_keywords = {'turma','classe'}
-                class_cols = []
-                for col in df1_data.columns:
-                    norm_col = comparator.normalize_name(str(col))
-                    if any(kw in norm_col for kw in class_keywords):
-                        class_cols.append(col)
-
-                # Escolher coluna primária de turma/classe quando disponível
-                primary_class_col = None
-                for col in df1_data.columns:
-                    norm_col = comparator.normalize_name(str(col))
-                    if any(kw in norm_col for kw in {'turma','classe'}):
-                        primary_class_col = col
-                        break
-                # Fallback: se não houver coluna identificada por cabeçalho, assumir coluna B (índice 1)
-                if primary_class_col is None and len(df1_data.columns) >= 2:
-                    fallback_class_col = df1_data.columns[1]
-                    if fallback_class_col != names_col:
-                        primary_class_col = fallback_class_col
-                        if fallback_class_col not in class_cols:
-                            class_cols.append(fallback_class_col)
-                # Não usar fallback para outras colunas (ano/serie/grau), pois podem não conter a letra correta
-                try:
-                    print(f"[CLASS SOURCE] Sheet='{sheet_name}' names_col='{names_col}' primary_class_col='{primary_class_col}' class_cols={class_cols}")
-                except Exception:
-                    pass
+@app.route('/rosters', methods=['GET'])
+def list_rosters():
+    return jsonify({'success': True, 'rosters': roster_registry.list()})
+
+@app.route('/rosters/<roster_id>', methods=['GET'])
+def get_roster(roster_id):
+    meta = roster_registry.info(roster_id)
+    if meta is None:
+        return jsonify({'success': False, 'error': 'Roster não encontrado'}), 404
+    return jsonify({'success': True, **meta})
+
+def run_comparison(data, progress=None, profile=None):
+    """Run a full /compare request and return the response dict.
+
+    ``progress(processed, total)`` is called as TOEFL names are scored, so the
+    same code serves synchronous requests and background jobs. Every stage is
+    timed for /metrics; with ``"timings": true`` the response carries the
+    ``timings`` block too. With a ``RequestProfile`` the whole run is profiled
+    in the calling thread and the capture goes to ``profile_store``.
+    """
+    timer = StageTimer('compare', trace_memory=request_flag(data.get('trace_memory')))
+    response = None
+    if profile is not None:
+        profile.enable()
+    try:
+        response = _run_comparison(data, progress, timer, in_process=profile is not None)
+    finally:
+        status = 'ok' if response and response.get('success') else 'error'
+        timings = timer.finish(status)
+        if profile is not None:
+            profile_info = profile.save(status, stages=timer.stage_seconds())
+    if request_flag(data.get('timings', app.config['COMPARE_TIMINGS'])):
+        response['timings'] = timings
+    if profile is not None:
+        response['profile'] = profile_info
+    return response
+
+def _run_comparison(data, progress, timer, in_process=False):
+    threshold = float(data.get('threshold', 80))  # threshold em escala 0-100
+    algorithm = data.get('algorithm', 'token_sort_ratio')
+    column1 = data.get('column1')  # coluna de nomes na planilha base
+    column2 = data.get('column2')  # coluna de nomes na planilha TOEFL
+    default_school_label = data.get('default_school_label')
+    use_blocking = request_flag(data.get('blocking', app.config['MATCH_BLOCKING']))
+    top_k = max(1, int(data.get('top_k', app.config['SUGGESTIONS_TOP_K'])))  # sugestões por nome não encontrado
+    top_k = min(top_k, app.config['SUGGESTIONS_MAX_TOP_K'])
+    include_diagnostics = request_flag(data.get('diagnostics', app.config['MATCH_DIAGNOSTICS']))
+    # Diagnóstico via logging: contadores agregados num registro por requisição e eventos por linha amostrados
+    aggregate_logs = app.config['LOG_AGGREGATE_COUNTERS']
+    sheet_log_level = logging.DEBUG if aggregate_logs else logging.INFO
+    origin_log = SampledLog(log_class_source, app.config['LOG_SAMPLE_LIMIT'])
+    origin_counts = Counter()
+    log_summary = {
+        'dataset_id': data.get('dataset_id'),
+        'algorithm': algorithm,
+        'threshold': threshold,
+        'sheets': {},
+    }
+    
+    # Localizar os arquivos no workspace do upload
+    workspace = get_workspace(data.get('dataset_id'))
+    file1_path, ext1 = find_workspace_file(workspace, 'file1') if workspace else (None, None)
+    file2_path, ext2 = find_workspace_file(workspace, 'file2') if workspace else (None, None)
+
+    # Com roster_id a base vem já preparada do registro de rosters e a planilha base não é lida
+    roster = None
+    roster_id = data.get('roster_id')
+    if roster_id:
+        entry = roster_registry.get(roster_id)
+        if entry is None:
+            return {'success': False, 'error': 'Roster não encontrado. Registre a planilha base novamente.'}
+        roster_meta, roster = entry
+        log_summary.update(roster_id=roster_meta['roster_id'], roster_version=roster_meta['version'])
+        timer.lap('load_roster', rows_out=len(roster))
+    
+    if (roster is None and not file1_path) or not file2_path:
+        return {'success': False, 'error': 'Arquivos não encontrados. Faça o upload novamente.'}
+    
+    # Read the uploaded files
+    try:
+        # Ler planilha base: todas as abas (Sheet1..N) quando for Excel
+        df1_sheets = dataset_cache.get_sheets(file1_path, ext1) if roster is None else None
+        if df1_sheets is not None:
+            timer.lap('read_base', rows_out=sum(len(df) for df in df1_sheets.values()))
+
+        # Ler planilha TOEFL (aba única); CSV grande é lido em blocos mais adiante, junto com o matching
+        stream_toefl = data.get('stream_toefl')
+        if stream_toefl is None:
+            stream_toefl = (
+                app.config['TOEFL_STREAM_CSV']
+                and os.path.getsize(file2_path) >= app.config['TOEFL_STREAM_MIN_BYTES']
+            )
+        stream_toefl = request_flag(stream_toefl) and ext2 == '.csv'
+        df2 = None if stream_toefl else dataset_cache.get_first_sheet(file2_path, ext2)
+        if df2 is not None:
+            timer.lap('read_toefl', rows_out=len(df2))
+
+        # Inicializar comparador/normalizador para apoiar filtros e deduplicação
+        comparator = NameComparator()
+
+        # Roster da base: do registro (já preparado) ou preparado agora a partir da planilha enviada
+        if roster is None:
+            roster = prepare_base_roster(df1_sheets, column1, comparator, sheet_log_level, origin_log, timer)
+        log_summary['sheets'].update(roster.sheet_summaries)
+        origin_counts.update(roster.origin_counts)
+        base_names = roster.names
+        base_classes = roster.classes
+        base_professors = roster.professors
+        base_levels = roster.levels
+
+        # Obter nomes TOEFL e mapear métricas por linha
+        if stream_toefl:
+            # Preenchidos bloco a bloco durante o matching
+            toefl_names = []
+            toefl_metrics = None
+        else:
+            df2_name_col = resolve_toefl_name_column(df2.columns, column2, comparator.normalize_name)
+            toefl_names = df2[df2_name_col].dropna().astype(str).tolist()
 
-                # Detectar coluna de Professor e Nível
-                professor_col = None
-                nivel_col = None
-                for col in df1_data.columns:
-                    norm_col = comparator.normalize_name(str(col))
-                    if professor_col is None and any(kw in norm_col for kw in {'professor','docente','prof','teacher'}):
-                        professor_col = col
-                    if nivel_col is None and any(kw in norm_col for kw in {'nivel','nível'}):
-                        nivel_col = col
-                # Fallbacks explícitos: Coluna C=professor, D=nivel
-                if professor_col is None and len(df1_data.columns) >= 3:
-                    professor_col = df1_data.columns[2]
-                if nivel_col is None and len(df1_data.columns) >= 4:
-                    nivel_col = df1_data.columns[3]
-
-                # Subconjunto e limpeza (inclui todas as colunas de classe encontradas)
-                subset_cols = [names_col] + class_cols + ([professor_col] if professor_col else []) + ([nivel_col] if nivel_col else [])
-                df_sub = df1_data[subset_cols].copy()
-                df_sub = df_sub[df_sub[names_col].notna()]
-
-                # Construir um campo normalizado combinando possíveis colunas de classe + nome da aba (como fallback controlado)
-                sheet_norm = comparator.normalize_name(sheet_name)
-                def build_class_norm(row):
-                    parts = []
-                    for c in class_cols:
-                        val = str(row[c]) if c in row else ''
-                        parts.append(val)
-                    # incluir nome da aba como último recurso (não prioritário)
-                    parts.append(sheet_norm)
-                    combo = ' '.join([p for p in parts if p and p != 'nan'])
-                    return comparator.normalize_name(combo)
-                df_sub['__class_norm__'] = df_sub.apply(build_class_norm, axis=1)
-                # Guardar turma crua priorizando coluna primária
-                if primary_class_col:
-                    df_sub['__class_raw__'] = df_sub[primary_class_col].astype(str).fillna('')
-                else:
-                    df_sub['__class_raw__'] = ''
-                # Guardar professor e nível como metadados diretos
-                if professor_col:
-                    df_sub['__professor__'] = df_sub[professor_col].astype(str).fillna('')
-                else:
-                    df_sub['__professor__'] = ''
-                if nivel_col:
-                    df_sub['__nivel__'] = df_sub[nivel_col].astype(str).fillna('')
-                else:
-                    df_sub['__nivel__'] = ''
-
-                # Filtrar extracurriculares e manter entradas relevantes
-                before_count = len(df_sub)
-                # Excluir termos extracurriculares comuns (normalizados, sem acentos)
-                banned_terms = [
-                    'violino','danca','teatro','musica','ballet','coral','flauta','piano','canto',
-                    'judo','capoeira','arte','artes','basquete','futsal','handebol','volei','xadrez'
-                ]
-                pattern = '|'.join(banned_terms)
-                df_sub = df_sub[~df_sub['__class_norm__'].str.contains(pattern, na=False)]
-                after_count = len(df_sub)
-                print(f"[DEBUG] Sheet='{sheet_name}' extracurricular filter: kept {after_count}/{before_count}")
-
-                # Limpar rótulo da turma para mostrar FUND-<numero><letra>, usando o texto combinado
-                # Normaliza a visualização do Nível para formato fechado (ex.: 6.1/6.2/6.3)
-                def normalize_nivel_display(raw_nivel):
-                    if raw_nivel is None:
-                        return ''
-                    s = str(raw_nivel).strip().lower()
-                    # Padrões com separador (.,;:-)
-                    m = re.match(r"^\s*(\d{1,2})\s*[\.,;:-]\s*(\d+)\s*$", s)
-                    if m:
-                        major = m.group(1)
-                        minor_first = m.group(2)[0]  # primeiro dígito após o separador
-                        # Exibir apenas quando minor ∈ {1,2,3}
-                        if minor_first in {'1','2','3'}:
-                            return f"{major}.{minor_first}"
-                        else:
-                            return ''
-                    # Inteiro simples
-                    m2 = re.match(r"^\s*(\d{1,2})\s*$", s)
-                    if m2:
-                        # Não exibir inteiro puro para 6º ano fechado; deixar vazio
-                        return ''
-                    return str(raw_nivel)
-
-                def clean_fund_label(norm, raw_class=None, raw_nivel=None, sheet_norm=None):
-
-                    def dbg(label, origin):
-                        try:
-                            print(f"[CLASS ORIGIN] origin='{origin}' | label='{label}' | raw_class='{raw_class}' | raw_nivel='{raw_nivel}' | sheet='{sheet_norm}' | text='{norm}'")
-                        except Exception:
-                            pass
-                        return label
-
-                    sources = [
-                        ('raw_class', raw_class),
-                        ('raw_nivel', raw_nivel),
-                        ('norm_combo', norm),
-                        ('sheet_name', sheet_norm),
-                    ]
+            # Métricas TOEFL por nome normalizado (colunas selecionadas via build_toefl_columns_map)
+            toefl_metrics = build_toefl_metrics_table(df2, df2_name_col, comparator.normalize_name)
+            timer.lap('toefl_extract', rows_in=len(df2), rows_out=len(toefl_names))
 
-                    fallback_label = None
-                    fallback_origin = None
-
-                    for origin, candidate in sources:
-                        grade, letter = _extract_grade_letter_from_text(candidate, comparator)
-                        if not grade:
-                            continue
-                        allowed_letters = CLASS_ALLOWED_LETTERS.get(grade, set())
-                        if letter and letter.lower() in allowed_letters:
-                            label = _format_fund_label(grade, letter)
-                            if label:
-                                return dbg(label, origin)
-                        if fallback_label is None:
-                            fallback = _format_fund_label(grade, None)
-                            if fallback:
-                                fallback_label = fallback
-                                fallback_origin = origin
-
-                    if fallback_label:
-                        origin_label = f"{fallback_origin}_fallback" if fallback_origin else 'fallback'
-                        return dbg(fallback_label, origin_label)
-
-                    return dbg('FUND', 'default')
-
-                # Calcular rótulo limpo FUND usando turma crua da planilha + classe normalizada + Nível bruto
-                df_sub['__class_clean__'] = df_sub.apply(
-                    lambda row: clean_fund_label(
-                        comparator.normalize_name(row['__class_norm__']),
-                        row['__class_raw__'],
-                        row['__nivel__'],
-                        sheet_norm
+    # Perform comparison
+        if not stream_toefl:
+            log_matching.log(
+                sheet_log_level, "base names=%d toefl names=%d threshold=%s algorithm=%s",
+                len(base_names), len(toefl_names), threshold, algorithm
+            )
+        # Nomes da base já normalizados/parseados no roster (O(N)); apenas a pontuação fica O(N×M)
+        base_prepared = roster.prepared
+        # Mais candidatos que nomes na base só acrescentaria colunas de preenchimento
+        top_k = min(top_k, max(1, len(base_prepared)))
+        blocking_options = None
+        if use_blocking:
+            blocking_options = blocking_options_from_config()
+        match_options = {
+            'top_k': top_k,
+            'chunk_size': max(1, int(app.config['MATCH_CHUNK_SIZE'])),
+            'full_scan_fallback': app.config['MATCH_BLOCKING_FULL_SCAN_FALLBACK'],
+            'pairwise_max_candidates': app.config['MATCH_PAIRWISE_MAX_CANDIDATES'],
+        }
+        processes = app.config['MATCH_PROCESSES']
+        if processes is None:
+            processes = os.cpu_count() or 1
+        if in_process:
+            # Perfil: matching no próprio processo, para o cProfile ver o NameComparator e o scorer
+            processes = 1
+        # Cache por nome: só nomes ainda não vistos contra este roster (mesmas opções) são pontuados
+        cache_key = None
+        cache_stats = Counter()
+        if request_flag(data.get('match_cache', app.config['MATCH_CACHE'])):
+            cache_key = (roster.fingerprint, match_cache_options_key(algorithm, blocking_options, match_options))
+        names_to_score = toefl_names
+        score_progress = progress
+        if cache_key is not None and not stream_toefl:
+            keys, known, missing = lookup_cached_tops(match_cache, *cache_key, toefl_names, comparator.normalize_name)
+            cache_stats.update(hits=len(known), scored=len(missing))
+            names_to_score = list(missing.values())
+            timer.lap('match_cache_lookup', rows_in=len(toefl_names), rows_out=len(names_to_score))
+            if progress:
+                cached_rows = len(toefl_names) - len(names_to_score)
+
+                def score_progress(processed, total):
+                    progress(cached_rows + processed, cached_rows + total)
+        # Pontuar os nomes TOEFL em blocos (matrizes via process.cdist), contra toda a base ou
+        # apenas contra os candidatos do índice de blocking; de cada linha guardar só os top_k
+        # candidatos (índice na base, score). Listas grandes são divididas entre processos.
+        # Top-k de cada nome guardado em arrays, independente do limiar (reclassificação sem repontuar)
+        all_tops = None
+        packed_tops = []
+        if stream_toefl:
+            # Pipeline: leitura do CSV em blocos -> matching de cada bloco -> top-k empacotado por bloco
+            metric_tables = []
+            read_fraction = [0.0]
+            cached_chunks = deque()  # (nomes, chaves, em cache, faltantes) dos blocos enviados ao matching
+
+            def toefl_name_chunks():
+                for names, metrics_table, fraction in iter_toefl_csv_chunks(
+                    file2_path, column2, comparator.normalize_name, app.config['TOEFL_STREAM_CHUNK_ROWS']
+                ):
+                    metric_tables.append(metrics_table)
+                    read_fraction[0] = fraction
+                    if cache_key is not None:
+                        keys, known, missing = lookup_cached_tops(
+                            match_cache, *cache_key, names, comparator.normalize_name
+                        )
+                        cache_stats.update(hits=len(known), scored=len(missing))
+                        cached_chunks.append((names, keys, known, missing))
+                        yield list(missing.values())
+                    else:
+                        yield names
+
+            def score_streamed():
+                for names, tops in match_top_k_chunks(
+                    toefl_name_chunks(), base_prepared, algorithm,
+                    processes=processes, blocking_options=blocking_options,
+                    candidate_index=(
+                        roster.candidate_index(blocking_options, comparator.stopwords)
+                        if blocking_options is not None else None
                     ),
-                    axis=1
+                    cdist_workers=app.config['MATCH_CDIST_WORKERS'], calls=timer.counters,
+                    min_pool_names=app.config['MATCH_PROCESS_MIN_NAMES'], **match_options
+                ):
+                    if cache_key is not None:
+                        names, keys, known, missing = cached_chunks.popleft()
+                        tops = store_scored_tops(match_cache, *cache_key, keys, known, missing, tops)
+                    if progress:
+                        # Total estimado pela fração do arquivo já lida
+                        estimated = int(len(toefl_names) / max(read_fraction[0], 1e-6))
+                        progress(len(toefl_names), max(estimated, len(toefl_names) + len(names)))
+                    toefl_names.extend(names)
+                    packed_tops.append(MatchOutcomes.pack(tops, top_k))
+
+            score_streamed()
+            timer.lap('read_and_match', rows_out=len(toefl_names))
+        elif processes > 1 and len(names_to_score) >= app.config['MATCH_PROCESS_MIN_NAMES']:
+            try:
+                all_tops = match_top_k_sharded(
+                    base_prepared, algorithm, names_to_score, processes,
+                    blocking_options=blocking_options, progress=score_progress, calls=timer.counters,
+                    **match_options
                 )
-                # Diagnóstico geral: quantos rótulos ficaram como apenas FUND
-                try:
-                    fund_only_count = int((df_sub['__class_clean__'] == 'FUND').sum())
-                    print(f"[CLASS DEBUG] Sheet='{sheet_name}' FUND-only rows: {fund_only_count}/{len(df_sub)}")
-                    # Distribuição por turma
-                    dist = df_sub['__class_clean__'].value_counts()
-                    print(f"[CLASS SUMMARY] Sheet='{sheet_name}' distribution: {dict(dist)}")
-                except Exception:
-                    pass
-
-                # Após limpar, manter apenas linhas de FUND
-                df_sub = df_sub[df_sub['__class_clean__'].str.startswith('FUND')]
-
-                # Agregar
-                base_names.extend(df_sub[names_col].astype(str).tolist())
-                # Usar rótulo limpo FUND (com fallback quando necessário)
-                base_classes.extend(df_sub['__class_clean__'].fillna('').astype(str).tolist())
-                base_professors.extend(df_sub['__professor__'].astype(str).tolist())
-                base_levels.extend(df_sub['__nivel__'].astype(str).tolist())
-
-            # Deduplicar nomes da base por normalização POR TURMA (preserva primeira ocorrência por turma)
-            # Isso evita perder alunos presentes em múltiplas turmas (ex.: FUND-6A e FUND-6B).
-            seen = set()
-            dedup_names = []
-            dedup_classes = []
-            dedup_professors = []
-            dedup_levels = []
-            for i, name in enumerate(base_names):
-                key = comparator.normalize_name(str(name))
-                cls = base_classes[i] if i < len(base_classes) else ''
-                comp_key = (key, cls)
-                if comp_key not in seen:
-                    seen.add(comp_key)
-                    dedup_names.append(name)
-                    dedup_classes.append(cls)
-                    dedup_professors.append(base_professors[i] if i < len(base_professors) else '')
-                    dedup_levels.append(base_levels[i] if i < len(base_levels) else '')
-            base_names = dedup_names
-            base_classes = dedup_classes
-            base_professors = dedup_professors
-            base_levels = dedup_levels
-
-            # Obter nomes TOEFL e mapear métricas por linha
-            if column2 and column2 in df2.columns:
-                df2_name_col = column2
+            except Exception as e:
+                log_matching.warning("Pool de processos indisponível (%s); pontuando em série", e)
+        if all_tops is None and not stream_toefl:
+            matrix_scorer = NameMatrixScorer(
+                comparator, base_prepared, algorithm, workers=app.config['MATCH_CDIST_WORKERS']
+            )
+            candidate_index = None
+            if blocking_options is not None:
+                candidate_index = roster.candidate_index(blocking_options, comparator.stopwords)
+            all_tops = match_top_k(
+                comparator, matrix_scorer, names_to_score,
+                candidate_index=candidate_index, progress=score_progress, **match_options
+            )
+            timer.counters.update(matrix_scorer.calls)
+        if not stream_toefl:
+            timer.lap('matching', rows_in=len(names_to_score), rows_out=len(all_tops))
+            if cache_key is not None:
+                all_tops = store_scored_tops(match_cache, *cache_key, keys, known, missing, all_tops)
+                timer.lap('match_cache_store', rows_in=len(missing), rows_out=len(all_tops))
+            packed_tops.append(MatchOutcomes.pack(all_tops, top_k))
+        outcomes = MatchOutcomes.from_packed(
+            toefl_names, packed_tops, top_k, base_names, base_classes, base_professors, base_levels
+        )
+        
+        if stream_toefl:
+            # Última linha de cada nome vale, como na leitura inteira
+            if metric_tables:
+                toefl_metrics = pd.concat(metric_tables, ignore_index=True).drop_duplicates('__key__', keep='last')
             else:
-                # Preferir coluna chamada exatamente 'NOME' quando existir
-                df2_name_col = None
-                for col in df2.columns:
-                    if comparator.normalize_name(str(col)) == 'nome':
-                        df2_name_col = col
-                        break
-                if df2_name_col is None:
-                    df2_name_col = df2.columns[0]
-            toefl_names = df2[df2_name_col].dropna().astype(str).tolist()
+                toefl_metrics = pd.DataFrame(columns=['__key__'] + TOEFL_METRIC_KEYS)
+            log_matching.log(
+                sheet_log_level, "base names=%d toefl names=%d threshold=%s algorithm=%s (csv em blocos: %d)",
+                len(base_names), len(toefl_names), threshold, algorithm, len(metric_tables)
+            )
+        timer.lap('collect_outcomes', rows_out=len(outcomes))
+        log_summary.update(base_names=len(base_names), toefl_names=len(toefl_names))
+        if cache_key is not None:
+            log_summary['match_cache'] = {'hits': cache_stats['hits'], 'scored': cache_stats['scored']}
+
+        # Métricas TOEFL de cada nome num único merge; encontrados e não encontrados usam a mesma tabela
+        toefl_metrics_by_name = toefl_metrics_by_names(toefl_metrics, toefl_names, comparator.normalize_name)
+        timer.lap('metrics_lookup', rows_in=len(toefl_names), rows_out=len(toefl_metrics_by_name))
+        classified = outcomes.classify(threshold, toefl_metrics_by_name, default_school_label, include_diagnostics)
+        timer.lap('classify', rows_in=len(outcomes), rows_out=classified['statistics']['matched'])
+
+        if progress:
+            progress(len(toefl_names), len(toefl_names))
+
+        # /export?result_id= e /results/<id>/reclassify reaproveitam o que foi guardado aqui
+        result_id = store_comparison_result(
+            data.get('dataset_id'), default_school_label, threshold, outcomes, toefl_metrics_by_name, classified
+        )
+        timer.lap('store_result')
+
+        # Calcular estatísticas
+        statistics = classified['statistics']
+        total_toefl = statistics['total_toefl']
+        matched_count = statistics['matched']
+        match_percentage = statistics['match_percentage']
+        log_matching.log(
+            sheet_log_level, "matched=%d/%d (%s%%)", matched_count, total_toefl, round(match_percentage, 2)
+        )
+        if matched_count == 0:
+            log_matching.warning("Nenhuma correspondência acima do limiar. Sugestões: reduzir limiar para 60–70; testar algoritmo 'token_set_ratio'; confirmar colunas de nomes.")
+        if aggregate_logs:
+            log_summary.update(
+                matched=matched_count,
+                match_percentage=round(match_percentage, 2),
+                class_origins=dict(origin_counts),
+                class_origin_events_suppressed=origin_log.suppressed,
+                stage_seconds=timer.stage_seconds(),
+            )
+            log_matching.info(
+                "compare summary %s", json.dumps(log_summary, ensure_ascii=False, default=str),
+                extra={'summary': log_summary}
+            )
+        
+        response = {'success': True, 'result_id': result_id}
+        response.update(classified)
+        return response
+        
+    except Exception as e:
+        return {'success': False, 'error': f'Erro ao processar planilhas: {str(e)}'}
+
+@app.route('/compare', methods=['POST'])
+def compare_names():
+    try:
+        data = request.get_json() or {}
+        profile = None
+        if profile_requested(data):
+            if not admin_authorized():
+                return jsonify({'success': False, 'error': 'Perfil de requisição restrito a administradores'}), 403
+            profile = RequestProfile('compare', dataset_id=data.get('dataset_id'), roster_id=data.get('roster_id'))
+        # Modo síncrono (compatível com clientes antigos): processar e responder na mesma requisição
+        if not request_flag(data.get('async', app.config['COMPARE_ASYNC'])):
+            return jsonify(run_comparison(data, profile=profile))
+
+        # Validar o dataset antes de enfileirar, para o erro voltar imediatamente
+        workspace = get_workspace(data.get('dataset_id'))
+        if data.get('roster_id') and roster_registry.info(data['roster_id']) is None:
+            return jsonify({'success': False, 'error': 'Roster não encontrado. Registre a planilha base novamente.'})
+        has_base = bool(data.get('roster_id')) or (workspace and find_workspace_file(workspace, 'file1')[0])
+        if not workspace or not has_base or not find_workspace_file(workspace, 'file2')[0]:
+            return jsonify({'success': False, 'error': 'Arquivos não encontrados. Faça o upload novamente.'})
+
+        job_id = submit_job(partial(run_comparison, profile=profile), data)
+        if job_id is None:
+            return jsonify({'success': False, 'error': 'Servidor ocupado: muitas comparações na fila. Tente novamente em instantes.'}), 503
+        response = {'success': True, 'job_id': job_id, 'status': 'queued'}
+        if profile is not None:
+            # O perfil é gravado quando o job termina (também em `result.profile` de GET /jobs/<id>)
+            response['profile_id'] = profile.profile_id
+        return jsonify(response), 202
 
-            # Mapa de colunas TOEFL para extração de métricas
-            toefl_colmap = build_toefl_columns_map(df2.columns, comparator.normalize_name)
-            # Índice de linhas por nome normalizado
-            df2_index_by_name = {}
-            for _, row in df2.iterrows():
-                nm = str(row[df2_name_col]) if df2_name_col in row else ''
-                key = comparator.normalize_name(nm)
-                if key:
-                    df2_index_by_name[key] = row
-            
-            
-        # Perform comparison
-            results = []
-            suggestions = []
-            # Amostras de diagnóstico: primeiros 5 itens
-            debug_limit = 5
-            print(f"[DEBUG] Base nomes: {len(base_names)} | TOEFL nomes: {len(toefl_names)} | threshold={threshold} | algorithm={algorithm}")
-            for i, toefl_name in enumerate(toefl_names):
-                best_match = None
-                best_score = 0
-                best_class = ''
-                best_professor = ''
-                best_nivel = ''
-                cand_scores = []
-                
-                for j, base_name in enumerate(base_names):
-                    # Compare TOEFL name with base name
-                    score = comparator.compare_names(toefl_name, base_name, algorithm)
-                    # Collect candidate scores for suggestions
-                    cand_scores.append((
-                        base_name,
-                        base_classes[j] if j < len(base_classes) else '',
-                        base_professors[j] if j < len(base_professors) else '',
-                        base_levels[j] if j < len(base_levels) else '',
-                        score
-                    ))
-                    
-                    if score >= threshold and score > best_score:
-                        best_match = base_name
-                        best_score = score
-                        best_class = base_classes[j] if j < len(base_classes) else ''
-                        best_professor = base_professors[j] if j < len(base_professors) else ''
-                        best_nivel = base_levels[j] if j < len(base_levels) else ''
-                
-                # Log diagnóstico para os primeiros itens
-                if i < debug_limit:
-                    # Mesmo se não atingir o limiar, recalcula melhor absoluto para entender proximidade
-                    abs_best_score = 0
-                    abs_best_match = None
-                    abs_best_class = ''
-                    for j, base_name in enumerate(base_names):
-                        s = comparator.compare_names(toefl_name, base_name, algorithm)
-                        if s > abs_best_score:
-                            abs_best_score = s
-                            abs_best_match = base_name
-                            abs_best_class = base_classes[j] if j < len(base_classes) else ''
-                    print(f"[DEBUG] TOEFL='{toefl_name}' | best_above_threshold={best_score} | abs_best={abs_best_score} -> '{abs_best_match}' turma='{abs_best_class}'")
-
-                if best_match:
-                    # Extrair métricas TOEFL da linha correspondente
-                    row = df2_index_by_name.get(comparator.normalize_name(toefl_name))
-                    metrics = {}
-                    if row is not None:
-                        def getv(key):
-                            col = toefl_colmap.get(key)
-                            return (row[col] if col in row else None) if col else None
-                        def san(v):
-                            try:
-                                return None if pd.isna(v) else v
-                            except Exception:
-                                return v if v is not None else None
-                        metrics = {
-                            'listening': san(getv('listening')),
-                            'listening_cerf': san(getv('listening_cerf')),
-                            'lfm': san(getv('lfm')),
-                            'lfm_cerf': san(getv('lfm_cerf')),
-                            'reading': san(getv('reading')),
-                            'reading_cerf': san(getv('reading_cerf')),
-                            'lexil': san(getv('lexil')),
-                            'osl': san(getv('osl')),
-                            'total': san(getv('total')),
-                            'cerf_geral': san(getv('cerf_geral')),
-                        }
-                    cerf_geral = compute_cerf_geral(metrics)
-                    # Listening CSA com base na turma encontrada; se ausente, usar seleção do usuário
-                    fallback_label = None if (default_school_label is None or str(default_school_label).strip().lower() == 'auto') else default_school_label
-                    effective_label = best_class if (best_class and str(best_class).strip()) else fallback_label
-                    csa = compute_listening_csa(effective_label, metrics.get('listening'))
-
-                    results.append({
-                        'toefl_name': toefl_name,
-                        'matched_name': best_match,
-                        'class': best_class,
-                        'professor': best_professor,
-                        'nivel': normalize_nivel_display(best_nivel),
-                        'score': round(best_score, 2),
-                        # métricas TOEFL para exportação final
-                        'listening': metrics.get('listening'),
-                        'listening_cerf': metrics.get('listening_cerf'),
-                        'listening_csa': csa.get('points'),
-                        'lfm': metrics.get('lfm'),
-                        'lfm_cerf': metrics.get('lfm_cerf'),
-                        'reading': metrics.get('reading'),
-                        'reading_cerf': metrics.get('reading_cerf'),
-                        'lexil': metrics.get('lexil'),
-                        'osl': metrics.get('osl'),
-                        'total': metrics.get('total'),
-                        'cerf_geral': cerf_geral
-                    })
-                else:
-                    # Build suggestions (top 3 by score) when no match above threshold
-                    if cand_scores:
-                        cand_scores.sort(key=lambda x: x[4], reverse=True)
-                        top = cand_scores[:3]
-                        suggestions.append({
-                            'toefl_name': toefl_name,
-                            'candidates': [
-                                {
-                                    'name': n,
-                                    'class': c,
-                                    'professor': p,
-                                    'nivel': normalize_nivel_display(None if pd.isna(lv) else lv),
-                                    'score': round(s, 2)
-                                } for (n, c, p, lv, s) in top
-                            ]
-                        })
-            
-            # Calcular lista de não encontrados
-            matched_toefl_set = set([r['toefl_name'] for r in results])
-            unmatched_list = [name for name in toefl_names if name not in matched_toefl_set]
-
-            # Calcular estatísticas
-            total_toefl = len(toefl_names)
-            matched_count = len(results)
-            unmatched_count = total_toefl - matched_count
-            match_percentage = (matched_count / total_toefl * 100) if total_toefl > 0 else 0
-            print(f"[DEBUG] matched={matched_count}/{total_toefl} ({round(match_percentage,2)}%)")
-            if matched_count == 0:
-                print("[DEBUG] Nenhuma correspondência acima do limiar. Sugestões: reduzir limiar para 60–70; testar algoritmo 'token_set_ratio'; confirmar colunas de nomes.")
-            
-            return jsonify({
-                'success': True,
-                'results': results,
-                'unmatched_list': unmatched_list,
-                'suggestions': suggestions,
-                'statistics': {
-                    'total_toefl': total_toefl,
-                    'matched': matched_count,
-                    'unmatched': unmatched_count,
-                    'match_percentage': round(match_percentage, 2)
-                }
-            })
-            
-        except Exception as e:
-            return jsonify({'success': False, 'error': f'Erro ao processar planilhas: {str(e)}'})
-            
     except Exception as e:
         return jsonify({'success': False, 'error': f'Erro na comparação: {str(e)}'})
 
-@app.route('/export', methods=['POST'])
+@app.route('/jobs/<job_id>', methods=['GET'])
+def get_job(job_id):
+    job = job_store.get(job_id)
+    if job is None:
+        return jsonify({'success': False, 'error': 'Job não encontrado ou expirado'}), 404
+    response = {
+        'success': job['status'] != 'error',
+        'job_id': job_id,
+        'status': job['status'],
+        'progress': job_progress(job),
+    }
+    if job['status'] == 'done':
+        response['result'] = job['result']
+    elif job['status'] == 'error':
+        response['error'] = job['error']
+    return jsonify(response)
+
+@app.route('/results/<result_id>/reclassify', methods=['POST'])
+def reclassify_result(result_id):
+    """Classify a stored comparison again for a new threshold, without rescoring."""
+    data = request.get_json(silent=True) or {}
+    record = result_store.get(result_id)
+    if record is None:
+        return jsonify({'success': False, 'error': 'Resultado não encontrado ou expirado. Execute a comparação novamente.'}), 404
+    if record.get('outcomes') is None:
+        return jsonify({'success': False, 'error': 'Resultado sem candidatos guardados. Execute a comparação novamente.'}), 409
+    try:
+        threshold = float(data.get('threshold', record['threshold']))  # threshold em escala 0-100
+    except (TypeError, ValueError):
+        return jsonify({'success': False, 'error': 'Limiar inválido'}), 400
+    default_school_label = data.get('default_school_label', record['default_school_label'])
+    include_diagnostics = request_flag(data.get('diagnostics', app.config['MATCH_DIAGNOSTICS']))
+
+    # Só a separação por limiar é refeita; o novo result_id serve o /export com o novo limiar
+    classified = record['outcomes'].classify(
+        threshold, record['toefl_metrics'], default_school_label, include_diagnostics
+    )
+    new_result_id = store_comparison_result(
+        record['dataset_id'], default_school_label, threshold, record['outcomes'], record['toefl_metrics'], classified
+    )
+    log_matching.debug(
+        "reclassify %s -> %s threshold=%s matched=%d/%d", result_id, new_result_id, threshold,
+        classified['statistics']['matched'], classified['statistics']['total_toefl']
+    )
+    response = {'success': True, 'result_id': new_result_id, 'threshold': threshold}
+    response.update(classified)
+    return jsonify(response)
+
+@app.route('/export', methods=['GET', 'POST'])
 def export_results():
+    # Etapas cronometradas para /metrics desde a validação, para que exports rejeitados também contem
+    # como 'error'; com timings=1 as etapas vão também no cabeçalho Server-Timing
+    timer = StageTimer('export')
+    profile = None
+
+    def reject(message, status):
+        timer.finish('error')
+        return jsonify({'error': message}), status
+
     try:
-        data = request.get_json()
-        results = data.get('results', [])
-        unmatched = data.get('unmatched_list', [])
-        default_school_label = data.get('default_school_label')
-        
-        # Criar DataFrame para exportação com os campos exigidos
-        export_rows = []
-        for r in results:
-            export_rows.append({
-                'NOME': r.get('toefl_name', ''),
-                'NOME ENCONTRADO': r.get('matched_name', ''),
-                'TURMA': r.get('class', ''),
-                'PROFESSOR': r.get('professor', ''),
-                'NÍVEL': r.get('nivel', ''),
-                'LISTENING': r.get('listening', ''),
-                'LISTENING CERF': r.get('listening_cerf', ''),
-                'LISTENING CSA': r.get('listening_csa', ''),
-                'LFM': r.get('lfm', ''),
-                'LFM CERF': r.get('lfm_cerf', ''),
-                'READING': r.get('reading', ''),
-                'READING CERF': r.get('reading_cerf', ''),
-                'LEXIL': r.get('lexil', ''),
-                'OSL': r.get('osl', ''),
-                'TOTAL': r.get('total', ''),
-                'CERF GERAL': r.get('cerf_geral', '')
-            })
-
-        # Acrescentar os não encontrados com suas pontuações da planilha TOEFL
-        if unmatched:
-            # Localizar o arquivo de TOEFL enviado
-            def find_uploaded_file(base_name):
-                for ext in ['.xlsx', '.xls', '.csv']:
-                    path = os.path.join(app.config['UPLOAD_FOLDER'], f'{base_name}{ext}')
-                    if os.path.exists(path):
-                        return path, ext
-                return None, None
-
-            file2_path, ext2 = find_uploaded_file('file2')
-            if file2_path:
-                df2 = pd.read_excel(file2_path) if ext2 in ['.xlsx', '.xls'] else pd.read_csv(file2_path)
-                comparator = NameComparator()
-                toefl_colmap = build_toefl_columns_map(df2.columns, comparator.normalize_name)
-                # Detectar coluna de nome preferindo 'NOME'
-                df2_name_col = None
-                for col in df2.columns:
-                    if comparator.normalize_name(str(col)) == 'nome':
-                        df2_name_col = col
-                        break
-                if df2_name_col is None:
-                    df2_name_col = df2.columns[0]
-                # Índice por nome normalizado
-                df2_index_by_name = {}
-                for _, row in df2.iterrows():
-                    nm = str(row[df2_name_col]) if df2_name_col in row else ''
-                    key = comparator.normalize_name(nm)
-                    if key:
-                        df2_index_by_name[key] = row
-
-                def san(v):
-                    try:
-                        return None if pd.isna(v) else v
-                    except Exception:
-                        return v if v is not None else None
-
-                for nm in unmatched:
-                    row = df2_index_by_name.get(comparator.normalize_name(nm))
-                    metrics = {}
-                    if row is not None:
-                        def getv(key):
-                            col = toefl_colmap.get(key)
-                            return (row[col] if col in row else None) if col else None
-                        metrics = {
-                            'listening': san(getv('listening')),
-                            'listening_cerf': san(getv('listening_cerf')),
-                            'lfm': san(getv('lfm')),
-                            'lfm_cerf': san(getv('lfm_cerf')),
-                            'reading': san(getv('reading')),
-                            'reading_cerf': san(getv('reading_cerf')),
-                            'lexil': san(getv('lexil')),
-                            'osl': san(getv('osl')),
-                            'total': san(getv('total')),
-                            'cerf_geral': san(getv('cerf_geral')),
-                        }
-                    cerf_geral = compute_cerf_geral(metrics)
-                    # Para não encontrados, calcular Listening CSA usando ano selecionado (ou 9.1 se "auto")
-                    fallback_label = '9.1' if (default_school_label is None or str(default_school_label).strip().lower() == 'auto') else default_school_label
-                    csa_unmatched = compute_listening_csa(fallback_label, metrics.get('listening')) if metrics else {'points': ''}
-
-                    export_rows.append({
-                        'NOME': nm,
-                        'NOME ENCONTRADO': '',
-                        'TURMA': '',
-                        'PROFESSOR': '',
-                        'NÍVEL': '',
-                        'LISTENING': metrics.get('listening', ''),
-                        'LISTENING CERF': metrics.get('listening_cerf', ''),
-                        'LISTENING CSA': csa_unmatched.get('points', ''),
-                        'LFM': metrics.get('lfm', ''),
-                        'LFM CERF': metrics.get('lfm_cerf', ''),
-                        'READING': metrics.get('reading', ''),
-                        'READING CERF': metrics.get('reading_cerf', ''),
-                        'LEXIL': metrics.get('lexil', ''),
-                        'OSL': metrics.get('osl', ''),
-                        'TOTAL': metrics.get('total', ''),
-                        'CERF GERAL': cerf_geral
-                    })
-
-        df_export = pd.DataFrame(export_rows)
-        # Diagnóstico: logar colunas geradas e contagem de linhas
+        data = request.get_json(silent=True) or {}
+        result_id = request.args.get('result_id') or data.get('result_id')
+        default_school_label = request.args.get('default_school_label', data.get('default_school_label'))
+        export_format = str(request.args.get('format') or data.get('format') or 'xlsx').strip().lower()
+        if export_format not in EXPORT_FORMATS:
+            return reject(f'Formato de exportação inválido: {export_format}. Use: {", ".join(EXPORT_FORMATS)}', 400)
+        if export_format == 'parquet' and pa is None:
+            return reject('Exportação em Parquet requer o pacote pyarrow (pip install pyarrow)', 400)
+        want_timings = request_flag(request.args.get('timings', data.get('timings')))
+        if profile_requested(data):
+            if not admin_authorized():
+                return reject('Perfil de requisição restrito a administradores', 403)
+            profile = RequestProfile('export', result_id=result_id, format=export_format)
+            profile.enable()
+
+        if result_id:
+            # Resultado guardado por /compare: encontrados e não encontrados já vêm com as métricas TOEFL
+            stored = result_store.get(result_id)
+            if stored is None:
+                if profile is not None:
+                    profile.save('not_found')
+                return reject('Resultado não encontrado ou expirado. Execute a comparação novamente.', 404)
+            if default_school_label is None:
+                default_school_label = stored['default_school_label']
+            export_rows = iter_export_rows(stored['results'], stored['unmatched'], default_school_label)
+        else:
+            # Modo legado: resultados enviados no corpo; métricas dos não encontrados relidas da planilha TOEFL
+            results = data.get('results', [])
+            unmatched = data.get('unmatched_list', [])
+            unmatched_rows = []
+            if unmatched:
+                # Localizar o arquivo de TOEFL enviado no workspace do upload
+                workspace = get_workspace(data.get('dataset_id'))
+                file2_path, ext2 = find_workspace_file(workspace, 'file2') if workspace else (None, None)
+                if file2_path:
+                    df2 = dataset_cache.get_first_sheet(file2_path, ext2)
+                    comparator = NameComparator()
+                    # Detectar coluna de nome preferindo 'NOME'
+                    df2_name_col = resolve_toefl_name_column(df2.columns, None, comparator.normalize_name)
+                    # Métricas de todos os não encontrados num único merge por nome normalizado
+                    toefl_metrics = build_toefl_metrics_table(df2, df2_name_col, comparator.normalize_name)
+                    found, metric_columns = lookup_toefl_metrics(toefl_metrics, unmatched, comparator.normalize_name)
+                    unmatched_rows = [
+                        (nm, toefl_metrics_row(found, metric_columns, i)) for i, nm in enumerate(unmatched)
+                    ]
+            export_rows = iter_export_rows(results, unmatched_rows, default_school_label)
+        timer.lap('load_result')
+
+        mimetype, extension = EXPORT_FORMATS[export_format]
+        download_name = f'comparacao_nomes_{datetime.now().strftime("%Y%m%d_%H%M%S")}.{extension}'
+        batch_rows = app.config['EXPORT_BATCH_ROWS']
+
+        if export_format in ('csv', 'ndjson'):
+            # Formatos de texto: gerados e enviados em blocos, sem arquivo temporário
+            chunks = iter_export_csv(export_rows, batch_rows) if export_format == 'csv' else iter_export_ndjson(export_rows, batch_rows)
+            headers = {'Content-Disposition': f'attachment; filename={download_name}'}
+            if want_timings:
+                # Só as etapas anteriores ao corpo; a geração em streaming vai para /metrics ao terminar
+                headers['Server-Timing'] = timer.server_timing()
+            if profile is not None:
+                # Perfil gravado ao fim do envio do corpo
+                profile.disable()
+                headers['X-Profile-Id'] = profile.profile_id
+            return Response(
+                _log_streamed_export(chunks, export_format, timer, profile),
+                mimetype=mimetype,
+                headers=headers,
+            )
+
+        # Escrever o arquivo linha a linha num temporário (memória constante) e enviá-lo em blocos
+        fd, export_path = tempfile.mkstemp(suffix=f'.{extension}', prefix='export_')
+        os.close(fd)
         try:
-            print('[EXPORT DEBUG] Colunas:', list(df_export.columns))
-            print('[EXPORT DEBUG] Linhas:', len(df_export))
-        except Exception as _e:
-            pass
-        
-        # Criar arquivo Excel em memória
-        output = io.BytesIO()
-        with pd.ExcelWriter(output, engine='openpyxl') as writer:
-            # Escrever resultados
-            sheet_name = 'Resultados_Comparacao'
-            df_export.to_excel(writer, sheet_name=sheet_name, index=False)
-
-            # Não é necessário escrever seção separada; não encontrados já foram incluídos
-        
-        output.seek(0)
-        
-        return send_file(
-            output,
-            mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
-            as_attachment=True,
-            download_name=f'comparacao_nomes_{datetime.now().strftime("%Y%m%d_%H%M%S")}.xlsx'
+            if export_format == 'parquet':
+                row_count = write_export_parquet(export_rows, export_path, batch_rows)
+            else:
+                row_count = write_export_xlsx(export_rows, export_path)
+            size = os.path.getsize(export_path)
+        except Exception:
+            os.remove(export_path)
+            raise
+        timer.lap(f'write_{export_format}', rows_out=row_count)
+        timer.finish('ok')
+        # Diagnóstico: logar colunas geradas e contagem de linhas
+        log_export.info("export format=%s columns=%s rows=%d bytes=%d", export_format, EXPORT_COLUMNS, row_count, size)
+
+        headers = {
+            'Content-Disposition': f'attachment; filename={download_name}',
+            'Content-Length': str(size),
+        }
+        if want_timings:
+            headers['Server-Timing'] = timer.server_timing()
+        if profile is not None:
+            profile_info = profile.save('ok', rows=row_count, export_bytes=size)
+            if profile_info['profile_id']:
+                headers['X-Profile-Id'] = profile_info['profile_id']
+        response = Response(
+            stream_file(export_path, app.config['EXPORT_STREAM_CHUNK_SIZE']),
+            mimetype=mimetype,
+            headers=headers,
         )
-        
+        # Remoção no fechamento da resposta: o servidor WSGI sempre fecha a resposta, mesmo quando o corpo
+        # não é lido (HEAD, cliente que desconecta antes do primeiro bloco); o finally de um gerador que
+        # nunca começou não rodaria
+        response.call_on_close(partial(remove_file_quietly, export_path))
+        return response
+
     except Exception as e:
+        timer.finish('error')
+        if profile is not None:
+            profile.save('error', error=str(e))
         return jsonify({'error': f'Erro na exportação: {str(e)}'}), 500
 
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    # Histogramas acumulados por etapa (formato texto do Prometheus), por processo
+    if not app.config['METRICS_ENABLED']:
+        return jsonify({'error': 'Métricas desabilitadas'}), 404
+    return Response(stage_metrics.render(), mimetype='text/plain; version=0.0.4')
+
+@app.route('/profiles', methods=['GET'])
+def list_profiles():
+    if not admin_authorized():
+        return jsonify({'success': False, 'error': 'Acesso restrito a administradores'}), 403
+    return jsonify({'success': True, 'profiles': profile_store.list()})
+
+@app.route('/profiles/<profile_id>', methods=['GET'])
+def download_profile(profile_id):
+    """Download a capture as ``.pstats`` or, with ``format=text``, as a pstats report."""
+    if not admin_authorized():
+        return jsonify({'success': False, 'error': 'Acesso restrito a administradores'}), 403
+    path = profile_store.path(profile_id)
+    if path is None or not os.path.exists(path):
+        return jsonify({'success': False, 'error': 'Perfil não encontrado ou já descartado'}), 404
+    if request.args.get('format') == 'text':
+        # Relatório legível direto no navegador/curl: as funções mais caras pela ordenação pedida
+        sort = request.args.get('sort', 'cumulative')
+        if sort not in PROFILE_SORT_KEYS:
+            return jsonify({'success': False, 'error': f'Ordenação inválida: {sort}. Use: {", ".join(PROFILE_SORT_KEYS)}'}), 400
+        try:
+            limit = max(1, int(request.args.get('limit', 40)))
+        except ValueError:
+            return jsonify({'success': False, 'error': 'limit inválido'}), 400
+        report = io.StringIO()
+        pstats.Stats(path, stream=report).strip_dirs().sort_stats(sort).print_stats(limit)
+        return Response(report.getvalue(), mimetype='text/plain')
+    with open(path, 'rb') as f:
+        content = f.read()
+    return Response(
+        content,
+        mimetype='application/octet-stream',
+        headers={'Content-Disposition': f'attachment; filename={profile_id}.pstats'},
+    )
+
 if __name__ == '__main__':
     app.run(debug=True, host='0.0.0.0', port=int(os.environ.get('PORT', 5001)))
\ No newline at end of file
@@ -0,0 +1,101 @@
+"""Micro-benchmark for NameComparator.normalize_name.
+
+Compares the current implementation (NFD decomposition, precompiled
+pattern, LRU memo) with the previous one (dict of str.replace calls plus an
+uncompiled re.sub). That both produce the same output is checked by
+tests/test_normalize_name.py.
+
+Run from the repository root:
+
+    python benchmarks/bench_normalize.py [--names 20000] [--repeat 5]
+"""
+import argparse
+import os
+import random
+import re
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pandas as pd  # noqa: E402
+
+from app import NameComparator, _normalize_name_cached  # noqa: E402
+
+def legacy_normalize_name(name):
+    """normalize_name as it was before the NFD/LRU rework."""
+    if pd.isna(name):
+        return ""
+    name = str(name).strip()
+    name = ' '.join(name.split()).lower()
+    replacements = {
+        'á': 'a', 'à': 'a', 'ã': 'a', 'â': 'a',
+        'é': 'e', 'ê': 'e',
+        'í': 'i',
+        'ó': 'o', 'ô': 'o', 'õ': 'o',
+        'ú': 'u', 'ü': 'u',
+        'ç': 'c'
+    }
+    for old, new in replacements.items():
+        name = name.replace(old, new)
+    name = re.sub(r'[^\w\s,]', '', name)
+    return name
+
+
+FIRST_NAMES = ['João', 'Maria', 'José', 'Ana', 'Antônio', 'Francisca', 'Carlos', 'Paula', 'Luís', 'Fernanda',
+               'Gabriel', 'Júlia', 'Lucas', 'Beatriz', 'Mateus', 'Clara', 'Pedro', 'Luíza', 'Rafael', 'Helena']
+LAST_NAMES = ['Silva', 'Santos', 'Oliveira', 'Souza', 'Rodrigues', 'Ferreira', 'Alves', 'Pereira', 'Lima', 'Gomes',
+              'Ribeiro', 'Carvalho', 'Araújo', 'Conceição', 'Gonçalves', 'Assunção', 'Nóbrega', 'Brandão']
+
+
+def portuguese_names(count, seed=42):
+    # Nomes realistas, metade no formato TOEFL ("SOBRENOME, NOME") em maiúsculas
+    rng = random.Random(seed)
+    names = []
+    for _ in range(count):
+        first = rng.sample(FIRST_NAMES, rng.randint(1, 2))
+        last = rng.sample(LAST_NAMES, rng.randint(1, 2))
+        if rng.random() < 0.5:
+            names.append(f"{last[-1].upper()}, {' '.join(first).upper()}")
+        else:
+            names.append(' '.join(first + (['de'] if rng.random() < 0.3 else []) + last))
+    return names
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--names', type=int, default=20000)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    names = portuguese_names(args.names)
+
+    comparator = NameComparator()
+
+    def run_legacy():
+        for n in names:
+            legacy_normalize_name(n)
+
+    def run_uncached():
+        _normalize_name_cached.cache_clear()
+        for n in names:
+            comparator.normalize_name(n)
+
+    def run_cached():
+        for n in names:
+            comparator.normalize_name(n)
+
+    run_cached()  # aquece o memo para a medição com entradas repetidas
+    timings = {
+        'legacy': min(timeit.repeat(run_legacy, number=1, repeat=args.repeat)),
+        'new (cold cache)': min(timeit.repeat(run_uncached, number=1, repeat=args.repeat)),
+        'new (repeated inputs)': min(timeit.repeat(run_cached, number=1, repeat=args.repeat)),
+    }
+    base = timings['legacy']
+    for label, seconds in timings.items():
+        per_call = seconds / len(names) * 1e6
+        print(f'{label:<24} {seconds * 1000:9.1f} ms  {per_call:6.2f} us/name  {base / seconds:5.1f}x')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,310 @@
+"""Benchmark suite: scoring, matching, class labeling, ingestion and export at growing roster sizes.
+
+Every dataset comes from synthetic_names.py with a fixed seed, so two runs on
+the same machine measure the same work. For each roster size (1k/5k/20k
+students by default) it reports wall time, throughput and peak traced
+memory (tracemalloc, in a separate run so tracing does not skew the timing)
+of:
+
+    pair_scoring     NameComparator.compare_names over fixed (TOEFL, base) pairs
+    labeling         prepare_base_roster: column detection, extracurricular filter, FUND labels, dedup
+    upload_preview   read_sheet_preview of the base workbook (what /upload reads)
+    parse_workbook   full parse of the base workbook (DatasetCache, cold)
+    matrix_full      match_top_k of --matrix-names TOEFL names against the whole roster
+    matrix_blocked   the same names through the blocking candidate index
+    classify         MatchOutcomes.classify of one TOEFL name per student (threshold split)
+    export_xlsx      GET /export?format=xlsx of that classified result
+    export_csv       GET /export?format=csv of that classified result
+    compare_route    POST /upload + synchronous POST /compare of --compare-rows TOEFL rows
+
+Scoring a full 20k x 20k matrix takes minutes, so the matching benchmarks
+score a fixed sample of TOEFL names; throughput is reported in pairs/s for
+the full scan and names/s for the blocked one. Save a run with --save and
+pass it as --baseline on a later run: any benchmark slower (or using more
+memory) than the baseline by more than --tolerance is flagged and the
+script exits with status 1.
+
+Run from the repository root:
+
+    python benchmarks/bench_suite.py [--sizes 1000 5000 20000] [--only matrix_full,export_csv]
+                                     [--save bench.json] [--baseline bench.json --tolerance 0.25]
+"""
+import argparse
+import gc
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_ROOT)
+
+import pandas as pd  # noqa: E402
+
+import synthetic_names  # noqa: E402
+
+BENCHMARKS = [
+    'pair_scoring', 'labeling', 'upload_preview', 'parse_workbook', 'matrix_full', 'matrix_blocked',
+    'classify', 'export_xlsx', 'export_csv', 'compare_route',
+]
+
+
+def measure(func, repeat, max_seconds, trace_memory):
+    """Best wall time over up to ``repeat`` runs (stopping once ``max_seconds`` is spent) and peak MiB."""
+    timings = []
+    started = time.perf_counter()
+    for _ in range(repeat):
+        gc.collect()
+        t0 = time.perf_counter()
+        func()
+        timings.append(time.perf_counter() - t0)
+        if time.perf_counter() - started >= max_seconds:
+            break
+    peak = None
+    if trace_memory:
+        gc.collect()
+        tracemalloc.start()
+        try:
+            func()
+            peak = tracemalloc.get_traced_memory()[1] / (1024 * 1024)
+        finally:
+            tracemalloc.stop()
+    return min(timings), peak
+
+
+class Dataset:
+    """Synthetic roster of ``students`` names with its workbook, prepared roster and TOEFL sheet."""
+
+    def __init__(self, app_module, students, folder, seed):
+        self.students = students
+        self.names = synthetic_names.student_names(students, seed)
+        self.sheets = synthetic_names.base_workbook_sheets(self.names, seed)
+        self.toefl = synthetic_names.toefl_sheet(self.names, students, seed)
+        self.base_path, self.toefl_path = synthetic_names.write_dataset(folder, students, seed=seed)
+        self.comparator = app_module.NameComparator()
+        self.roster = app_module.prepare_base_roster(self.sheets, 'Nome do Aluno', self.comparator)
+
+
+class Suite:
+    """Runs the selected benchmarks for one dataset size and collects their records."""
+
+    def __init__(self, app_module, args, workdir):
+        self.m = app_module
+        self.args = args
+        self.workdir = workdir
+        self.client = app_module.app.test_client()
+        self.records = []
+
+    def run(self, name, size, items, unit, func):
+        if name not in self.args.only:
+            return
+        seconds, peak = measure(func, self.args.repeat, self.args.max_seconds, not self.args.no_memory)
+        record = {
+            'benchmark': name, 'size': size, 'items': items, 'unit': unit,
+            'seconds': round(seconds, 4), 'throughput': round(items / seconds, 1) if seconds else None,
+            'peak_mib': None if peak is None else round(peak, 1),
+        }
+        self.records.append(record)
+        print_record(record, None, flush=True)
+
+    def pair_scoring(self):
+        # Pares fixos (nome TOEFL, nome da base), independentes do tamanho do roster
+        names = synthetic_names.student_names(2000, self.args.seed + 10)
+        rng = random.Random(self.args.seed)
+        pairs = [
+            (synthetic_names.toefl_spelling(rng, rng.choice(names)), rng.choice(names))
+            for _ in range(self.args.pairs)
+        ]
+        comparator = self.m.NameComparator()
+
+        def score_pairs():
+            for toefl_name, base_name in pairs:
+                comparator.compare_names(toefl_name, base_name, self.args.algorithm)
+
+        self.run('pair_scoring', len(pairs), len(pairs), 'pairs', score_pairs)
+
+    def dataset_benchmarks(self, data):
+        m = self.m
+        size = data.students
+        comparator = data.comparator
+        self.run('labeling', size, sum(len(df) for df in data.sheets.values()), 'rows',
+                 lambda: m.prepare_base_roster(data.sheets, 'Nome do Aluno', m.NameComparator()))
+        self.run('upload_preview', size, size, 'rows', lambda: m.read_sheet_preview(data.base_path, '.xlsx'))
+
+        def parse_workbook():
+            folder = tempfile.mkdtemp(dir=self.workdir)
+            m.DatasetCache(folder).get_sheets(data.base_path, '.xlsx')
+            shutil.rmtree(folder, ignore_errors=True)
+
+        self.run('parse_workbook', size, size, 'rows', parse_workbook)
+
+        sample = data.toefl['NOME'].tolist()
+        if self.args.matrix_names:
+            sample = sample[:self.args.matrix_names]
+        scorer = m.NameMatrixScorer(comparator, data.roster.prepared, self.args.algorithm)
+        self.run('matrix_full', size, len(sample) * len(data.roster), 'pairs',
+                 lambda: m.match_top_k(comparator, scorer, sample))
+        candidate_index = data.roster.candidate_index(m.blocking_options_from_config(), comparator.stopwords)
+        self.run('matrix_blocked', size, len(sample), 'names',
+                 lambda: m.match_top_k(comparator, scorer, sample, candidate_index=candidate_index))
+
+        # Resultado com um nome TOEFL por aluno (top-k sorteado), para classificação e exportação
+        rng = random.Random(self.args.seed)
+        toefl_names = data.toefl['NOME'].tolist()
+        tops = [
+            sorted(((rng.randrange(len(data.roster)), rng.uniform(40, 100)) for _ in range(3)), key=lambda t: -t[1])
+            for _ in toefl_names
+        ]
+        roster = data.roster
+        outcomes = m.MatchOutcomes.from_packed(
+            toefl_names, [m.MatchOutcomes.pack(tops, 3)], 3,
+            roster.names, roster.classes, roster.professors, roster.levels,
+        )
+        metrics_table = m.build_toefl_metrics_table(data.toefl, 'NOME', comparator.normalize_name)
+        metrics = m.toefl_metrics_by_names(metrics_table, toefl_names, comparator.normalize_name)
+        self.run('classify', size, len(outcomes), 'names', lambda: outcomes.classify(80, metrics, 'auto'))
+        classified = outcomes.classify(80, metrics, 'auto')
+        result_id = m.store_comparison_result(None, 'auto', 80, outcomes, metrics, classified)
+        for export_format in ('xlsx', 'csv'):
+            def export():
+                response = self.client.get(f'/export?result_id={result_id}&format={export_format}')
+                for _ in response.response:
+                    pass
+                response.close()
+
+            self.run(f'export_{export_format}', size, len(toefl_names), 'rows', export)
+
+        if 'compare_route' in self.args.only:
+            self.compare_route(data)
+
+    def compare_route(self, data):
+        toefl_path = os.path.join(os.path.dirname(data.base_path), 'toefl_compare.csv')
+        data.toefl.head(self.args.compare_rows).to_csv(toefl_path, index=False)
+        client = self.client
+
+        def upload_and_compare():
+            with open(data.base_path, 'rb') as f1, open(toefl_path, 'rb') as f2:
+                upload = client.post('/upload', data={'file1': (f1, 'base.xlsx'), 'file2': (f2, 'toefl.csv')},
+                                     content_type='multipart/form-data').get_json()
+            result = client.post('/compare', json={
+                'dataset_id': upload['dataset_id'], 'column1': 'Nome do Aluno', 'column2': 'NOME',
+                'threshold': 80, 'algorithm': self.args.algorithm, 'async': False, 'match_cache': False,
+            }).get_json()
+            if not result.get('success'):
+                raise RuntimeError(result.get('error'))
+
+        self.run('compare_route', data.students, min(self.args.compare_rows, len(data.toefl)), 'toefl rows',
+                 upload_and_compare)
+
+
+def print_header():
+    print(f"{'benchmark':<16} {'size':>7} {'items':>10} {'unit':<10} {'seconds':>9} {'items/s':>12} "
+          f"{'peak MiB':>9}  vs baseline")
+
+
+def print_record(record, verdict, flush=False):
+    peak = '-' if record['peak_mib'] is None else f"{record['peak_mib']:.1f}"
+    throughput = '-' if record['throughput'] is None else f"{record['throughput']:,.0f}"
+    print(f"{record['benchmark']:<16} {record['size']:>7} {record['items']:>10} {record['unit']:<10} "
+          f"{record['seconds']:>9.3f} {throughput:>12} {peak:>9}  {verdict or ''}", flush=flush)
+
+
+def compare_with_baseline(records, baseline, tolerance):
+    """Print each record against the baseline; returns the number of regressions."""
+    previous = {(r['benchmark'], r['size']): r for r in baseline.get('records', [])}
+    regressions = 0
+    print(f'\nagainst baseline (tolerance {tolerance:.0%}):')
+    print_header()
+    for record in records:
+        old = previous.get((record['benchmark'], record['size']))
+        if old is None:
+            print_record(record, 'new')
+            continue
+        if old['items'] != record['items']:
+            print_record(record, f"not comparable (baseline measured {old['items']} {old['unit']})")
+            continue
+        notes = [f"time {record['seconds'] / old['seconds']:.2f}x" if old['seconds'] else 'time n/a']
+        slower = old['seconds'] and record['seconds'] > old['seconds'] * (1 + tolerance)
+        heavier = False
+        if record['peak_mib'] is not None and old.get('peak_mib'):
+            notes.append(f"mem {record['peak_mib'] / old['peak_mib']:.2f}x")
+            heavier = record['peak_mib'] > old['peak_mib'] * (1 + tolerance)
+        if slower or heavier:
+            regressions += 1
+            notes.append('REGRESSION')
+        print_record(record, ', '.join(notes))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 5000, 20000], help='roster sizes (students)')
+    parser.add_argument('--only', default=','.join(BENCHMARKS), help='comma-separated benchmarks to run')
+    parser.add_argument('--algorithm', default='token_sort_ratio')
+    parser.add_argument('--pairs', type=int, default=20000, help='pairs for pair_scoring')
+    parser.add_argument('--matrix-names', type=int, default=1000,
+                        help='TOEFL names scored per size in matrix_* (0 = one per student)')
+    parser.add_argument('--compare-rows', type=int, default=1000, help='TOEFL rows sent to /compare')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--repeat', type=int, default=3, help='best of N runs per benchmark')
+    parser.add_argument('--max-seconds', type=float, default=10.0, help='stop repeating once this is spent')
+    parser.add_argument('--processes', type=int, default=1, help='MATCH_PROCESSES for compare_route')
+    parser.add_argument('--no-memory', action='store_true', help='skip the tracemalloc run')
+    parser.add_argument('--save', help='write the results to this JSON file')
+    parser.add_argument('--baseline', help='JSON file from an earlier --save to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.25, help='allowed slowdown/memory growth (0.25 = 25%%)')
+    args = parser.parse_args()
+    args.only = {name.strip() for name in args.only.split(',') if name.strip()}
+    unknown = args.only - set(BENCHMARKS)
+    if unknown:
+        parser.error(f"unknown benchmarks: {', '.join(sorted(unknown))} (choose from {', '.join(BENCHMARKS)})")
+    baseline = None
+    if args.baseline:
+        with open(args.baseline, encoding='utf-8') as f:
+            baseline = json.load(f)
+
+    # uploads/, caches e resultados do app ficam num diretório temporário, fora do repositório
+    workdir = tempfile.mkdtemp(prefix='comparar-bench-')
+    cwd = os.getcwd()
+    os.chdir(workdir)
+    try:
+        import app as app_module
+        app_module.app.config.update(MATCH_PROCESSES=args.processes, MATCH_CACHE=False)
+        app_module.app.config['LOG_LEVELS'] = {category: 'WARNING' for category in app_module.app.config['LOG_LEVELS']}
+        app_module.configure_logging()
+
+        suite = Suite(app_module, args, workdir)
+        print(f"algorithm={args.algorithm} seed={args.seed} repeat={args.repeat} "
+              f"memory={'off' if args.no_memory else 'tracemalloc'}")
+        print_header()
+        if 'pair_scoring' in args.only:
+            suite.pair_scoring()
+        for size in args.sizes:
+            data = Dataset(app_module, size, os.path.join(workdir, f'data_{size}'), args.seed)
+            suite.dataset_benchmarks(data)
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    output = {
+        'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': sys.version.split()[0],
+        'pandas': pd.__version__,
+        'options': {k: (sorted(v) if isinstance(v, set) else v) for k, v in vars(args).items()
+                    if k not in ('save', 'baseline')},
+        'records': suite.records,
+    }
+    if args.save:
+        with open(args.save, 'w', encoding='utf-8') as f:
+            json.dump(output, f, indent=1)
+        print(f'saved {len(suite.records)} records to {args.save}')
+    if baseline is not None and compare_with_baseline(suite.records, baseline, args.tolerance):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
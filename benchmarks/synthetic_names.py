@@ -0,0 +1,207 @@
+"""Seeded generator of synthetic school rosters and TOEFL score sheets.
+
+Students get realistic Brazilian names (one or two given names, particles
+like "de/da/dos", one to three surnames, accents). The base workbook has one
+sheet per grade with Nome do Aluno / Turma / Professor / Nível columns, in
+the label formats found in real rosters, plus a few extracurricular rows
+the comparison filters out. The TOEFL sheet lists a sample of those
+students the way the score reports spell them ("SOBRENOME, NOME" in upper
+case, typos, dropped accents, run-together names) mixed with students that
+are not in the roster, and the metric columns of the real export.
+
+The same seed always produces the same files, so timings from different
+commits can be compared. Used by bench_suite.py; it also writes a dataset
+for manual testing:
+
+    python benchmarks/synthetic_names.py --students 5000 --out /tmp/dataset [--toefl-format csv]
+"""
+import argparse
+import os
+import random
+import unicodedata
+
+import pandas as pd
+
+FIRST_NAMES = [
+    'João', 'Maria', 'José', 'Ana', 'Antônio', 'Francisca', 'Carlos', 'Paula', 'Luís', 'Fernanda',
+    'Gabriel', 'Júlia', 'Lucas', 'Beatriz', 'Mateus', 'Clara', 'Pedro', 'Luíza', 'Rafael', 'Helena',
+    'Thaís', 'Caio', 'Letícia', 'Vinícius', 'Lívia', 'Otávio', 'Cecília', 'Davi', 'Sofia', 'Heitor',
+    'Valentina', 'Bernardo', 'Alícia', 'Enzo', 'Isabela', 'Guilherme', 'Lorena', 'Samuel', 'Yasmin', 'Joaquim',
+    'Vitória', 'Henrique', 'Mariana', 'Leônidas', 'Manuela', 'Arthur', 'Giovanna', 'Raí', 'Íris', 'Conceição',
+]
+FIRST_NAME_SET = set(FIRST_NAMES)
+LAST_NAMES = [
+    'Silva', 'Santos', 'Oliveira', 'Souza', 'Rodrigues', 'Ferreira', 'Alves', 'Pereira', 'Lima', 'Gomes',
+    'Ribeiro', 'Carvalho', 'Araújo', 'Conceição', 'Gonçalves', 'Assunção', 'Nóbrega', 'Brandão', 'Magalhães', 'Falcão',
+    'Barbosa', 'Rocha', 'Dias', 'Nascimento', 'Andrade', 'Moreira', 'Nunes', 'Marques', 'Machado', 'Mendes',
+    'Freitas', 'Cardoso', 'Ramos', 'Teixeira', 'Correia', 'Cavalcanti', 'Sá', 'Guimarães', 'Simões', 'Damasceno',
+    'Monteiro', 'Fonseca', 'Albuquerque', 'Peixoto', 'Queiroz', 'Aragão', 'Bastos', 'Uchôa', 'Lins', 'Prado',
+]
+PARTICLES = ['de', 'da', 'do', 'dos', 'das']
+PROFESSORS = ['Ana Paula', 'Carlos T.', 'Márcia Lopes', 'Rogério', 'Prof. Sílvia', 'Teacher John', 'Débora M.']
+GRADES = [6, 7, 8, 9]
+CLASS_LETTERS = 'ABCDEFGH'
+EXTRACURRICULAR = ['Violino', 'Dança 6A', 'Teatro', 'Xadrez', 'Futsal']
+# Formatos de turma encontrados nas planilhas base
+CLASS_FORMATS = [
+    '{grade}º ano {letter}', '{grade}{letter}', '{grade} {letter}', '{grade}º ano - {letter}',
+    'Turma {grade}{letter}', 'FUND {grade}{letter}',
+]
+
+
+def student_name(rng):
+    """One full name: given name(s), optional particle, surname(s)."""
+    parts = rng.sample(FIRST_NAMES, 2 if rng.random() < 0.55 else 1)
+    surnames = rng.sample(LAST_NAMES, rng.choice([1, 2, 2, 3]))
+    if rng.random() < 0.35:
+        surnames.insert(rng.randrange(len(surnames)), rng.choice(PARTICLES))
+    return ' '.join(parts + surnames)
+
+
+def student_names(count, seed=0):
+    """``count`` distinct student names."""
+    rng = random.Random(seed)
+    names = []
+    seen = set()
+    while len(names) < count:
+        name = student_name(rng)
+        if name not in seen:
+            seen.add(name)
+            names.append(name)
+    return names
+
+
+def strip_accents(text):
+    return ''.join(c for c in unicodedata.normalize('NFD', text) if unicodedata.category(c) != 'Mn')
+
+
+def typo(rng, word):
+    """Drop, repeat, swap or replace one inner letter."""
+    if len(word) < 4:
+        return word
+    i = rng.randrange(1, len(word) - 1)
+    kind = rng.randrange(4)
+    if kind == 0:
+        return word[:i] + word[i + 1:]
+    if kind == 1:
+        return word[:i] + word[i] + word[i:]
+    if kind == 2:
+        return word[:i] + word[i + 1] + word[i] + word[i + 2:]
+    return word[:i] + rng.choice('aeiourstnm') + word[i + 1:]
+
+
+def toefl_spelling(rng, name, typo_rate=0.15, concat_rate=0.05):
+    """How a roster name shows up in the TOEFL report."""
+    words = [w for w in name.split() if w not in PARTICLES]
+    given_count = 2 if len(words) > 2 and words[1] in FIRST_NAME_SET else 1
+    given, surnames = words[:given_count], words[given_count:] or words[-1:]
+    if rng.random() < 0.6:
+        # Formato do relatório: "SOBRENOME, NOME [NOME DO MEIO]", às vezes sem o segundo nome
+        shown_given = given if rng.random() < 0.6 else given[:1]
+        spelled = f"{surnames[-1]}, {' '.join(shown_given)}".upper()
+    elif rng.random() < 0.5:
+        spelled = name
+    else:
+        # Sem partículas e sem os sobrenomes do meio
+        spelled = ' '.join(given + surnames[-1:])
+    if rng.random() < 0.3:
+        spelled = strip_accents(spelled)
+    if rng.random() < typo_rate:
+        tokens = spelled.split()
+        k = rng.randrange(len(tokens))
+        tokens[k] = typo(rng, tokens[k])
+        spelled = ' '.join(tokens)
+    if rng.random() < concat_rate:
+        # Nomes colados ("dasilva", "SILVAJOAO")
+        tokens = spelled.replace(',', '').split()
+        if len(tokens) >= 2:
+            k = rng.randrange(len(tokens) - 1)
+            tokens[k:k + 2] = [tokens[k] + tokens[k + 1].lower()]
+        spelled = ' '.join(tokens)
+    return spelled
+
+
+def base_workbook_sheets(students, seed=0, extracurricular_rate=0.03):
+    """Base roster as ``{sheet_name: DataFrame}``, one sheet per grade (6º-9º ano).
+
+    ``students`` is a count or a list of names. A name can appear twice in
+    the same class (duplicate enrollment) and a few rows are extracurricular
+    activities, as in the real spreadsheets.
+    """
+    names = student_names(students, seed) if isinstance(students, int) else list(students)
+    rng = random.Random(seed + 1)
+    rows = {grade: [] for grade in GRADES}
+    for name in names:
+        grade = rng.choice(GRADES)
+        letter = rng.choice(CLASS_LETTERS)
+        if rng.random() < extracurricular_rate:
+            turma = rng.choice(EXTRACURRICULAR)
+        else:
+            turma = rng.choice(CLASS_FORMATS).format(grade=grade, letter=letter)
+        nivel = rng.choice([f'{grade}.{rng.randint(1, 3)}', f'{grade},{rng.randint(1, 3)}', str(grade), None])
+        rows[grade].append((name, turma, rng.choice(PROFESSORS + [None]), nivel))
+        if rng.random() < 0.01:
+            rows[grade].append((name, turma, None, nivel))
+    return {
+        f'{grade}º ano': pd.DataFrame(grade_rows, columns=['Nome do Aluno', 'Turma', 'Professor', 'Nível'])
+        for grade, grade_rows in rows.items()
+    }
+
+
+def toefl_sheet(names, rows, seed=0, unknown_rate=0.15, typo_rate=0.15, concat_rate=0.05):
+    """TOEFL score sheet with ``rows`` test takers drawn from ``names``.
+
+    A share ``unknown_rate`` of the rows are students missing from the roster.
+    """
+    rng = random.Random(seed + 2)
+    names = list(names)
+    known = rng.sample(names, min(len(names), int(rows * (1 - unknown_rate))))
+    unknown = student_names(rows - len(known), seed + 3)
+    spelled = [toefl_spelling(rng, name, typo_rate, concat_rate) for name in known]
+    spelled += [name.upper() if rng.random() < 0.5 else name for name in unknown]
+    rng.shuffle(spelled)
+    return pd.DataFrame({
+        'NOME': spelled,
+        'LISTENING': [rng.randint(200, 300) for _ in spelled],
+        'LISTENING CERF': [rng.choice(['A2', 'B1', 'B2']) for _ in spelled],
+        'LFM': [rng.choice([rng.randint(200, 300), None]) for _ in spelled],
+        'LFM CERF': [rng.choice(['A2', 'B1', None]) for _ in spelled],
+        'READING': [rng.randint(200, 300) for _ in spelled],
+        'READING CERF': [rng.choice(['A2', 'B1', 'B2']) for _ in spelled],
+        'LEXIL': [rng.choice(['BR', '600L', '700L', 850]) for _ in spelled],
+        'OSL': [rng.randint(1, 5) for _ in spelled],
+        'TOTAL': [rng.randint(600, 900) for _ in spelled],
+    })
+
+
+def write_dataset(folder, students, toefl_rows=None, seed=0, toefl_format='xlsx'):
+    """Write ``base.xlsx`` and ``toefl.<format>`` into ``folder``; returns both paths."""
+    os.makedirs(folder, exist_ok=True)
+    names = student_names(students, seed)
+    base_path = os.path.join(folder, 'base.xlsx')
+    with pd.ExcelWriter(base_path) as writer:
+        for sheet_name, df in base_workbook_sheets(names, seed).items():
+            df.to_excel(writer, sheet_name=sheet_name, index=False)
+    toefl = toefl_sheet(names, toefl_rows or students, seed)
+    toefl_path = os.path.join(folder, f'toefl.{toefl_format}')
+    if toefl_format == 'csv':
+        toefl.to_csv(toefl_path, index=False)
+    else:
+        toefl.to_excel(toefl_path, index=False)
+    return base_path, toefl_path
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--students', type=int, default=1000)
+    parser.add_argument('--toefl-rows', type=int, default=None, help='default: same as --students')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--toefl-format', choices=['xlsx', 'csv'], default='xlsx')
+    parser.add_argument('--out', required=True)
+    args = parser.parse_args()
+    for path in write_dataset(args.out, args.students, args.toefl_rows, args.seed, args.toefl_format):
+        print(path)
+
+
+if __name__ == '__main__':
+    main()
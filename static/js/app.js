@@ -2,6 +2,10 @@
 class ComparisonDashboard {
     constructor() {
         this.currentResults = null;
+        this.datasetId = null;
+        // Geração do resultado base e reclassificação em andamento (descartar respostas obsoletas)
+        this.resultsGeneration = 0;
+        this.reclassifyController = null;
         this.init();
     }
 
@@ -110,6 +114,10 @@ class ComparisonDashboard {
         document.getElementById('threshold').addEventListener('input', (e) => {
             this.updateThresholdDisplay();
         });
+        // Ao soltar o slider, reclassificar o resultado atual no servidor (sem repontuar)
+        document.getElementById('threshold').addEventListener('change', () => {
+            this.handleReclassify();
+        });
 
         // Column selects (guards)
         const col1El = document.getElementById('column1');
@@ -163,6 +171,9 @@ class ComparisonDashboard {
             const result = await response.json();
 
             if (result.success) {
+                this.datasetId = result.dataset_id;
+                this.cancelReclassify();
+                this.currentResults = null;
                 this.displayFileInfo(result);
                 this.showToast('Arquivos carregados com sucesso!', 'success');
             } else {
@@ -227,7 +238,11 @@ class ComparisonDashboard {
         const column1 = column1El ? column1El.value : null;
         const column2 = column2El ? column2El.value : null;
 
+        // Uma nova comparação substitui o resultado base: reclassificações pendentes ficam obsoletas
+        this.cancelReclassify();
+
         const requestData = {
+            dataset_id: this.datasetId,
             threshold: parseInt(threshold),
             algorithm: algorithm,
             column1: column1,
@@ -237,6 +252,7 @@ class ComparisonDashboard {
 
         try {
             this.showLoading('Executando comparação...');
+            this.updateProgress(null);
             document.getElementById('loadingSection').style.display = 'block';
             
             const response = await fetch('/compare', {
@@ -247,7 +263,11 @@ class ComparisonDashboard {
                 body: JSON.stringify(requestData)
             });
 
-            const result = await response.json();
+            let result = await response.json();
+            // Comparação em background: acompanhar o job até concluir
+            if (result.success && result.job_id) {
+                result = await this.pollJob(result.job_id);
+            }
 
             if (result.success) {
                 this.currentResults = result;
@@ -264,6 +284,94 @@ class ComparisonDashboard {
         }
     }
 
+    cancelReclassify() {
+        this.resultsGeneration++;
+        if (this.reclassifyController) {
+            this.reclassifyController.abort();
+            this.reclassifyController = null;
+        }
+    }
+
+    async handleReclassify() {
+        if (!this.currentResults || !this.currentResults.result_id) return;
+        const threshold = document.getElementById('threshold').value;
+        const schoolYearEl = document.getElementById('schoolYearSelect');
+        const defaultSchoolLabel = schoolYearEl ? schoolYearEl.value : 'auto';
+
+        // Só vale a última reclassificação, e só sobre o resultado que ainda está na tela:
+        // a anterior é cancelada e respostas de outra geração (novo upload/comparação) são descartadas
+        if (this.reclassifyController) this.reclassifyController.abort();
+        const controller = new AbortController();
+        this.reclassifyController = controller;
+        const generation = this.resultsGeneration;
+        const baseResultId = this.currentResults.result_id;
+        const isStale = () => controller !== this.reclassifyController
+            || generation !== this.resultsGeneration
+            || !this.currentResults
+            || this.currentResults.result_id !== baseResultId;
+
+        try {
+            const response = await fetch(`/results/${encodeURIComponent(baseResultId)}/reclassify`, {
+                method: 'POST',
+                headers: {
+                    'Content-Type': 'application/json'
+                },
+                body: JSON.stringify({ threshold: parseInt(threshold), default_school_label: defaultSchoolLabel }),
+                signal: controller.signal
+            });
+            const result = await response.json();
+            if (isStale()) return;
+
+            if (result.success) {
+                this.currentResults = result;
+                this.displayResults(result);
+            } else {
+                this.showToast((result.error || 'Erro ao reclassificar') + ' Clique em "Iniciar Comparação".', 'error');
+            }
+        } catch (error) {
+            if (error.name === 'AbortError' || isStale()) return;
+            this.showToast('Erro de conexão: ' + error.message, 'error');
+        } finally {
+            if (this.reclassifyController === controller) this.reclassifyController = null;
+        }
+    }
+
+    async pollJob(jobId) {
+        // Consultar /jobs/<id> periodicamente; devolve o resultado final (ou o erro) do job
+        while (true) {
+            const response = await fetch(`/jobs/${encodeURIComponent(jobId)}`);
+            const job = await response.json();
+            if (job.status === 'done') {
+                this.updateProgress(job.progress);
+                return job.result;
+            }
+            if (job.status === 'error' || !response.ok) {
+                return { success: false, error: job.error || 'Erro na comparação' };
+            }
+            this.updateProgress(job.progress);
+            await new Promise(resolve => setTimeout(resolve, 500));
+        }
+    }
+
+    updateProgress(progress) {
+        const bar = document.getElementById('compareProgressBar');
+        const text = document.getElementById('compareProgressText');
+        if (!bar || !text) return;
+        const percent = progress ? progress.percent : 0;
+        bar.style.width = percent + '%';
+        bar.setAttribute('aria-valuenow', percent);
+        bar.textContent = Math.round(percent) + '%';
+        if (!progress || !progress.total) {
+            text.textContent = 'Aguardando início...';
+            return;
+        }
+        let message = `${progress.processed.toLocaleString()} de ${progress.total.toLocaleString()} nomes`;
+        if (progress.eta_seconds !== null && progress.eta_seconds !== undefined && progress.processed < progress.total) {
+            message += ` · restam ~${Math.ceil(progress.eta_seconds)}s`;
+        }
+        text.textContent = message;
+    }
+
     displayResults(data) {
         // Update statistics
         document.getElementById('totalToefl').textContent = data.statistics.total_toefl.toLocaleString();
@@ -412,17 +520,25 @@ class ComparisonDashboard {
             this.showLoading('Preparando exportação...');
             const schoolYearEl = document.getElementById('schoolYearSelect');
             const defaultSchoolLabel = schoolYearEl ? schoolYearEl.value : 'auto';
+            const exportFormatEl = document.getElementById('exportFormat');
+            const exportFormat = exportFormatEl ? exportFormatEl.value : 'xlsx';
             
+            // Com result_id o servidor usa o resultado guardado; sem ele, reenviar os resultados (modo legado)
+            const exportBody = this.currentResults.result_id
+                ? { result_id: this.currentResults.result_id, default_school_label: defaultSchoolLabel, format: exportFormat }
+                : {
+                    format: exportFormat,
+                    dataset_id: this.datasetId,
+                    results: this.currentResults.results,
+                    unmatched_list: this.currentResults.unmatched_list || [],
+                    default_school_label: defaultSchoolLabel
+                };
             const response = await fetch('/export', {
                 method: 'POST',
                 headers: {
                     'Content-Type': 'application/json'
                 },
-                body: JSON.stringify({
-                    results: this.currentResults.results,
-                    unmatched_list: this.currentResults.unmatched_list || [],
-                    default_school_label: defaultSchoolLabel
-                })
+                body: JSON.stringify(exportBody)
             });
 
             if (response.ok) {
@@ -430,7 +546,7 @@ class ComparisonDashboard {
                 const url = window.URL.createObjectURL(blob);
                 const a = document.createElement('a');
                 a.href = url;
-                a.download = `comparacao_nomes_${new Date().toISOString().slice(0, 19).replace(/:/g, '-')}.xlsx`;
+                a.download = `comparacao_nomes_${new Date().toISOString().slice(0, 19).replace(/:/g, '-')}.${exportFormat}`;
                 document.body.appendChild(a);
                 a.click();
                 window.URL.revokeObjectURL(url);
@@ -0,0 +1,149 @@
+"""compare_names with score_cutoff against the scoring it replaced.
+
+``reference_compare_prepared`` is compare_prepared as it was before the
+cutoff and early exits were added. With no cutoff the scores must be
+identical; with a cutoff, scores at or above it must be exact and the
+others 0, for every algorithm and every pair of the committed corpus.
+"""
+import csv
+import os
+
+import pytest
+from rapidfuzz import fuzz
+
+ALGORITHMS = ['ratio', 'partial_ratio', 'token_sort_ratio', 'token_set_ratio']
+CUTOFFS = [1, 50, 70, 75, 80, 85, 90, 95, 100]
+CORPUS_PATH = os.path.join(os.path.dirname(__file__), 'data', 'portuguese_name_pairs.csv')
+
+
+def load_pairs():
+    with open(CORPUS_PATH, newline='', encoding='utf-8') as f:
+        return [(row['toefl_name'], row['base_name']) for row in csv.DictReader(f)]
+
+
+PAIRS = load_pairs()
+
+
+def reference_similarity(str1, str2, algorithm='token_sort_ratio'):
+    if not str1 or not str2:
+        return 0
+    scorer = {
+        'ratio': fuzz.ratio,
+        'partial_ratio': fuzz.partial_ratio,
+        'token_sort_ratio': fuzz.token_sort_ratio,
+        'token_set_ratio': fuzz.token_set_ratio,
+    }.get(algorithm, fuzz.token_sort_ratio)
+    return scorer(str1, str2)
+
+
+def reference_compare_prepared(toefl, base, algorithm='token_sort_ratio'):
+    firstname_score = None
+    lastname_score = None
+    full_name_scores = []
+
+    if toefl.firstname and base.firstname:
+        firstname_score = reference_similarity(toefl.firstname, base.firstname, algorithm)
+    if toefl.lastname and base.lastname:
+        lastname_score = reference_similarity(toefl.lastname, base.lastname, algorithm)
+    if base.normalized:
+        for toefl_variant in toefl.variants:
+            full_name_scores.append(reference_similarity(toefl_variant, base.normalized, algorithm))
+
+    max_full = max(full_name_scores) if full_name_scores else None
+
+    weights = []
+    values = []
+    if firstname_score is not None:
+        weights.append(0.4)
+        values.append(firstname_score)
+    if lastname_score is not None:
+        weights.append(0.4)
+        values.append(lastname_score)
+    if max_full is not None:
+        weights.append(0.2)
+        values.append(max_full)
+    if values:
+        weighted_avg = sum(v * w for v, w in zip(values, weights)) / sum(weights)
+    else:
+        weighted_avg = 0
+
+    compact_score = reference_similarity(toefl.compact, base.compact, 'ratio') if base.compact else 0
+
+    overlap = toefl.tokens.intersection(base.tokens)
+    jaccard_score = (len(overlap) / max(1, len(base.tokens))) * 100
+
+    max_first_token_score = 0
+    max_last_token_score = 0
+    if base.firstname:
+        for tok in toefl.tokens:
+            max_first_token_score = max(max_first_token_score, reference_similarity(base.firstname, tok, algorithm))
+    if base.lastname:
+        for tok in toefl.tokens:
+            max_last_token_score = max(max_last_token_score, reference_similarity(base.lastname, tok, algorithm))
+
+    final_score = max(
+        weighted_avg,
+        max_full if max_full is not None else 0,
+        jaccard_score,
+        max_first_token_score,
+        max_last_token_score,
+        compact_score,
+    )
+    if len(toefl.tokens) >= 2 and len(overlap) < 2 and not compact_score >= 90:
+        final_score = min(final_score, 75)
+    return final_score
+
+
+@pytest.fixture(scope='module')
+def reference_scores(comparator):
+    prepared = [(comparator.prepare_toefl(t), comparator.prepare_base(b)) for t, b in PAIRS]
+    return {
+        algorithm: [reference_compare_prepared(t, b, algorithm) for t, b in prepared]
+        for algorithm in ALGORITHMS
+    }
+
+
+def test_corpus_is_not_trivial(reference_scores):
+    scores = reference_scores['token_sort_ratio']
+    assert len(PAIRS) >= 500
+    assert any(s == 100 for s in scores)
+    assert any(s == 75 for s in scores)
+    assert any(s < 50 for s in scores)
+
+
+@pytest.mark.parametrize('algorithm', ALGORITHMS)
+def test_scores_identical_without_cutoff(comparator, reference_scores, algorithm):
+    for (toefl_name, base_name), expected in zip(PAIRS, reference_scores[algorithm]):
+        assert comparator.compare_names(toefl_name, base_name, algorithm) == expected, (toefl_name, base_name)
+        assert comparator.compare_names(toefl_name, base_name, algorithm, score_cutoff=0) == expected, (toefl_name, base_name)
+
+
+@pytest.mark.parametrize('algorithm', ALGORITHMS)
+def test_cutoff_keeps_scores_above_and_zeroes_below(comparator, reference_scores, algorithm):
+    for (toefl_name, base_name), expected in zip(PAIRS, reference_scores[algorithm]):
+        toefl, base = comparator.prepare_toefl(toefl_name), comparator.prepare_base(base_name)
+        for cutoff in CUTOFFS:
+            got = comparator.compare_prepared(toefl, base, algorithm, score_cutoff=cutoff)
+            if expected >= cutoff:
+                assert got == expected, (toefl_name, base_name, cutoff)
+            else:
+                assert got == 0, (toefl_name, base_name, cutoff, got)
+
+
+@pytest.mark.parametrize('algorithm', ALGORITHMS)
+def test_best_match_unchanged_with_running_cutoff(comparator, reference_scores, algorithm):
+    # Melhor candidato de cada nome TOEFL com o máximo corrente como cutoff, como no matching
+    by_toefl = {}
+    for i, (toefl_name, base_name) in enumerate(PAIRS):
+        by_toefl.setdefault(toefl_name, []).append((base_name, reference_scores[algorithm][i]))
+    for toefl_name, candidates in by_toefl.items():
+        toefl = comparator.prepare_toefl(toefl_name)
+        best_name, best_score = None, 0
+        for base_name, _ in candidates:
+            score = comparator.compare_prepared(toefl, comparator.prepare_base(base_name), algorithm, score_cutoff=best_score)
+            if score > best_score:
+                best_name, best_score = base_name, score
+        expected_name, expected_score = max(candidates, key=lambda c: c[1])
+        assert best_score == expected_score, toefl_name
+        if expected_score > 0:
+            assert best_name == expected_name, toefl_name
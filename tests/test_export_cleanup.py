@@ -0,0 +1,51 @@
+"""Temporary .xlsx/.parquet export files are removed whenever the response is closed."""
+import tempfile
+
+import pytest
+
+
+@pytest.fixture
+def client(app_module, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(app_module.result_store, 'folder', str(tmp_path / 'results'))
+    monkeypatch.setattr(tempfile, 'tempdir', str(tmp_path))
+    return app_module.app.test_client()
+
+
+@pytest.fixture
+def result_id(app_module):
+    record = {
+        'dataset_id': None,
+        'default_school_label': None,
+        'results': [{'toefl_name': 'SILVA, JOAO', 'base_name': 'João da Silva', 'turma': '6º ano A', 'score': 92.0}],
+        'unmatched': [('SOUZA, ANA', {})],
+    }
+    return app_module.result_store.put(record)
+
+
+def export_files(tmp_path):
+    return sorted(p.name for p in tmp_path.glob('export_*'))
+
+
+def test_full_download_removes_file(client, result_id, tmp_path):
+    response = client.get(f'/export?result_id={result_id}')
+    assert response.status_code == 200
+    assert response.get_data()[:2] == b'PK'
+    response.close()
+    assert export_files(tmp_path) == []
+
+
+def test_head_removes_file(client, result_id, tmp_path):
+    for _ in range(3):
+        response = client.head(f'/export?result_id={result_id}')
+        assert response.status_code == 200
+        response.close()
+    assert export_files(tmp_path) == []
+
+
+def test_closing_without_reading_removes_file(client, result_id, tmp_path):
+    response = client.get(f'/export?result_id={result_id}', buffered=False)
+    assert response.status_code == 200
+    assert export_files(tmp_path)  # ainda não enviado: o arquivo existe
+    response.close()
+    assert export_files(tmp_path) == []
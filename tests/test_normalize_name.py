@@ -0,0 +1,98 @@
+"""normalize_name (NFD accent stripping + LRU memo) against the replace-loop version it replaced.
+
+Outputs must be unchanged for ASCII and the accents the previous version
+handled, for missing values and for numbers.
+"""
+import math
+import random
+import re
+
+import pandas as pd
+import pytest
+
+LEGACY_ACCENTS = 'áàãâéêíóôõúüç'
+
+
+def legacy_normalize_name(name):
+    """normalize_name as it was before the NFD/LRU rework."""
+    if pd.isna(name):
+        return ""
+    name = str(name).strip()
+    name = ' '.join(name.split()).lower()
+    replacements = {
+        'á': 'a', 'à': 'a', 'ã': 'a', 'â': 'a',
+        'é': 'e', 'ê': 'e',
+        'í': 'i',
+        'ó': 'o', 'ô': 'o', 'õ': 'o',
+        'ú': 'u', 'ü': 'u',
+        'ç': 'c'
+    }
+    for old, new in replacements.items():
+        name = name.replace(old, new)
+    name = re.sub(r'[^\w\s,]', '', name)
+    return name
+
+
+def spreadsheet_names(count, seed=42):
+    # Nomes no formato das planilhas: maiúsculas/minúsculas, vírgula TOEFL, pontuação e espaços extras
+    rng = random.Random(seed)
+    alphabet = 'abcdefghijklmnopqrstuvwxyz0123456789' + LEGACY_ACCENTS
+    extras = [' ', '  ', ',', '.', '-', "'", 'º', 'ª', '\t', '\n', '_']
+    names = []
+    for _ in range(count):
+        words = []
+        for _ in range(rng.randint(1, 5)):
+            word = ''.join(rng.choice(alphabet) for _ in range(rng.randint(1, 10)))
+            words.append(word.upper() if rng.random() < 0.4 else word.capitalize())
+        name = ' '.join(words)
+        if rng.random() < 0.5:
+            name = name.replace(' ', rng.choice(extras), 1)
+        names.append(' ' * rng.randint(0, 2) + name + ' ' * rng.randint(0, 2))
+    return names
+
+
+REAL_NAMES = [
+    'João da Silva', 'SILVA, JOÃO', 'Antônio Gonçalves', 'ASSUNÇÃO, MARIA DA CONCEIÇÃO', 'Lívia Nóbrega',
+    'Thaís Magalhães  Brandão', "Enzo D'Ávila", 'Müller, Luíza', 'ÚRSULA ARAÚJO', 'Otávio Uchôa', 'Raí Sá',
+    '6º ano - B', '9ª série A', 'FUND 7A', 'Violino', 'Turma 8C',
+]
+
+
+def test_legacy_accent_set_unchanged(comparator):
+    for text in (LEGACY_ACCENTS, LEGACY_ACCENTS.upper(), ' '.join(LEGACY_ACCENTS), LEGACY_ACCENTS.title()):
+        assert comparator.normalize_name(text) == legacy_normalize_name(text)
+    for char in LEGACY_ACCENTS + LEGACY_ACCENTS.upper():
+        assert comparator.normalize_name(f'x{char}y') == legacy_normalize_name(f'x{char}y'), char
+
+
+@pytest.mark.parametrize('name', REAL_NAMES)
+def test_real_names_unchanged(comparator, name):
+    assert comparator.normalize_name(name) == legacy_normalize_name(name)
+
+
+def test_generated_spreadsheet_names_unchanged(comparator):
+    mismatches = [n for n in spreadsheet_names(20000) if comparator.normalize_name(n) != legacy_normalize_name(n)]
+    assert not mismatches, mismatches[:5]
+
+
+@pytest.mark.parametrize('value', [None, float('nan'), pd.NA, pd.NaT, math.nan, '', '   ', '\t\n'])
+def test_missing_and_blank_values(comparator, value):
+    assert comparator.normalize_name(value) == legacy_normalize_name(value) == ''
+
+
+@pytest.mark.parametrize('value', [6, 9, 6.1, 7.25, -3, 0, 1e21])
+def test_numbers(comparator, value):
+    assert comparator.normalize_name(value) == legacy_normalize_name(value)
+
+
+def test_repeated_calls_hit_the_memo(app_module, comparator):
+    comparator.normalize_name('Conceição Assunção')
+    hits = app_module._normalize_name_cached.cache_info().hits
+    assert comparator.normalize_name('Conceição Assunção') == 'conceicao assuncao'
+    assert app_module._normalize_name_cached.cache_info().hits == hits + 1
+
+
+def test_other_latin_diacritics_are_removed(comparator):
+    # Mudança intencional: todos os diacríticos latinos saem, não só os do conjunto antigo
+    assert comparator.normalize_name('Müller Ñuñez Èva Øystein') == 'muller nunez eva øystein'
+    assert comparator.normalize_name('6º ano') == '6º ano'